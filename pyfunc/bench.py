@@ -0,0 +1,479 @@
+"""
+Offline replay + benchmark harness for main.py.
+
+    python bench.py record --fixtures fixtures     # live run, saves raw provider JSON
+    python bench.py replay --fixtures fixtures     # full main() against a local stand-in
+    python bench.py replay --synthetic             # same, responses sampled from gf_deals.json
+    python bench.py stages --sizes 1000,10000,100000,1000000
+    python bench.py pool --size 200000 --workers 0,1,2,4,8   # STAGE_EXECUTOR=process scaling (0 = inline)
+    python bench.py importtime --runs 7            # cold import of main.py vs IMPORT_BUDGET_MS
+    FIRESTORE_EMULATOR_HOST=localhost:8080 python bench.py firestore --docs 5000
+    python bench.py export --rows 500000 --store Target   # JSONL export write + filtered scan
+
+main.py reads its endpoints/keys from the environment at import time, so it is
+only imported after the environment for the chosen mode has been set up.
+"""
+import os
+import sys
+import re
+import json
+import time
+import random
+import hashlib
+import argparse
+import resource
+import statistics
+import subprocess
+import threading
+import multiprocessing
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from typing import List, Dict, Optional, Tuple
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SEED_CORPUS = os.path.join(HERE, "gf_deals.json")
+
+def load_seed_corpus(path: str = SEED_CORPUS) -> List[Dict]:
+    with open(path) as f:
+        return [d for d in json.load(f) if d.get("title") or d.get("snippet")]
+
+def _norm(query: str) -> str:
+    return " ".join(str(query).lower().split())
+
+def _seed(*parts: str) -> int:
+    return int(hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()[:8], 16)
+
+# ---------------- Local provider stand-in ----------------
+class FixtureStore:
+    """Recorded responses keyed by (provider, engine, normalized query); optional synthetic fallback."""
+
+    def __init__(self, fixture_dir: Optional[str] = None, synthetic: bool = False, seed_items: Optional[List[Dict]] = None,
+                 latency: float = 0.0):
+        self.responses: Dict[Tuple[str, str, str], Dict] = {}
+        self.synthetic = synthetic
+        self.latency = latency
+        self.seed_items = seed_items or (load_seed_corpus() if synthetic else [])
+        self.stats = {"hits": 0, "synthetic": 0, "misses": 0}
+        self._lock = threading.Lock()
+        if fixture_dir and os.path.isdir(fixture_dir):
+            for name in sorted(os.listdir(fixture_dir)):
+                if not name.endswith(".json"): continue
+                with open(os.path.join(fixture_dir, name)) as f:
+                    fx = json.load(f)
+                self.responses[(fx["provider"], fx["engine"], _norm(fx["query"]))] = fx["response"]
+        print(f"📼 Loaded {len(self.responses)} fixtures{' (+ synthetic fallback)' if synthetic else ''}")
+
+    def _count(self, key: str) -> None:
+        with self._lock: self.stats[key] += 1
+
+    def lookup(self, provider: str, engine: str, query: str, request: Optional[str] = None) -> Dict:
+        if self.latency: time.sleep(self.latency)
+        found = self.responses.get((provider, engine, _norm(query)))
+        if found is not None:
+            self._count("hits"); return found
+        if not self.synthetic:
+            self._count("misses")
+            return {"content": ""} if provider == "openai" else {"organic_results": [], "results": []}
+        self._count("synthetic")
+        return self.synthesize(provider, engine, query, request)
+
+    def chat(self, body: Dict) -> str:
+        """Chat-completions body → reply content: an LLM review batch or the query plan."""
+        import main
+        messages = body.get("messages") or [{}]
+        model = body.get("model", "gpt-3.5-turbo")
+        if messages[0].get("content") == main.LLM_REVIEW_SYSTEM_PROMPT:
+            prompt = messages[-1].get("content", "")
+            return self.lookup("openai", model, main.review_fixture_query(prompt), request=prompt)["content"]
+        return self.lookup("openai", model, "query-plan")["content"]
+
+    def synthesize(self, provider: str, engine: str, query: str, request: Optional[str] = None) -> Dict:
+        rnd = random.Random(_seed(provider, engine, _norm(query)))
+        if provider == "openai" and request is not None:
+            return {"content": json.dumps({"verdicts": [mock_review_verdict(item) for item in json.loads(request)["items"]]})}
+        if provider == "openai":
+            import main
+            names = [n for n in main.DEAL_FOCUSED_STORES.values()] + main.enhanced_brands
+            month = datetime.now().strftime('%B %Y')
+            kinds = ["coupons", "promo codes", "sale", "deals", "BOGO offers", "discount codes"]
+            return {"content": "\n".join(f"{rnd.choice(names)} gluten free {rnd.choice(kinds)} {month}" for _ in range(60))}
+        picks = rnd.sample(self.seed_items, min(len(self.seed_items), 20 if provider == "serpapi" else 10))
+        if provider == "serpapi":
+            return {"organic_results": [{"title": d.get("title", ""), "snippet": d.get("snippet", ""), "link": d.get("link", "")} for d in picks]}
+        return {"answer": "", "results": [{"title": d.get("title", ""), "content": d.get("snippet", ""), "url": d.get("link", "")} for d in picks]}
+
+REVIEW_GF_RE = re.compile(r"gluten|celiac|\bgf\b")
+REVIEW_OFFER_RE = re.compile(r"coupon|promo|code|sale|% off|\$\d|bogo|rebate|cash ?back|free shipping|deal")
+REVIEW_NOT_OFFER_RE = re.compile(r"recipe|how to|blog|review|expired")
+
+def mock_review_verdict(item: Dict) -> Dict:
+    """Deterministic stand-in for the LLM's judgement of one review item."""
+    text = f"{item.get('title', '')} {item.get('snippet', '')}".lower()
+    keep = bool(REVIEW_GF_RE.search(text) and REVIEW_OFFER_RE.search(text)) and not REVIEW_NOT_OFFER_RE.search(text)
+    return {"id": item["id"], "keep": keep, "confidence": 0.9, "store": None, "brand": None}
+
+def _chat_completion(content: str) -> Dict:
+    return {
+        "id": "chatcmpl-replay", "object": "chat.completion", "created": int(time.time()), "model": "gpt-3.5-turbo",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+    }
+
+def start_fixture_server(store: FixtureStore, port: int = 0) -> ThreadingHTTPServer:
+    """
+    Serve SerpAPI (GET /search), Tavily (POST /tavily/search) and OpenAI
+    (POST /v1/chat/completions) from the fixture store on 127.0.0.1.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, body: Dict, status: int = 200):
+            raw = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(raw)))
+            self.end_headers()
+            self.wfile.write(raw)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != "/search": return self._reply({"error": "not found"}, 404)
+            qs = {k: v[0] for k, v in parse_qs(url.query).items()}
+            self._reply(store.lookup("serpapi", qs.get("engine", "google"), qs.get("q", "")))
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            path = urlparse(self.path).path
+            if path == "/tavily/search":
+                return self._reply(store.lookup("tavily", "tavily", body.get("query", "")))
+            if path.endswith("/chat/completions"):
+                return self._reply(_chat_completion(store.chat(body)))
+            self._reply({"error": "not found"}, 404)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fixture-server", daemon=True).start()
+    return server
+
+# ---------------- Record / replay ----------------
+def cmd_record(args) -> None:
+    os.environ["SEARCH_RECORD_DIR"] = os.path.abspath(args.fixtures)
+    os.environ.setdefault("FIRESTORE_WRITE_MODE", "none")
+    import main
+    main.main()
+    print(f"📼 Fixtures saved to {os.environ['SEARCH_RECORD_DIR']}")
+
+def cmd_replay(args) -> None:
+    store = FixtureStore(args.fixtures, synthetic=args.synthetic, latency=args.latency)
+    server = start_fixture_server(store)
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ.update({
+        "SERPAPI_URL": f"{base}/search", "TAVILY_URL": f"{base}/tavily/search", "OPENAI_BASE_URL": f"{base}/v1/",
+        "SERPAPI_KEY": "replay", "TAVILY_API_KEY": "replay", "OPENAI_API_KEY": "replay",
+        "SEARCH_CACHE_BACKEND": "none",
+    })
+    os.environ.setdefault("FIRESTORE_WRITE_MODE", "none")
+    os.environ.setdefault("SEEN_INDEX", "none")  # SEEN_INDEX=local to measure warm (steady-state) runs
+    import main
+    if not args.keep_rate_limits:
+        main.RATE_LIMITER = main.RateLimiter({k: (1000.0, 1000) for k in main.DEFAULT_RATE_LIMITS})
+    start = time.perf_counter()
+    deals = main.main()
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    print(f"\n📼 Replay: {len(deals)} deals in {elapsed:.2f}s, fixtures {store.stats}, peak RSS {_peak_rss_mb():.0f} MB")
+
+# ---------------- Stage benchmark ----------------
+NUMBER_RE = re.compile(r"\d+")
+
+def synthetic_corpus(seed_items: List[Dict], n: int, seed: int = 0) -> List[Dict]:
+    """
+    n raw hits built from the seed corpus: titles and snippets are recombined and
+    their numbers re-rolled so texts stay mostly unique (no free memo-cache hits),
+    and every link is made distinct.
+    """
+    rnd = random.Random(seed)
+    out = []
+    for i in range(n):
+        a, b = rnd.choice(seed_items), rnd.choice(seed_items)
+        snippet = NUMBER_RE.sub(lambda m: str(rnd.randint(1, 99)), str(b.get("snippet", "") or ""))
+        title = str((a if rnd.random() < 0.8 else b).get("title", "") or "")
+        link = str(a.get("link", "") or "")
+        out.append({"title": title, "snippet": snippet, "link": f"{link}{'&' if '?' in link else '?'}bench={i}" if link.startswith("http") else link,
+                    "source": a.get("source") or "SerpAPI (google)"})
+    return out
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def run_stage_bench(n: int, seed: int = 0) -> Dict:
+    """One corpus size, in-process. Runs the same stages main() does, in order."""
+    import main
+    corpus = synthetic_corpus(load_seed_corpus(), n, seed)
+    base_rss = _peak_rss_mb()
+    fetched_at = datetime.now()
+    stages: List[Dict] = []
+
+    def timed(name, fn, items):
+        start = time.perf_counter()
+        out = fn(items)
+        secs = time.perf_counter() - start
+        stages.append({"stage": name, "in": len(items), "out": len(out), "seconds": round(secs, 4),
+                       "us_per_item": round(secs / max(len(items), 1) * 1e6, 2)})
+        return out
+
+    total_start = time.perf_counter()
+    quiet = open(os.devnull, "w")
+    stdout, sys.stdout = sys.stdout, quiet  # the list wrappers print per call
+    try:
+        deals = timed("build", lambda xs: [main.Deal(x["title"], x["snippet"], x["link"], x["source"], fetched_at) for x in xs], corpus)
+        del corpus
+        deals = timed("quality", lambda xs: [d for d in xs if main.is_high_quality_deal(d)], deals)
+        deals = timed("real_deal", lambda xs: [d for d in xs if main.is_real_deal(d)], deals)
+        deals = timed("validate", main.ai_powered_deal_validation, deals)
+        deals = timed("enhance", main.enhance_deal_metadata, deals)
+        deals = timed("relevance", main.final_relevance_filter, deals)
+        deals = timed("dedup", main.dedupe_deals, deals)
+    finally:
+        sys.stdout = stdout; quiet.close()
+    total = time.perf_counter() - total_start
+    return {"size": n, "kept": len(deals), "seconds": round(total, 3), "items_per_sec": round(n / total, 1),
+            "peak_rss_mb": round(_peak_rss_mb(), 1), "peak_rss_delta_mb": round(_peak_rss_mb() - base_rss, 1), "stages": stages}
+
+def _bench_child(n: int, seed: int, conn) -> None:
+    try:
+        conn.send(run_stage_bench(n, seed))
+    except BaseException as e:
+        conn.send({"size": n, "error": repr(e)})
+    finally:
+        conn.close()
+
+def cmd_stages(args) -> None:
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    ctx = multiprocessing.get_context("spawn")  # fresh process per size: clean memo caches and peak RSS
+    results = []
+    for n in sizes:
+        parent, child = ctx.Pipe(duplex=False)
+        proc = ctx.Process(target=_bench_child, args=(n, args.seed, child))
+        proc.start(); child.close()
+        res = parent.recv(); proc.join()
+        results.append(res)
+        if "error" in res:
+            print(f"❌ {n:>9,} items: {res['error']}"); continue
+        print(f"⏱️  {n:>9,} items: {res['seconds']:8.2f}s  {res['items_per_sec']:>10,.0f} items/s  "
+              f"peak RSS {res['peak_rss_mb']:.0f} MB (+{res['peak_rss_delta_mb']:.0f})  kept {res['kept']:,}")
+        for st in res["stages"]:
+            print(f"     {st['stage']:<10} {st['in']:>9,} → {st['out']:>9,}  {st['seconds']:8.3f}s  {st['us_per_item']:8.2f} µs/item")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"generatedAt": datetime.utcnow().isoformat() + "Z", "seed": args.seed, "results": results}, f, indent=2)
+        print(f"📝 Wrote {args.json}")
+
+# ---------------- Process-pool stages ----------------
+def run_pool_bench(n: int, workers: int, chunk_size: int, seed: int = 0) -> Dict:
+    """Raw synthetic hits through the per-deal stages: inline (workers=0) or on a pool of that many processes."""
+    import main
+    fetched_at = datetime.now()
+    deals = [main.Deal(x["title"], x["snippet"], x["link"], x["source"], fetched_at) for x in synthetic_corpus(load_seed_corpus(), n, seed)]
+    stats: Dict = {}
+    validation, relevance = {"passed": 0, "failed_gf": 0, "failed_score": 0}, main.new_relevance_stats()
+    quiet = open(os.devnull, "w")
+    stdout, sys.stdout = sys.stdout, quiet
+    start = time.perf_counter()
+    try:
+        if workers:
+            kept = list(main.run_deal_pipeline_pool(iter(deals), stats, validation, relevance, quality=True,
+                                                    workers=workers, chunk_size=chunk_size))
+        else:
+            kept = list(main.run_deal_pipeline(iter(deals), main.default_deal_stages(validation, relevance, quality=True), stats))
+    finally:
+        sys.stdout = stdout; quiet.close()
+    secs = time.perf_counter() - start
+    rows = [{k: v for k, v in d.to_dict().items() if k != "timestamp"} for d in kept]  # fetched_at is per process
+    digest = hashlib.sha1(json.dumps(rows, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+    return {"workers": workers, "size": n, "kept": len(kept), "seconds": round(secs, 3), "items_per_sec": round(n / secs, 1), "digest": digest}
+
+def _pool_child(n: int, workers: int, chunk_size: int, seed: int, conn) -> None:
+    try:
+        conn.send(run_pool_bench(n, workers, chunk_size, seed))
+    except BaseException as e:
+        conn.send({"workers": workers, "error": repr(e)})
+    finally:
+        conn.close()
+
+def cmd_pool(args) -> None:
+    ctx = multiprocessing.get_context("spawn")  # fresh coordinator per run: no warm memo caches carried over
+    results, base = [], None
+    print(f"🧮 {args.size:,} raw hits, chunks of {args.chunk_size}, {os.cpu_count()} CPUs")
+    for w in [int(s) for s in args.workers.split(",") if s.strip()]:
+        parent, child = ctx.Pipe(duplex=False)
+        proc = ctx.Process(target=_pool_child, args=(args.size, w, args.chunk_size, args.seed, child))
+        proc.start(); child.close()
+        res = parent.recv(); proc.join()
+        results.append(res)
+        label = f"{w} workers" if w else "inline"
+        if "error" in res:
+            print(f"❌ {label:>10}: {res['error']}"); continue
+        base = base or res
+        same = "" if res["digest"] == base["digest"] else "  ⚠️ output differs"
+        print(f"⏱️  {label:>10}: {res['seconds']:8.2f}s  {res['items_per_sec']:>10,.0f} items/s  "
+              f"x{res['items_per_sec'] / base['items_per_sec']:.2f}  kept {res['kept']:,}{same}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"generatedAt": datetime.utcnow().isoformat() + "Z", "seed": args.seed, "results": results}, f, indent=2)
+        print(f"📝 Wrote {args.json}")
+
+# ---------------- Import time / cold-start budget ----------------
+IMPORT_BUDGET_MS = float(os.getenv("IMPORT_BUDGET_MS", "250"))
+# main.py imports these on first use; seeing one during `import main` means something pulled it back in
+LAZY_MODULES = ("requests", "openai", "google.cloud.firestore", "google.cloud.pubsub_v1", "dotenv",
+                "asyncio", "concurrent.futures", "email.utils")
+IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$")
+
+def measure_import(module: str = "main") -> Dict:
+    """One fresh interpreter running `python -X importtime -c "import main"`; times in ms."""
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(p for p in (HERE, os.environ.get("PYTHONPATH")) if p)}
+    env.setdefault("K_SERVICE", "bench")  # as deployed: config from env vars, no .env lookup
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=HERE, env=env, capture_output=True, text=True)
+    wall_ms = (time.perf_counter() - start) * 1000
+    if proc.returncode: raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+    rows = [(m.group(4), int(m.group(1)) / 1000, int(m.group(2)) / 1000, len(m.group(3)) // 2)
+            for m in map(IMPORTTIME_RE.match, proc.stderr.splitlines()) if m]
+    end = next(i for i, r in enumerate(rows) if r[0] == module and r[3] == 0)
+    begin = max((i for i in range(end) if rows[i][3] == 0), default=-1) + 1
+    subtree = rows[begin:end]  # importtime prints children before their parent
+    return {"total_ms": round(rows[end][2], 1), "self_ms": round(rows[end][1], 1), "wall_ms": round(wall_ms, 1),
+            "children": sorted(({"module": n, "ms": round(c, 1)} for n, _, c, d in subtree if d == 1), key=lambda c: -c["ms"]),
+            "lazy_loaded": [n for n, *_ in subtree if n in LAZY_MODULES]}
+
+def cmd_importtime(args) -> None:
+    runs = [measure_import(args.module) for _ in range(args.runs)]
+    runs.sort(key=lambda r: r["total_ms"])
+    median = runs[len(runs) // 2]
+    total = statistics.median(r["total_ms"] for r in runs)
+    print(f"⏱️  import {args.module}: median {total:.1f} ms (min {runs[0]['total_ms']:.1f}, max {runs[-1]['total_ms']:.1f}) "
+          f"over {len(runs)} runs; self {median['self_ms']:.1f} ms, interpreter wall {median['wall_ms']:.0f} ms")
+    for child in median["children"][:args.top]:
+        print(f"     {child['module']:<28} {child['ms']:8.1f} ms")
+    lazy = sorted({n for r in runs for n in r["lazy_loaded"]})
+    if lazy: print(f"⚠️  Loaded at import time but meant to be lazy: {', '.join(lazy)}")
+    over = total > args.budget_ms
+    print(f"{'❌' if over else '✅'} Cold-start import budget: {total:.1f} / {args.budget_ms:.0f} ms")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"generatedAt": datetime.utcnow().isoformat() + "Z", "module": args.module, "budgetMs": args.budget_ms,
+                       "medianMs": total, "lazyLoaded": lazy, "runs": runs}, f, indent=2)
+        print(f"📝 Wrote {args.json}")
+    if over or lazy: sys.exit(1)
+
+# ---------------- Firestore writer (emulator) ----------------
+def cmd_firestore(args) -> None:
+    """Insert, no-op resync, partial update and replace of synthetic deals; emulator only."""
+    if not os.getenv("FIRESTORE_EMULATOR_HOST"):
+        sys.exit("❌ Set FIRESTORE_EMULATOR_HOST (gcloud emulators firestore start) — this wipes gf_deals")
+    os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "gf-deals-bench")
+    import main
+    coll = main.get_firestore_client().collection("gf_deals")
+    for snap in coll.select([]).stream(): snap.reference.delete()
+    fetched_at = datetime.now()
+    deals = [main.Deal(x["title"], x["snippet"], x["link"], x["source"], fetched_at).to_dict()
+             for x in synthetic_corpus(load_seed_corpus(), args.docs, args.seed)]
+    changed = [{**d, "ai_quality_score": d["ai_quality_score"] + 1} if i % 10 == 0 else d for i, d in enumerate(deals)]
+    run_ts = datetime.utcnow()
+    for label, fn, batch in [("insert", main.sync_deals_firestore, deals), ("resync", main.sync_deals_firestore, deals),
+                             ("update 10%", main.sync_deals_firestore, changed), ("replace", main.replace_deals_firestore, deals[: args.docs // 2])]:
+        start = time.perf_counter()
+        stats = fn(iter(batch), run_ts)
+        secs = time.perf_counter() - start
+        stored = sum(1 for _ in coll.select([]).stream())
+        print(f"⏱️  {label:<10} {len(batch):>7,} deals {secs:7.2f}s  {len(batch) / secs:>8,.0f} deals/s  stored {stored:,}  {stats}")
+
+# ---------------- Export benchmark ----------------
+def cmd_export(args) -> None:
+    """Write synthetic deals through DealExporter, then scan them back (all rows, and filtered by store)."""
+    import tempfile
+    import main
+    seed_items = load_seed_corpus()
+    rnd = random.Random(args.seed)
+    out_dir = args.dir or tempfile.mkdtemp(prefix="gf-export-")
+    base_rss = _peak_rss_mb()
+
+    exporter = main.DealExporter(out_dir, datetime.utcnow(), compression=args.compression, rows_per_file=args.rows_per_file)
+    start = time.perf_counter()
+    for i in range(args.rows):
+        deal = dict(rnd.choice(seed_items)); deal["link"] = f"{deal.get('link', '')}#{i}"
+        exporter.write(deal)
+    stats = exporter.close()
+    secs = time.perf_counter() - start
+    print(f"⏱️  write  {args.rows:>9,} rows {secs:7.2f}s  {args.rows / secs:>9,.0f} rows/s  "
+          f"{stats['files']} files  {stats['bytes'] / max(args.rows, 1):.0f} B/row")
+
+    for label, filters in [("scan", {}), (f"store={args.store}", {"store": args.store})]:
+        start = time.perf_counter()
+        matched = sum(1 for _ in main.iter_exported_deals(out_dir, **filters))
+        secs = time.perf_counter() - start
+        print(f"⏱️  {label:<16} {matched:>9,} rows {secs:7.2f}s  {args.rows / secs:>9,.0f} rows/s scanned")
+    print(f"📦 {out_dir}  peak RSS {_peak_rss_mb():.0f} MB (+{_peak_rss_mb() - base_rss:.0f} MB)")
+
+# ---------------- CLI ----------------
+def main_cli(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    rec = sub.add_parser("record", help="live run that saves raw provider responses")
+    rec.add_argument("--fixtures", default=os.path.join(HERE, "fixtures"))
+    rec.set_defaults(fn=cmd_record)
+
+    rep = sub.add_parser("replay", help="run main() against the local provider stand-in")
+    rep.add_argument("--fixtures", default=os.path.join(HERE, "fixtures"))
+    rep.add_argument("--synthetic", action="store_true", help="answer unrecorded requests from gf_deals.json")
+    rep.add_argument("--keep-rate-limits", action="store_true", help="keep the production token-bucket rates")
+    rep.add_argument("--latency", type=float, default=0.0, help="seconds each stand-in response takes, to mimic provider latency")
+    rep.set_defaults(fn=cmd_replay)
+
+    st = sub.add_parser("stages", help="per-stage throughput/latency/memory over synthetic corpora")
+    st.add_argument("--sizes", default="1000,10000,100000")
+    st.add_argument("--seed", type=int, default=0)
+    st.add_argument("--json", help="also write results to this file")
+    st.set_defaults(fn=cmd_stages)
+
+    pl = sub.add_parser("pool", help="per-deal stage throughput inline vs STAGE_EXECUTOR=process at several worker counts")
+    pl.add_argument("--size", type=int, default=100000)
+    pl.add_argument("--workers", default="0,1,2,4", help="comma-separated pool sizes; 0 runs inline")
+    pl.add_argument("--chunk-size", type=int, default=256)
+    pl.add_argument("--seed", type=int, default=0)
+    pl.add_argument("--json", help="also write results to this file")
+    pl.set_defaults(fn=cmd_pool)
+
+    imp = sub.add_parser("importtime", help="cold import time of main.py (python -X importtime) against a budget")
+    imp.add_argument("--module", default="main")
+    imp.add_argument("--runs", type=int, default=5)
+    imp.add_argument("--top", type=int, default=10, help="heaviest direct imports to list")
+    imp.add_argument("--budget-ms", type=float, default=IMPORT_BUDGET_MS)
+    imp.add_argument("--json", help="also write results to this file")
+    imp.set_defaults(fn=cmd_importtime)
+
+    fs = sub.add_parser("firestore", help="bulk writer throughput/outcomes against the Firestore emulator")
+    fs.add_argument("--docs", type=int, default=5000)
+    fs.add_argument("--seed", type=int, default=0)
+    fs.set_defaults(fn=cmd_firestore)
+
+    ex = sub.add_parser("export", help="JSON Lines export write throughput and constant-memory filtered scans")
+    ex.add_argument("--rows", type=int, default=200000)
+    ex.add_argument("--rows-per-file", type=int, default=50000)
+    ex.add_argument("--compression", default="gzip", choices=["gzip", "zstd"])
+    ex.add_argument("--store", default="Target")
+    ex.add_argument("--dir", help="output directory (default: a fresh temp dir)")
+    ex.add_argument("--seed", type=int, default=0)
+    ex.set_defaults(fn=cmd_export)
+
+    args = parser.parse_args(argv)
+    args.fn(args)
+
+if __name__ == "__main__":
+    main_cli()
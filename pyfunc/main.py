@@ -1,20 +1,35 @@
 import os
-import requests
 import time
 import random
 import re
-from urllib.parse import urlparse
-from typing import List, Dict, Optional
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+from typing import List, Dict, Optional, NamedTuple, Iterable, Iterator, Callable, Tuple, TYPE_CHECKING
 import json
-import openai
-from datetime import datetime, timedelta
-import concurrent.futures
-from dotenv import load_dotenv
-from google.cloud import firestore
+from datetime import datetime, timedelta, date
+from dataclasses import dataclass, field
+from enum import Enum
+import queue
+import threading
+import functions_framework
 import hashlib
+import base64
+import sqlite3
+import zlib
+from functools import lru_cache
+from contextlib import contextmanager
+import contextvars
+
+if TYPE_CHECKING:
+    import asyncio
+    import openai
+    import requests
+    from google.cloud import firestore
 
 # --- Configuration ---
-load_dotenv()
+# Deployed instances get their config from env vars; only import python-dotenv when there is a .env to read
+if not os.getenv("K_SERVICE") or os.path.exists(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")):
+    from dotenv import load_dotenv
+    load_dotenv()
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 SERPAPI_KEY    = os.getenv("SERPAPI_KEY")
@@ -24,8 +39,99 @@ REQUEST_TIMEOUT = 30
 MAX_QUERIES_PER_SOURCE = 8
 MAX_DEALS_TO_DISPLAY = 25
 MAX_WORKERS = 3
+SEARCH_CONCURRENCY = {
+    "serpapi": int(os.getenv("SERPAPI_CONCURRENCY", "6")),
+    "tavily":  int(os.getenv("TAVILY_CONCURRENCY", str(MAX_WORKERS))),
+}
+ENGINE_CONCURRENCY = int(os.getenv("SERPAPI_ENGINE_CONCURRENCY", "3"))  # per SerpAPI engine
+SEARCH_DEADLINE = float(os.getenv("SEARCH_DEADLINE_SECONDS", "600"))
+# Token buckets: (requests/sec, burst). Override with e.g. SERPAPI_RATE_PER_SEC,
+# SERPAPI_BURST, SERPAPI_GOOGLE_RATE_PER_SEC, TAVILY_BURST.
+DEFAULT_RATE_LIMITS = {"serpapi": (2.0, 5), "serpapi:engine": (1.0, 3), "tavily": (1.0, 3)}
+SEARCH_MAX_RETRIES = int(os.getenv("SEARCH_MAX_RETRIES", "3"))
+SEARCH_BACKOFF_BASE = float(os.getenv("SEARCH_BACKOFF_BASE", "1.0"))
+SEARCH_BACKOFF_MAX = float(os.getenv("SEARCH_BACKOFF_MAX", "60"))
+SEARCH_CACHE_BACKEND = os.getenv("SEARCH_CACHE_BACKEND", "sqlite")  # "sqlite", "firestore" or "none"
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL_SECONDS", str(6 * 3600)))
+SEARCH_CACHE_PATH = os.getenv("SEARCH_CACHE_PATH", "/tmp/gf_search_cache.sqlite3")
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "5000"))
+QUERY_PLAN_TTL = float(os.getenv("QUERY_PLAN_TTL_SECONDS", str(35 * 86400)))  # prompt only changes monthly
+# Query plans and yield history must outlive the instance: on Cloud Functions (K_SERVICE) /tmp is gone after a cold start
+QUERY_PLAN_CACHE_BACKEND = os.getenv("QUERY_PLAN_CACHE_BACKEND", "firestore" if os.getenv("K_SERVICE") else SEARCH_CACHE_BACKEND)
+QUERY_DEDUP_THRESHOLD = float(os.getenv("QUERY_DEDUP_THRESHOLD", "0.8"))
+DEDUP_JACCARD_THRESHOLD = float(os.getenv("DEDUP_JACCARD_THRESHOLD", "0.8"))
+SEARCH_CALL_BUDGET = int(os.getenv("SEARCH_CALL_BUDGET", "150"))  # provider calls per run; 0 = unlimited
+FIRESTORE_WRITE_MODE = os.getenv("FIRESTORE_WRITE_MODE", "sync")  # "sync" (diff), "replace", "snapshot" (versioned runs) or "none" (dry run)
+SNAPSHOT_KEEP = int(os.getenv("SNAPSHOT_KEEP", "3"))  # published runs kept for rollback, the current one included
+EXPORT_DIR = os.getenv("EXPORT_DIR", "")  # also stream each run's deals to JSON Lines files here
+EXPORT_COMPRESSION = os.getenv("EXPORT_COMPRESSION", "gzip")  # "gzip" or "zstd" (needs the zstandard package)
+EXPORT_ROWS_PER_FILE = int(os.getenv("EXPORT_ROWS_PER_FILE", "50000"))
+DEAL_VIEWS = os.getenv("DEAL_VIEWS", "1") != "0"  # also write the gf_deal_views read-side docs
+DEAL_VIEW_TOP_N = int(os.getenv("DEAL_VIEW_TOP_N", "20"))  # deals per store/brand view doc
+# Bulk writer flow control: start rate, then +50% every 5 min up to the max (Firestore's 500/50/5 rule).
+# Deal doc IDs are hashes, so writes spread evenly; throttling errors are retried per doc.
+FIRESTORE_INITIAL_OPS_PER_SECOND = int(os.getenv("FIRESTORE_INITIAL_OPS_PER_SECOND", "2000"))
+FIRESTORE_MAX_OPS_PER_SECOND = int(os.getenv("FIRESTORE_MAX_OPS_PER_SECOND", "10000"))
+FIRESTORE_WRITE_RETRIES = int(os.getenv("FIRESTORE_WRITE_RETRIES", "5"))  # retries per doc before it counts as failed
+FIRESTORE_BACKOFF_BASE = float(os.getenv("FIRESTORE_BACKOFF_BASE", "0.5"))  # before each one-by-one re-send round
+FIRESTORE_BACKOFF_MAX = float(os.getenv("FIRESTORE_BACKOFF_MAX", "10"))
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))  # > 1 fans the search out to parallel workers
+SHARD_MODE = os.getenv("SHARD_MODE", "local")  # "local" (process pool) or "pubsub" (SHARD_TOPIC workers)
+SHARD_TOPIC = os.getenv("SHARD_TOPIC", "gf-deals-shards")
+SHARD_SPLIT_RATE_LIMITS = os.getenv("SHARD_SPLIT_RATE_LIMITS", "1") != "0"  # each worker gets 1/N of the provider rates
+SEEN_INDEX = os.getenv("SEEN_INDEX", "local")  # cross-run result index: "local" (SEEN_INDEX_PATH), "firestore" or "none"
+SEEN_INDEX_PATH = os.getenv("SEEN_INDEX_PATH", "/tmp/gf_seen_index.json.z")
+SEEN_INDEX_TTL = float(os.getenv("SEEN_INDEX_TTL_SECONDS", str(14 * 86400)))  # since a result was last seen
+SEEN_INDEX_MAX_ENTRIES = int(os.getenv("SEEN_INDEX_MAX_ENTRIES", "50000"))
+STAGE_EXECUTOR = os.getenv("STAGE_EXECUTOR", "inline")  # per-deal stages: "inline" (main thread) or "process" (process pool)
+STAGE_WORKERS = int(os.getenv("STAGE_WORKERS", "0"))  # process-pool size; 0 = os.cpu_count()
+STAGE_CHUNK_SIZE = int(os.getenv("STAGE_CHUNK_SIZE", "256"))  # deals per pool task
+SEARCH_RECORD_DIR = os.getenv("SEARCH_RECORD_DIR", "")  # save raw provider JSON here for offline replay (bench.py)
+
+# ---------------- Shared clients ----------------
+# requests, openai, google-cloud-firestore, pubsub and the asyncio stack are imported
+# on first use, and each client is built once per instance and reused by later warm
+# invocations. A cold start that only validates keys, enqueues a job or reads job
+# status never loads what it does not touch (bench.py importtime tracks this).
+_clients: Dict[str, object] = {}
+_clients_lock = threading.Lock()
+
+def shared_client(name: str, factory: Callable[[], object]):
+    with _clients_lock:
+        if name not in _clients: _clients[name] = factory()
+        return _clients[name]
+
+def get_firestore_client() -> "firestore.Client":
+    def build():
+        from google.cloud import firestore
+        return firestore.Client()
+    return shared_client("firestore", build)
+
+def get_openai_client() -> "openai.OpenAI":
+    def build():
+        import openai
+        return openai.OpenAI(api_key=OPENAI_API_KEY, base_url=os.getenv("OPENAI_BASE_URL") or None)
+    return shared_client("openai", build)
+
+def get_http_session() -> "requests.Session":
+    """Shared pooled session for all provider calls (sized for the search fan-out)."""
+    def build():
+        import requests
+        pool = sum(SEARCH_CONCURRENCY.values())
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool)
+        session = requests.Session()
+        session.mount("https://", adapter); session.mount("http://", adapter)
+        return session
+    return shared_client("http", build)
+
+def get_pubsub_publisher():
+    def build():
+        from google.cloud import pubsub_v1
+        return pubsub_v1.PublisherClient()
+    return shared_client("pubsub", build)
 
-openai.api_key = OPENAI_API_KEY
+def gcp_project() -> str:
+    return os.getenv("GOOGLE_CLOUD_PROJECT") or os.getenv("GCP_PROJECT") or get_firestore_client().project
 
 # --- Constants ---
 DEAL_INDICATORS = [
@@ -37,13 +143,6 @@ DEAL_INDICATORS = [
     "flash sale", "daily deal", "weekly special", "markdown", "reduced price"
 ]
 
-CURRENT_DEAL_KEYWORDS = [
-    f"{datetime.now().strftime('%B %Y').lower()}",
-    f"{datetime.now().year}",
-    "today", "this week", "current", "now", "active", "valid", "expires",
-    "new deals", "latest", "recent", "fresh", "updated", "live", "available"
-]
-
 GF_KEYWORDS = [
     "gluten free", "gluten-free", "gluten free", "celiac", "wheat free",
     "gf", "no gluten", "gluten conscious", "gluten sensitive", "gf certified"
@@ -105,45 +204,610 @@ DOMAIN_TO_BRAND = {
     'farwestfungi':'Far West Fungi','mariani':'Mariani','kinetikasports':'Kinetica Sports','naturebox':'NatureBox'
 }
 
-# ---------------- Firestore replace-all writer ----------------
-def replace_deals_firestore(deals: List[Dict], run_ts: datetime, batch_size: int = 300) -> Dict[str, int]:
+# ---------------- Metrics ----------------
+# Spans, counters and histograms for one process. Spans and the run summary go
+# to stdout as JSON lines (Cloud Logging reads severity/message); the same data
+# can be dumped as Prometheus text and is returned per stage by the HTTP handler.
+METRICS_LOG = os.getenv("METRICS_LOG", "json")  # "json" or "off"
+METRICS_PROM_PATH = os.getenv("METRICS_PROM_PATH", "")  # write Prometheus text here after each run
+SPAN_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+def log_event(message: str, severity: str = "INFO", **fields) -> None:
+    """One structured log line on stdout."""
+    if METRICS_LOG != "json": return
+    print(json.dumps({"severity": severity, "message": message, **fields}, default=str), flush=True)
+
+LabelKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+def _prom_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Metrics:
+    """Thread-safe counters, cumulative-bucket histograms and per-span timing totals."""
+
+    def __init__(self, buckets: Tuple[float, ...] = SPAN_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters: Dict[LabelKey, float] = {}
+            self._hists: Dict[LabelKey, List[float]] = {}  # per-bucket counts..., sum, count
+            self._spans: Dict[str, List[float]] = {}  # name -> [count, total seconds, max seconds]
+
+    @staticmethod
+    def _key(name: str, labels: Dict) -> LabelKey:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1.0, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            h = self._hists.get(key)
+            if h is None: h = self._hists[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound: h[i] += 1
+            h[-2] += value; h[-1] += 1
+
+    def record_span(self, name: str, seconds: float, count: int = 1, max_seconds: Optional[float] = None) -> None:
+        """Add time that was measured elsewhere (e.g. a pipeline stage summed over items)."""
+        with self._lock:
+            s = self._spans.setdefault(name, [0, 0.0, 0.0])
+            s[0] += count; s[1] += seconds
+            s[2] = max(s[2], max_seconds if max_seconds is not None else seconds / max(count, 1))
+
+    @contextmanager
+    def span(self, name: str, **labels):
+        """Time a block: feeds the per-span breakdown, the span_seconds histogram and one log line."""
+        start, error = time.perf_counter(), None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            secs = time.perf_counter() - start
+            self.record_span(name, secs)
+            self.observe("span_seconds", secs, span=name, **labels)
+            if error: self.inc("span_errors_total", span=name, error=error, **labels)
+            log_event("span", span=name, seconds=round(secs, 4), **labels, **({"error": error} if error else {}))
+
+    def breakdown(self) -> Dict[str, Dict[str, float]]:
+        """{span: {count, total_ms, max_ms}}; concurrent spans (provider calls) sum their wall time."""
+        with self._lock:
+            return {name: {"count": int(c), "total_ms": round(t * 1000, 1), "max_ms": round(m * 1000, 1)}
+                    for name, (c, t, m) in sorted(self._spans.items())}
+
+    def prometheus_text(self, prefix: str = "gf_") -> str:
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            return "{" + ",".join(f'{k}="{_prom_label(v)}"' for k, v in pairs) + "}" if pairs else ""
+        with self._lock:
+            counters, hists = dict(self._counters), {k: list(v) for k, v in self._hists.items()}
+        lines = []
+        for name in sorted({n for n, _ in counters}):
+            lines.append(f"# TYPE {prefix}{name} counter")
+            lines += [f"{prefix}{name}{fmt(labels)} {value:g}" for (n, labels), value in sorted(counters.items()) if n == name]
+        for name in sorted({n for n, _ in hists}):
+            lines.append(f"# TYPE {prefix}{name} histogram")
+            for (n, labels), h in sorted(hists.items()):
+                if n != name: continue
+                for bound, count in zip(self.buckets, h):
+                    lines.append(f"{prefix}{name}_bucket{fmt(labels, [('le', f'{bound:g}')])} {count}")
+                lines.append(f"{prefix}{name}_bucket{fmt(labels, [('le', '+Inf')])} {h[-1]}")
+                lines.append(f"{prefix}{name}_sum{fmt(labels)} {h[-2]:.6f}")
+                lines.append(f"{prefix}{name}_count{fmt(labels)} {h[-1]}")
+        return "\n".join(lines) + "\n"
+
+    def dump_prometheus(self, path: str) -> None:
+        try:
+            with open(path, "w") as f: f.write(self.prometheus_text())
+        except OSError as e:
+            print(f"⚠️ Could not write metrics to {path}: {e}")
+
+METRICS = Metrics()
+
+# ---------------- Firestore writers ----------------
+VOLATILE_DEAL_FIELDS = {"timestamp", "runAt", "updatedAt", "contentHash"}
+
+def deal_doc_id(deal: Dict) -> str:
+    key = f"{canonicalize_url(deal.get('link',''))}|{deal.get('discount_amount','')}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def deal_content_hash(deal: Dict) -> str:
+    """Stable hash of a deal's content, ignoring per-run fields like timestamp."""
+    stable = {k: v for k, v in deal.items() if k not in VOLATILE_DEAL_FIELDS}
+    return hashlib.sha1(json.dumps(stable, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+EXPIRY_GRACE = timedelta(hours=12)  # past UTC midnight, so US time zones keep the whole last day
+
+def deal_doc(deal: Dict, run_ts: datetime, chash: Optional[str] = None) -> Dict:
+    """Stored form of a deal: the record, write bookkeeping and expiresAt (the TTL policy field)."""
+    from google.cloud import firestore
+    doc = {**deal, "contentHash": chash or deal_content_hash(deal), "runAt": run_ts, "updatedAt": firestore.SERVER_TIMESTAMP}
+    if deal.get("expires_on"): doc["expiresAt"] = datetime.fromisoformat(deal["expires_on"]) + timedelta(days=1) + EXPIRY_GRACE
+    return doc
+
+RETRYABLE_WRITE_CODES = frozenset([4, 8, 10, 13, 14])  # gRPC DEADLINE_EXCEEDED, RESOURCE_EXHAUSTED, ABORTED, INTERNAL, UNAVAILABLE
+
+class DealDocWriter:
     """
-    Delete all docs in 'gf_deals', then insert the new list of deals.
-    Uses batched deletes + batched writes.
+    Streaming writer for one collection on Firestore's BulkWriter: ops are
+    committed in parallel batches under its rate ramp-up (FIRESTORE_*_OPS_PER_SECOND),
+    and each failed doc is retried on its own
+    while the error is retryable, up to FIRESTORE_WRITE_RETRIES attempts. Docs
+    whose whole batch RPC failed get no callback from BulkWriter, so flush()
+    re-sends them one by one. BulkWriter.flush() shuts its executor down, so
+    each flush retires the current BulkWriter and later ops open a new one. Outcomes are counted per doc; docs that never
+    landed are listed in `failures` (doc ID → last error).
     """
-    db = firestore.Client()
-    coll = db.collection("gf_deals")
 
-    # Delete existing docs in batches
-    deleted = 0
-    while True:
-        docs = list(coll.limit(batch_size).stream())
-        if not docs:
-            break
-        for d in docs:
-            d.reference.delete()
-        deleted += len(docs)
-    print(f"🧹 Deleted {deleted} existing docs from gf_deals")
-
-    # Write new deals
-    count = 0
-    batch = db.batch()
+    def __init__(self, db, collection: str):
+        self.coll = db.collection(collection)
+        self.stats = {"written": 0, "deleted": 0, "retried": 0, "failed": 0}
+        self.failures: Dict[str, str] = {}
+        self._pending: Dict[str, Tuple[str, Optional[Dict]]] = {}  # doc ID → (outcome, data) until confirmed
+        self._lock = threading.Lock()
+        self._db = db
+        self._bw = None
+
+    def _writer(self):
+        if self._bw is None:
+            from google.cloud.firestore_v1.bulk_writer import BulkWriterOptions
+            self._bw = self._db.bulk_writer(BulkWriterOptions(initial_ops_per_second=min(FIRESTORE_INITIAL_OPS_PER_SECOND, FIRESTORE_MAX_OPS_PER_SECOND),
+                                                              max_ops_per_second=FIRESTORE_MAX_OPS_PER_SECOND))
+            self._bw.on_write_result(self._on_result)
+            self._bw.on_write_error(self._on_error)
+        return self._bw
+
+    def set(self, doc_id: str, data: Dict) -> None:
+        with self._lock: self._pending[doc_id] = ("written", data)
+        self._writer().set(self.coll.document(doc_id), data)
+
+    def delete(self, doc_id: str) -> None:
+        with self._lock: self._pending[doc_id] = ("deleted", None)
+        self._writer().delete(self.coll.document(doc_id))
+
+    def _on_result(self, ref, result, bulk_writer) -> None:
+        with self._lock:
+            outcome, _ = self._pending.pop(ref.id, ("written", None))
+            self.stats[outcome] += 1
+
+    def _on_error(self, failure, bulk_writer) -> bool:
+        doc_id = failure.operation.reference.id
+        retry = failure.code in RETRYABLE_WRITE_CODES and failure.attempts < FIRESTORE_WRITE_RETRIES
+        with self._lock:
+            if retry:
+                self.stats["retried"] += 1
+            elif self._pending.pop(doc_id, None) is not None:
+                self.stats["failed"] += 1
+                self.failures[doc_id] = f"code {failure.code}: {failure.message}"
+        return retry
+
+    def flush(self) -> None:
+        """Block until every op so far has landed or failed for good."""
+        if self._bw is not None:
+            self._bw.close(); self._bw = None  # a flushed BulkWriter drops any later ops
+        errors: Dict[str, str] = {}
+        for attempt in range(FIRESTORE_WRITE_RETRIES):
+            with self._lock: unconfirmed = dict(self._pending)
+            if not unconfirmed: return
+            time.sleep(backoff_delay(attempt, FIRESTORE_BACKOFF_BASE, FIRESTORE_BACKOFF_MAX))
+            for doc_id, (outcome, data) in unconfirmed.items():
+                ref = self.coll.document(doc_id)
+                try:
+                    ref.set(data) if outcome == "written" else ref.delete()
+                except Exception as e:
+                    errors[doc_id] = str(e)
+                    with self._lock: self.stats["retried"] += 1
+                    continue
+                with self._lock:
+                    self._pending.pop(doc_id, None); self.stats[outcome] += 1
+        with self._lock:
+            for doc_id in self._pending:
+                self.stats["failed"] += 1
+                self.failures[doc_id] = errors.get(doc_id, "no response")
+            self._pending.clear()
+
+    def close(self) -> Dict[str, int]:
+        self.flush()
+        return self.stats
+
+def existing_deal_hashes(coll) -> Dict[str, Optional[str]]:
+    """Doc ID → contentHash for every stored deal, in one projection query."""
+    return {snap.id: (snap.to_dict() or {}).get("contentHash") for snap in coll.select(["contentHash"]).stream()}
+
+def finish_deal_writes(writer: DealDocWriter, stale_ids: Iterable[str], stats: Dict) -> Dict:
+    """
+    Wait for the writes, then delete stale docs, but only if every write landed:
+    a partially failed run keeps the previous docs instead of thinning the app.
+    """
+    writer.flush()
+    if writer.failures:
+        print(f"⚠️ {len(writer.failures)} deal writes failed — keeping stale docs this run")
+    else:
+        for doc_id in stale_ids: writer.delete(doc_id)
+    writer.close()
+    stats.update({k: writer.stats[k] for k in ("deleted", "retried", "failed")})
+    if writer.failures: stats["failed_docs"] = dict(list(writer.failures.items())[:20])
+    return stats
+
+def sync_deals_firestore(deals: Iterable[Dict], run_ts: datetime) -> Dict[str, int]:
+    """
+    Diff the new deals against 'gf_deals' and apply only the changes.
+    New or changed deals stream into the bulk writer as they arrive; stale docs
+    are deleted once those writes have landed. Unchanged docs are left alone,
+    so the collection is never empty mid-run.
+    """
+    writer = DealDocWriter(get_firestore_client(), "gf_deals")
+    existing = existing_deal_hashes(writer.coll)
+    seen: Dict[str, str] = {}
+
+    stats = {"inserted": 0, "updated": 0, "unchanged": 0, "deleted": 0}
+    for deal in deals:
+        doc_id = deal_doc_id(deal)
+        chash = deal_content_hash(deal)
+        first = doc_id not in seen
+        current = seen[doc_id] if not first else existing.get(doc_id)
+        seen[doc_id] = chash  # last one wins, same as the replace writer
+        if current == chash:
+            if first: stats["unchanged"] += 1
+            continue
+        stats["inserted" if first and doc_id not in existing else "updated"] += 1
+        writer.set(doc_id, deal_doc(deal, run_ts, chash))
+
+    finish_deal_writes(writer, existing.keys() - seen.keys(), stats)
+    print(f"🔄 Firestore sync: {stats}")
+    return stats
+
+def write_deals_firestore(deals: Iterable[Dict], run_ts: datetime) -> Dict[str, int]:
+    exporter = DealExporter(EXPORT_DIR, run_ts) if EXPORT_DIR else None
+    if exporter: deals = exporter.track(deals)
+    views = DealViews() if DEAL_VIEWS and FIRESTORE_WRITE_MODE != "none" else None
+    if views: deals = views.track(deals)
+    if FIRESTORE_WRITE_MODE == "none":
+        stats = {"skipped": sum(1 for _ in deals)}
+        print(f"🚫 Firestore write skipped (dry run): {stats}")
+    elif FIRESTORE_WRITE_MODE == "snapshot":
+        stats = publish_deals_snapshot(deals, run_ts, views)
+    else:
+        stats = replace_deals_firestore(deals, run_ts) if FIRESTORE_WRITE_MODE == "replace" else sync_deals_firestore(deals, run_ts)
+        if views: stats["views"] = write_deal_views(views, DEAL_VIEWS_COLLECTION, run_ts)
+    if exporter: stats["export"] = exporter.close()
+    return stats
+
+def replace_deals_firestore(deals: Iterable[Dict], run_ts: datetime) -> Dict[str, int]:
+    """
+    Rewrite every deal in 'gf_deals' (no diff), then delete the docs this run
+    did not produce. New docs land before anything is removed, so a failed
+    write never leaves the collection empty.
+    """
+    writer = DealDocWriter(get_firestore_client(), "gf_deals")
+    existing = existing_deal_hashes(writer.coll)
+    written = set()
+    for deal in deals:
+        doc_id = deal_doc_id(deal); written.add(doc_id)
+        writer.set(doc_id, deal_doc(deal, run_ts))
+
+    stats = finish_deal_writes(writer, existing.keys() - written, {"inserted": len(written)})
+    print(f"✅ Replaced gf_deals: {stats}")
+    return stats
+
+# ---------------- Read-side views ----------------
+# Materialized docs so each app screen is one document read instead of a query:
+#   top           → the MAX_DEALS_TO_DISPLAY best deals
+#   counts        → totals by category, store and brand (with each view doc ID)
+#   store-<slug>  → one store's DEAL_VIEW_TOP_N best deals, plus its coupon deals
+#   brand-<slug>  → the same per brand
+# Deals inside a view are compact copies; `id` is the deal's doc ID in gf_deals.
+DEAL_VIEWS_COLLECTION = "gf_deal_views"
+VIEW_DEAL_FIELDS = ("title", "link", "store", "brand", "category", "deal_type", "discount_amount",
+                    "coupon_code", "expiration", "expires_on", "ai_quality_score")
+VIEW_SNIPPET_CHARS = 200
+
+def view_slug(name: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "-", name.lower()).strip("-") or "unknown"
+
+class DealViews:
+    """Collects compact deals as they stream to the writer, then builds the view docs."""
+
+    def __init__(self, top_n: int = DEAL_VIEW_TOP_N):
+        self.top_n = top_n
+        self.deals: Dict[str, Dict] = {}  # doc ID → compact deal; last one wins, like the writers
+
+    def track(self, deals: Iterable[Dict]) -> Iterator[Dict]:
+        for deal in deals:
+            doc_id = deal_doc_id(deal)
+            self.deals[doc_id] = {"id": doc_id, **{k: deal.get(k) for k in VIEW_DEAL_FIELDS},
+                                  "snippet": (deal.get("snippet") or "")[:VIEW_SNIPPET_CHARS]}
+            yield deal
+
+    def _group_doc(self, kind: str, name: str, deals: List[Dict]) -> Dict:
+        return {kind: name, "count": len(deals), "deals": deals[:self.top_n],
+                "coupons": [d for d in deals if d.get("coupon_code") not in (None, "N/A")][:self.top_n]}
+
+    def docs(self) -> Dict[str, Dict]:
+        ranked = sorted(self.deals.values(), key=lambda d: (-(d.get("ai_quality_score") or 0), d["id"]))
+        groups: Dict[str, Dict[str, List[Dict]]] = {"store": {}, "brand": {}, "category": {}}
+        for deal in ranked:
+            for kind, members in groups.items():
+                members.setdefault(deal.get(kind) or "Unknown", []).append(deal)
+        docs = {"top": {"count": len(ranked), "deals": ranked[:MAX_DEALS_TO_DISPLAY]}}
+        counts: Dict[str, List[Dict]] = {"categories": [{"name": name, "count": len(ds)} for name, ds in groups["category"].items()]}
+        for kind, sentinel in (("store", "Unknown"), ("brand", "Multiple/Various")):
+            entries = []
+            for name, ds in groups[kind].items():
+                entry = {"name": name, "count": len(ds)}
+                if name != sentinel:
+                    entry["view"] = f"{kind}-{view_slug(name)}"
+                    docs[entry["view"]] = self._group_doc(kind, name, ds)
+                entries.append(entry)
+            counts[kind + "s"] = entries
+        for entries in counts.values(): entries.sort(key=lambda e: (-e["count"], e["name"]))
+        docs["counts"] = {"total": len(ranked), **counts}
+        return docs
+
+def write_deal_views(views: DealViews, collection: str, run_ts: datetime) -> Dict[str, int]:
+    """Write the view docs that changed (by content hash) and delete views no deal maps to anymore."""
+    writer = DealDocWriter(get_firestore_client(), collection)
+    existing = existing_deal_hashes(writer.coll)
+    docs = views.docs()
+    stats = {"views": len(docs), "changed": 0}
+    for view_id, doc in docs.items():
+        chash = deal_content_hash(doc)
+        if existing.get(view_id) == chash: continue
+        stats["changed"] += 1
+        writer.set(view_id, {**doc, "contentHash": chash, "runAt": run_ts})
+    finish_deal_writes(writer, existing.keys() - docs.keys(), stats)
+    print(f"🗂️  Deal views: {stats}")
+    return stats
+
+# ---------------- Local export ----------------
+# With EXPORT_DIR set, each run's deals also stream, as the writer consumes them,
+# to deals-<runAt>-<part>.jsonl.gz (or .jsonl.zst) files: one compact JSON
+# object per line with runAt added, rotated every EXPORT_ROWS_PER_FILE rows.
+# Files appear under their final name only once complete. iter_exported_deals
+# reads them back one line at a time, so run history of any size scans in
+# constant memory.
+EXPORT_EXTENSIONS = {"gzip": ".jsonl.gz", "zstd": ".jsonl.zst"}
+
+def open_export_file(path: str, mode: str = "r"):
+    """Text-mode handle on a .jsonl.gz / .jsonl.zst / .jsonl file; mode "r" or "w"."""
+    if path.endswith(".zst") or path.endswith(".zst.part"):
+        import io, zstandard
+        raw = open(path, mode + "b")
+        stream = zstandard.ZstdCompressor().stream_writer(raw) if mode == "w" else zstandard.ZstdDecompressor().stream_reader(raw)
+        return io.TextIOWrapper(stream, encoding="utf-8")
+    if path.endswith(".gz") or path.endswith(".gz.part"):
+        import gzip
+        return gzip.open(path, mode + "t", encoding="utf-8", compresslevel=6)
+    return open(path, mode, encoding="utf-8")
+
+class DealExporter:
+    """Streams one run's deals to rotating compressed JSON Lines files."""
+
+    def __init__(self, directory: str, run_ts: datetime, compression: str = EXPORT_COMPRESSION,
+                 rows_per_file: int = EXPORT_ROWS_PER_FILE):
+        if compression == "zstd":
+            try:
+                import zstandard  # noqa: F401
+            except ImportError:
+                print("⚠️ zstandard is not installed — exporting gzip instead"); compression = "gzip"
+        self.ext = EXPORT_EXTENSIONS.get(compression, EXPORT_EXTENSIONS["gzip"])
+        self.prefix = os.path.join(directory, f"deals-{run_ts.strftime('%Y%m%dT%H%M%S')}")
+        self.run_at = run_ts.isoformat() + "Z"
+        self.rows_per_file = max(1, rows_per_file)
+        self.files: List[str] = []
+        self.rows = 0
+        self._fh = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _rotate(self) -> None:
+        self._finish()
+        path = f"{self.prefix}-{len(self.files):04d}{self.ext}"
+        self.files.append(path)
+        self._fh = open_export_file(path + ".part", "w")
+
+    def _finish(self) -> None:
+        if self._fh is None: return
+        self._fh.close(); self._fh = None
+        os.replace(self.files[-1] + ".part", self.files[-1])
+
+    def write(self, deal: Dict) -> None:
+        if self._fh is None or self.rows % self.rows_per_file == 0: self._rotate()
+        self._fh.write(json.dumps({**deal, "runAt": self.run_at}, separators=(",", ":"), default=str) + "\n")
+        self.rows += 1
+
+    def track(self, deals: Iterable[Dict]) -> Iterator[Dict]:
+        for deal in deals:
+            self.write(deal)
+            yield deal
+
+    def close(self) -> Dict:
+        self._finish()
+        stats = {"rows": self.rows, "files": len(self.files), "bytes": sum(os.path.getsize(f) for f in self.files)}
+        print(f"💾 Exported deals to {self.prefix}-*{self.ext}: {stats}")
+        return stats
+
+def export_files(source: str) -> List[str]:
+    """Export files in a directory (oldest run first) or matching a glob."""
+    import glob
+    pattern = os.path.join(source, "deals-*.jsonl*") if os.path.isdir(source) else source
+    return sorted(p for p in glob.glob(pattern) if not p.endswith(".part"))
+
+def iter_exported_deals(source: str, store: Optional[str] = None, brand: Optional[str] = None,
+                        deal_type: Optional[str] = None) -> Iterator[Dict]:
+    """
+    Stream exported deals, one line in memory at a time, keeping exact
+    store/brand/deal_type matches. Lines that cannot match are skipped on a
+    substring test before any JSON parsing.
+    """
+    wanted = {k: v for k, v in (("store", store), ("brand", brand), ("deal_type", deal_type)) if v is not None}
+    needles = [f'"{k}":{json.dumps(v)}' for k, v in wanted.items()]
+    for path in export_files(source):
+        with open_export_file(path) as f:
+            for line in f:
+                if any(n not in line for n in needles): continue
+                deal = json.loads(line)
+                if all(deal.get(k) == v for k, v in wanted.items()): yield deal
+
+# ---------------- Snapshot publishing ----------------
+# FIRESTORE_WRITE_MODE=snapshot: each run writes its own gf_deal_runs/{runId}/deals
+# (and /views) collections, then one transaction points gf_meta/current_deals at it.
+# Readers get the pointer and read pointer["collection"] / pointer["views"], so they
+# always see one whole run.
+# Older runs are deleted in the background; the newest SNAPSHOT_KEEP stay for rollback.
+SNAPSHOT_RUNS = "gf_deal_runs"
+SNAPSHOT_POINTER_PATH = "gf_meta/current_deals"
+SNAPSHOT_ABANDONED_SECONDS = 3600  # unpublished runs older than this are GC'd
+
+def snapshot_deals_path(run_id: str) -> str:
+    return f"{SNAPSHOT_RUNS}/{run_id}/deals"
+
+def snapshot_views_path(run_id: str) -> str:
+    return f"{SNAPSHOT_RUNS}/{run_id}/views"
+
+def _snapshot_pointer(run_id: str, run: Dict) -> Dict:
+    from google.cloud import firestore
+    return {"runId": run_id, "runAt": run.get("runAt"), "count": run.get("count", 0), "collection": snapshot_deals_path(run_id),
+            "views": snapshot_views_path(run_id), "previousRunId": run.get("previousRunId"), "publishedAt": firestore.SERVER_TIMESTAMP}
+
+def publish_deals_snapshot(deals: Iterable[Dict], run_ts: datetime, views: Optional[DealViews] = None) -> Dict:
+    """
+    Write this run's deals to a fresh snapshot, then swap the pointer to it.
+    The pointer only moves once every doc has landed; an empty or partially
+    failed run is marked failed and readers stay on the previous snapshot.
+    """
+    db = get_firestore_client()
+    run_id = f"{run_ts.strftime('%Y%m%dT%H%M%S')}-{os.urandom(3).hex()}"
+    run_path = f"{SNAPSHOT_RUNS}/{run_id}"
+    db.document(run_path).set({"runId": run_id, "runAt": run_ts, "status": "writing", "createdAt": time.time()})
+    writer = DealDocWriter(db, snapshot_deals_path(run_id))
+    written = set()
     for deal in deals:
-        key = f"{deal.get('link','')}|{deal.get('discount_amount','')}"
-        doc_id = hashlib.sha1(key.encode('utf-8')).hexdigest()
-        doc = coll.document(doc_id)
-        data = {**deal, "runAt": run_ts, "updatedAt": firestore.SERVER_TIMESTAMP}
-        batch.set(doc, data)
-        count += 1
-        if count % 450 == 0:
-            batch.commit()
-            batch = db.batch()
-    batch.commit()
-    print(f"✅ Inserted {count} new docs into gf_deals")
-    return {"deleted": deleted, "inserted": count}
-
-# ---------------- Query gen, search, AI filters (unchanged) ----------------
-def generate_comprehensive_queries() -> Dict[str, List[str]]:
+        doc_id = deal_doc_id(deal); written.add(doc_id)
+        writer.set(doc_id, deal_doc(deal, run_ts))
+    writer.close()
+
+    stats = {"runId": run_id, "inserted": len(written), "retried": writer.stats["retried"], "failed": writer.stats["failed"]}
+    if views and written and not writer.failures:
+        stats["views"] = write_deal_views(views, snapshot_views_path(run_id), run_ts)
+        stats["failed"] += stats["views"]["failed"]
+    if stats["failed"] or not written:
+        if writer.failures: stats["failed_docs"] = dict(list(writer.failures.items())[:20])
+        db.document(run_path).set({"status": "failed", "count": len(written)}, merge=True)
+        print(f"⚠️ Snapshot {run_id} not published — readers stay on the current run: {stats}")
+        return {**stats, "published": False}
+
+    def swap(t):
+        previous = (t.get(SNAPSHOT_POINTER_PATH) or {}).get("runId")
+        run = {"runAt": run_ts, "count": len(written), "previousRunId": previous}
+        t.set(run_path, {**run, "status": "published"}, merge=True)
+        t.set(SNAPSHOT_POINTER_PATH, _snapshot_pointer(run_id, run))
+        return previous
+    stats["previousRunId"] = firestore_transact(swap)
+    run_in_background("snapshot_gc", gc_deal_snapshots)
+    print(f"📸 Published snapshot {run_id}: {stats}")
+    return {**stats, "published": True}
+
+def rollback_deals_snapshot(run_id: Optional[str] = None) -> Dict:
+    """
+    Point readers back at `run_id` (default: the run the current one replaced).
+    Only the pointer moves; the run rolled back from is marked so GC drops it.
+    """
+    def swap(t):
+        current = t.get(SNAPSHOT_POINTER_PATH) or {}
+        target = run_id or current.get("previousRunId")
+        if not target: raise ValueError("no previous snapshot to roll back to")
+        run = t.get(f"{SNAPSHOT_RUNS}/{target}") or {}
+        if run.get("status") != "published": raise ValueError(f"snapshot {target} is not available ({run.get('status', 'missing')})")
+        t.set(SNAPSHOT_POINTER_PATH, _snapshot_pointer(target, run))
+        if current.get("runId") and current["runId"] != target:
+            t.set(f"{SNAPSHOT_RUNS}/{current['runId']}", {"status": "rolled_back"}, merge=True)
+        return {"runId": target, "rolledBackFrom": current.get("runId")}
+    result = firestore_transact(swap)
+    print(f"⏪ Rolled back deals snapshot: {result}")
+    return result
+
+def gc_deal_snapshots(keep: int = SNAPSHOT_KEEP) -> Dict[str, int]:
+    """Delete runs beyond the newest `keep` published ones; never the current run or one still being written."""
+    db = get_firestore_client()
+    current = (db.document(SNAPSHOT_POINTER_PATH).get().to_dict() or {}).get("runId")
+    runs = sorted(((snap.id, snap.to_dict() or {}) for snap in db.collection(SNAPSHOT_RUNS).stream()), key=lambda r: r[0], reverse=True)
+    kept = {run_id for run_id, run in runs if run.get("status") == "published"}
+    kept = set(sorted(kept, reverse=True)[:max(keep, 1)]) | {current}
+    stats = {"runs_deleted": 0, "docs_deleted": 0, "failed": 0}
+    for run_id, run in runs:
+        if run_id in kept: continue
+        if run.get("status") == "writing" and time.time() - run.get("createdAt", 0) < SNAPSHOT_ABANDONED_SECONDS: continue
+        failed = 0
+        for path in (snapshot_deals_path(run_id), snapshot_views_path(run_id)):
+            writer = DealDocWriter(db, path)
+            for snap in writer.coll.select([]).stream(): writer.delete(snap.id)
+            writer.close()
+            stats["docs_deleted"] += writer.stats["deleted"]; failed += writer.stats["failed"]
+        stats["failed"] += failed
+        if not failed:
+            db.document(f"{SNAPSHOT_RUNS}/{run_id}").delete(); stats["runs_deleted"] += 1
+    print(f"🧹 Snapshot GC: {stats}")
+    return stats
+
+_background: List[threading.Thread] = []
+
+def run_in_background(name: str, fn: Callable, *args) -> None:
+    """Run fn on a daemon thread; main() joins these before it returns so Cloud Functions doesn't freeze them."""
+    def run():
+        try: fn(*args)
+        except Exception as e: log_event("background_failed", severity="WARNING", task=name, error=str(e))
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start(); _background.append(thread)
+
+def join_background(timeout: float = 120.0) -> None:
+    deadline = time.monotonic() + timeout
+    while _background: _background.pop().join(max(0.0, deadline - time.monotonic()))
+
+# ---------------- Expiry sweeper ----------------
+# Deals whose expiration phrase parses to a date are stored with expiresAt. A
+# Firestore TTL policy on it deletes them eventually (usually within a day):
+#   gcloud firestore fields ttls update expiresAt --collection-group=gf_deals --enable-ttl
+#   (and --collection-group=deals for FIRESTORE_WRITE_MODE=snapshot)
+# sweep_expired_deals does it promptly between scrapes: one range query on the
+# live collection, deletes, and a view rebuild only when something expired.
+def sweep_expired_deals(now: Optional[datetime] = None) -> Dict[str, int]:
+    from google.cloud.firestore_v1.base_query import FieldFilter
+    now = now or datetime.utcnow()
+    db = get_firestore_client()
+    collection, views_path, run_id = "gf_deals", DEAL_VIEWS_COLLECTION, None
+    if FIRESTORE_WRITE_MODE == "snapshot":
+        pointer = db.document(SNAPSHOT_POINTER_PATH).get().to_dict() or {}
+        if not pointer.get("runId"): return {"expired": 0}
+        collection, views_path, run_id = pointer["collection"], pointer.get("views"), pointer["runId"]
+    writer = DealDocWriter(db, collection)
+    for snap in writer.coll.where(filter=FieldFilter("expiresAt", "<", now)).select([]).stream():
+        writer.delete(snap.id)
+    writer.close()
+    stats = {"expired": writer.stats["deleted"], "failed": writer.stats["failed"]}
+    if stats["expired"] and run_id:
+        def recount(t):
+            pointer = t.get(SNAPSHOT_POINTER_PATH) or {}
+            if pointer.get("runId") == run_id:
+                t.set(SNAPSHOT_POINTER_PATH, {"count": max(0, pointer.get("count", 0) - stats["expired"])}, merge=True)
+        firestore_transact(recount)
+    if stats["expired"] and DEAL_VIEWS and views_path:
+        views = DealViews()
+        for _ in views.track(snap.to_dict() or {} for snap in writer.coll.stream()): pass
+        stats["views"] = write_deal_views(views, views_path, now)
+    print(f"⌛ Expiry sweep of {collection}: {stats}")
+    return stats
+
+# ---------------- Query gen, search, AI filters ----------------
+def generate_llm_queries() -> List[str]:
+    """Ask the LLM for candidate queries; raises on failure so callers can fall back."""
     print("🤖 Generating comprehensive queries for all stores & brands using OpenAI LLM...")
     current_month_year = datetime.now().strftime('%B %Y')
     current_year = str(datetime.now().year)
@@ -179,8 +843,8 @@ Examples of GOOD queries:
 
 Generate 60 diverse queries (one per line, no numbering):
 """
-    try:
-        resp = openai.chat.completions.create(
+    with METRICS.span("llm_call", model="gpt-3.5-turbo"):
+        resp = get_openai_client().chat.completions.create(
             model="gpt-3.5-turbo",
             messages=[
                 {"role":"system","content":"You are a shopping deals expert specializing in gluten-free product promotions and discounts."},
@@ -188,23 +852,45 @@ Generate 60 diverse queries (one per line, no numbering):
             ],
             max_tokens=2000, temperature=0.8, top_p=0.9
         )
-        generated = resp.choices[0].message.content.strip().splitlines()
-        clean = [q.strip("•- ").strip() for q in generated if q and len(q.strip()) > 15 and not re.match(r'^\d+[\.\)]', q.strip())]
-        print(f"✅ Generated {len(clean)} comprehensive queries")
-        mid = len(clean)//2
-        serp = clean[:mid][:50]
-        tav  = clean[mid:][:50]
-        print(f"📊 Query distribution: {len(serp)} SerpAPI + {len(tav)} Tavily")
-        print(f"🎯 Expected coverage: ~{len(all_stores)} stores + ~{len(all_brands)} brands")
-        return {"serpapi": serp, "tavily": tav}
-    except Exception as e:
-        print(f"❌ Comprehensive LLM query generation failed: {e}")
-        return generate_comprehensive_fallback_queries()
+    content = resp.choices[0].message.content
+    record_fixture("openai", "gpt-3.5-turbo", "query-plan", {"content": content})
+    generated = content.strip().splitlines()
+    clean = [q.strip("•- ").strip() for q in generated if q and len(q.strip()) > 15 and not re.match(r'^\d+[\.\)]', q.strip())]
+    print(f"✅ Generated {len(clean)} comprehensive queries")
+    print(f"🎯 Expected coverage: ~{len(all_stores)} stores + ~{len(all_brands)} brands")
+    return clean
+
+def generate_comprehensive_queries(tracker: Optional["QueryYieldTracker"] = None) -> Dict[str, List[str]]:
+    """
+    Query plan for this run. The LLM prompt only depends on the month, so its
+    output is cached per month and reused; the LLM is skipped while a plan is
+    fresh. Near-duplicates are dropped and queries are split between providers
+    by observed yield.
+    """
+    month_key = datetime.now().strftime('%Y-%m')
+    plans = open_query_plan_cache()
+    plan_key = f"llm-{month_key}"
+    cached = plans.get(plan_key)
+    if cached and cached.get("queries"):
+        candidates = cached["queries"]
+        print(f"♻️  Reusing cached {month_key} query plan ({len(candidates)} queries)")
+    else:
+        try:
+            candidates = generate_llm_queries()
+        except Exception as e:
+            print(f"❌ Comprehensive LLM query generation failed: {e}")
+            return generate_comprehensive_fallback_queries(tracker)
+        if candidates: plans.set(plan_key, {"queries": candidates, "generatedAt": datetime.utcnow().isoformat()})
 
-def generate_comprehensive_fallback_queries() -> Dict[str, List[str]]:
+    plan = assign_queries_to_providers(dedupe_queries(candidates), tracker or load_query_yield())
+    print(f"📊 Query distribution: {len(plan['serpapi'])} SerpAPI + {len(plan['tavily'])} Tavily")
+    return plan
+
+def generate_comprehensive_fallback_queries(tracker: Optional["QueryYieldTracker"] = None) -> Dict[str, List[str]]:
     print("🔄 Using comprehensive fallback query generation...")
     current_date = datetime.now().strftime('%B %Y')
     current_year = str(datetime.now().year)
+    rng = random.Random(current_date)  # same fallback plan all month
     top_stores = ['target.com','walmart.com','kroger.com','costco.com','amazon.com','publix.com','safeway.com','thrivemarket.com','vitacost.com']
     deal_types = ['coupons','deals','promo codes','sales','discounts','BOGO offers']
     time_indicators = [current_date, current_year, 'today', 'current', 'active']
@@ -212,372 +898,1933 @@ def generate_comprehensive_fallback_queries() -> Dict[str, List[str]]:
     all_q = []
     for store in top_stores:
         name = DEAL_FOCUSED_STORES.get(store, store.replace('.com','').title())
-        dt = random.choice(deal_types); ti = random.choice(time_indicators)
+        dt = rng.choice(deal_types); ti = rng.choice(time_indicators)
         all_q.append(f"{name} gluten free {dt} {ti}")
         all_q.append(f"gluten free {dt} at {name} {ti}")
 
     for brand in enhanced_brands[:15]:
-        dt = random.choice(deal_types); ti = random.choice(time_indicators)
+        dt = rng.choice(deal_types); ti = rng.choice(time_indicators)
         all_q.append(f"{brand} gluten free {dt} {ti}")
         all_q.append(f"{brand} {dt} gluten free products {ti}")
 
-    random.shuffle(all_q)
-    mid = len(all_q)//2
-    return {"serpapi": all_q[:mid], "tavily": all_q[mid:]}
+    return assign_queries_to_providers(dedupe_queries(all_q), tracker or load_query_yield())
 
-def is_high_quality_deal(item: Dict) -> bool:
-    try:
-        title = str(item.get("title", "") or "")
-        snippet = str(item.get("snippet", "") or "")
-        link = str(item.get("link", "") or "")
-        text = (title + " " + snippet).lower()
-        if not any(kw.lower() in text for kw in GF_KEYWORDS):
-            return False
-        quality_score = 0
-        strong_patterns = [
-            r'\d+%\s*off', r'\$\d+\.?\d*\s*off', r'save\s*\$\d+', r'buy\s+\d+\s+get\s+\d+',
-            r'for\s+\$\d+', r'printable coupon', r'digital coupon', r'free shipping', r'rebate', r'cashback'
-        ]
-        for pat in strong_patterns:
-            if re.search(pat, text, re.I): quality_score += 3
-        if re.search(r'(promo|coupon|discount)\s*code', text, re.I): quality_score += 2
-        for sig in ["deal","sale","promotion","special","clearance","markdown"]:
-            if sig in text: quality_score += 2
-        fresh_keywords = ['today','current','active','new','latest','this week', datetime.now().strftime('%B').lower()]
-        if any(kw in text for kw in fresh_keywords): quality_score += 2
-        if any(domain in link.lower() for domain in DEAL_FOCUSED_STORES.keys()): quality_score += 5
-        coupon_code = item.get("coupon_code", "N/A").upper()
-        if coupon_code in INVALID_COUPON_TERMS or len(coupon_code) > 20: quality_score -= 5
-        if item.get("discount_amount") == "N/A": quality_score -= 2
-        return quality_score >= 3
-    except Exception as e:
-        print(f"❌ Error in quality check: {e}")
+# ---------------- Query planner ----------------
+QUERY_STOPWORDS = frozenset(["the","a","an","at","for","on","in","of","and","or","to","with","from","products","items"])
+GF_QUERY_SYNONYMS = {"gluten-free": "gluten free", "gf": "gluten free"}
+
+def normalize_query(query: str) -> str:
+    """Lowercased, punctuation-free form used for dedup and yield bookkeeping."""
+    q = query.lower().replace("gluten-free", "gluten free")
+    tokens = re.findall(r"[a-z0-9$%']+", q)
+    return " ".join(GF_QUERY_SYNONYMS.get(t, t) for t in tokens)
+
+def _query_tokens(query: str) -> frozenset:
+    return frozenset(t for t in normalize_query(query).split() if t not in QUERY_STOPWORDS)
+
+def dedupe_queries(queries: List[str], threshold: float = QUERY_DEDUP_THRESHOLD) -> List[str]:
+    """Drop queries whose token set is >= threshold Jaccard-similar to an earlier one."""
+    kept, kept_tokens = [], []
+    for q in queries:
+        toks = _query_tokens(q)
+        if not toks: continue
+        if any(len(toks & kt) / len(toks | kt) >= threshold for kt in kept_tokens): continue
+        kept.append(q); kept_tokens.append(toks)
+    if len(kept) < len(queries): print(f"🧹 Dropped {len(queries) - len(kept)} near-duplicate queries")
+    return kept
+
+def _name_pattern(names: Iterable[str]) -> "re.Pattern":
+    alts = sorted({normalize_query(n) for n in names if normalize_query(n)}, key=len, reverse=True)
+    return re.compile(r"\b(?:" + "|".join(re.escape(a) for a in alts) + r")\b")
+
+_TEMPLATE_SUBS = [
+    (_name_pattern(enhanced_brands), "{brand}"),
+    (_name_pattern(list(DEAL_FOCUSED_STORES.values()) + ["whole foods", "publix", "safeway"]), "{store}"),
+    (re.compile(r"\b(?:january|february|march|april|may|june|july|august|september|october|november|december)\b"), "{month}"),
+    (re.compile(r"\b20\d\d\b"), "{year}"),
+]
+
+def query_template(query: str) -> str:
+    """Normalized query with brand/store/month/year slots, e.g. "{store} gluten free coupons {month} {year}"."""
+    t = normalize_query(query)
+    for pat, slot in _TEMPLATE_SUBS: t = pat.sub(slot, t)
+    return t
+
+YIELD_METRICS = ("raw", "deals", "new_links")
+QUERY_YIELD_KEY = "query_yield_v2"
+SEEN_LINKS_CAP = 20000
+YIELD_HISTORY_MAX_AGE = 30  # runs an entry may go without an update before it is dropped
+YIELD_HISTORY_MAX_ENTRIES = 500  # per unit and table, most recently updated kept
+
+class QueryYieldTracker:
+    """
+    Cross-run yield history per search unit ("serpapi:google", "tavily", ...)
+    for each normalized query and each query template. Every run records raw
+    high-quality hits, post-filter deals and links never seen in earlier runs;
+    commit() folds them into EMAs and persists them with the query plans,
+    pruning entries that stopped getting updates so the doc stays small.
+    """
+
+    def __init__(self, history: Optional[Dict] = None, seen_links: Optional[List[str]] = None, alpha: float = 0.5):
+        self.history = history or {"queries": {}, "templates": {}}
+        self.alpha = alpha
+        self._seen_order = list(seen_links or [])
+        self._seen = set(self._seen_order)
+        self._run: Dict[Tuple[str, str], Dict[str, int]] = {}
+        self._link_units: Dict[str, set] = {}
+        self._new_links: List[str] = []
+
+    @classmethod
+    def load(cls) -> "QueryYieldTracker":
+        stored = open_query_plan_cache().get(QUERY_YIELD_KEY) or {}
+        return cls(stored.get("history"), stored.get("seen_links"))
+
+    @staticmethod
+    def _link_key(link: str) -> str:
+        return hashlib.sha1(link.encode("utf-8")).hexdigest()[:16]
+
+    def record_search(self, provider: str, query: str, items: List["Deal"], engines: Optional[List[str]] = None) -> None:
+        """Called once per finished query with its (already deduped) high-quality hits."""
+        self.record_hits(provider, query, [(item.source, item.link) for item in items], engines)
+
+    def record_hits(self, provider: str, query: str, hits: List[Tuple[str, str]], engines: Optional[List[str]] = None) -> None:
+        """record_search on (source, link) pairs, as shipped back by shard workers."""
+        units = [f"serpapi:{e}" for e in engines or SERPAPI_ENGINES] if provider == "serpapi" else [provider]
+        for unit in units: self._run.setdefault((unit, query), dict.fromkeys(YIELD_METRICS, 0))
+        for source, link in hits:
+            m = re.match(r"SerpAPI \((\w+)\)", source)
+            unit = f"serpapi:{m.group(1)}" if provider == "serpapi" and m else provider
+            stats = self._run.setdefault((unit, query), dict.fromkeys(YIELD_METRICS, 0))
+            stats["raw"] += 1
+            if not link.startswith(("http://", "https://")): continue
+            key = self._link_key(link)
+            self._link_units.setdefault(link, set()).add((unit, query))
+            if key not in self._seen:
+                self._seen.add(key); self._new_links.append(key)
+                stats["new_links"] += 1
+
+    def record_deal(self, deal: "Deal") -> None:
+        """Credit a post-filter deal (once per link) to every unit/query that returned it."""
+        for unit_query in self._link_units.pop(deal.link, ()):
+            self._run[unit_query]["deals"] += 1
+
+    def _fold(self, table: Dict, unit: str, key: str, stats: Dict[str, float]) -> None:
+        entry = table.setdefault(unit, {}).setdefault(key, {"runs": 0, **dict.fromkeys(YIELD_METRICS, 0.0)})
+        for metric in YIELD_METRICS:
+            entry[metric] = stats[metric] if not entry["runs"] else (1 - self.alpha) * entry[metric] + self.alpha * stats[metric]
+        entry["runs"] += 1
+        entry["last"] = self.history["commits"]
+
+    def _prune(self, table: Dict) -> None:
+        oldest = self.history["commits"] - YIELD_HISTORY_MAX_AGE
+        for unit in list(table):
+            live = sorted(((e.get("last", 0), key) for key, e in table[unit].items() if e.get("last", 0) > oldest), reverse=True)
+            table[unit] = {key: table[unit][key] for _, key in live[:YIELD_HISTORY_MAX_ENTRIES]}
+            if not table[unit]: del table[unit]
+
+    def commit(self) -> Dict[str, int]:
+        self.history["commits"] = self.history.get("commits", 0) + 1
+        templates: Dict[Tuple[str, str], List[Dict[str, int]]] = {}
+        for (unit, query), stats in self._run.items():
+            self._fold(self.history["queries"], unit, normalize_query(query), stats)
+            templates.setdefault((unit, query_template(query)), []).append(stats)
+        for (unit, tpl), runs in templates.items():  # templates track the mean per call
+            self._fold(self.history["templates"], unit, tpl, {m: sum(r[m] for r in runs) / len(runs) for m in YIELD_METRICS})
+        for table in ("queries", "templates"): self._prune(self.history[table])
+        seen = (self._seen_order + self._new_links)[-SEEN_LINKS_CAP:]
+        open_query_plan_cache().set(QUERY_YIELD_KEY, {"history": self.history, "seen_links": seen})
+        totals = {m: sum(st[m] for st in self._run.values()) for m in YIELD_METRICS}
+        totals["calls"] = len(self._run)
+        totals["zero_yield_calls"] = sum(1 for st in self._run.values() if not st["deals"])
+        self._run, self._link_units, self._new_links, self._seen_order = {}, {}, [], seen
+        return totals
+
+    def estimate(self, unit: str, query: str) -> Tuple[float, int]:
+        """(expected deals + new links per call, runs observed) for one unit/query."""
+        def value(e): return e["deals"] + 0.5 * e["new_links"]
+        entry = self.history["queries"].get(unit, {}).get(normalize_query(query))
+        if entry: return value(entry), entry["runs"]
+        tpl = self.history["templates"].get(unit, {}).get(query_template(query))
+        if tpl: return value(tpl), 0
+        per_unit = self.history["queries"].get(unit, {})
+        if per_unit: return sum(value(e) for e in per_unit.values()) / len(per_unit), 0
+        return 1.0, 0
+
+    def expected(self, provider: str, query: str) -> float:
+        units = [f"serpapi:{e}" for e in SERPAPI_ENGINES] if provider == "serpapi" else [provider]
+        return sum(self.estimate(u, query)[0] for u in units)
+
+def load_query_yield() -> QueryYieldTracker:
+    return QueryYieldTracker.load()
+
+def assign_queries_to_providers(queries: List[str], tracker: QueryYieldTracker, per_provider_cap: int = 50) -> Dict[str, List[str]]:
+    """
+    Deterministic split: queries that yield relatively more on SerpAPI go there,
+    the rest to Tavily, half each. Ties break on a stable hash of the query.
+    """
+    def preference(q: str):
+        edge = tracker.expected("serpapi", q) - tracker.expected("tavily", q)
+        return (-edge, hashlib.sha1(normalize_query(q).encode("utf-8")).hexdigest())
+    ordered = sorted(queries, key=preference)
+    mid = len(ordered) // 2
+    return {"serpapi": ordered[:mid][:per_provider_cap], "tavily": ordered[mid:][:per_provider_cap]}
+
+def allocate_search_budget(plan: Dict[str, List[str]], tracker: QueryYieldTracker, budget: int = SEARCH_CALL_BUDGET,
+                           floor: int = MAX_QUERIES_PER_SOURCE) -> Dict[str, List[str]]:
+    """
+    Spend a fixed number of provider calls (one per SerpAPI engine per query, one
+    per Tavily query) on the units with the best expected yield. Every source
+    keeps at least `floor` calls so a bad run can't starve an engine, and unseen
+    units get an exploration bonus. Returns the plan plus "serpapi_engines".
+    """
+    units = [(f"serpapi:{e}", q) for q in plan.get("serpapi", []) for e in SERPAPI_ENGINES]
+    units += [("tavily", q) for q in plan.get("tavily", [])]
+    if budget <= 0 or len(units) <= budget:
+        return plan
+
+    def priority(unit_query):
+        value, runs = tracker.estimate(*unit_query)
+        tie = hashlib.sha1(f"{unit_query[0]}|{normalize_query(unit_query[1])}".encode("utf-8")).hexdigest()
+        return (-(value + 1.0 / (1 + runs) ** 0.5), tie)
+
+    ranked = sorted(units, key=priority)
+    chosen, per_source = [], {}
+    for uq in ranked:
+        if per_source.get(uq[0], 0) < floor:
+            chosen.append(uq); per_source[uq[0]] = per_source.get(uq[0], 0) + 1
+    picked = set(chosen)
+    for uq in ranked:
+        if len(chosen) >= budget: break
+        if uq not in picked: chosen.append(uq); picked.add(uq)
+    picked = set(chosen[:max(budget, 0)])
+
+    engines = {q: [e for e in SERPAPI_ENGINES if (f"serpapi:{e}", q) in picked] for q in plan.get("serpapi", [])}
+    out = {
+        "serpapi": [q for q in plan.get("serpapi", []) if engines[q]],
+        "tavily": [q for q in plan.get("tavily", []) if ("tavily", q) in picked],
+    }
+    out["serpapi_engines"] = {q: engines[q] for q in out["serpapi"]}
+    print(f"💰 Search budget: {len(picked)}/{len(units)} calls → {len(out['serpapi'])} SerpAPI + {len(out['tavily'])} Tavily queries")
+    return out
+
+# ---------------- Keyword index ----------------
+# Every "any(kw in text for kw in LIST)" vocabulary lives in one Aho-Corasick
+# automaton built at import. keyword_hits() walks a text once and returns the
+# matched terms per category, so filters test set membership instead of
+# rescanning the same string for each keyword.
+REAL_DEAL_GF_KEYWORDS = ["gluten free", "gluten-free", "gf", "celiac", "wheat free", "gluten conscious", "gluten sensitive"]
+REAL_DEAL_KEYWORDS = [
+    "coupon", "promo", "discount", "save", "off", "deal", "sale",
+    "special", "offer", "rebate", "cashback", "bogo", "free shipping",
+    "clearance", "promotion", "code"
+]
+NON_SHOPPING_PATTERNS = [
+    "recipe", "how to make", "what is gluten", "gluten intolerance symptoms",
+    "celiac disease diagnosis", "gluten free diet tips", "restaurant review",
+    "blog about", "article about", "guide to", "understanding celiac"
+]
+BLOG_INDICATORS = [
+    "blog", "article", "post", "guide to", "how to", "what is",
+    "understanding", "living with", "tips for", "managing celiac",
+    "gluten free lifestyle", "celiac awareness", "gluten sensitivity guide"
+]
+BLOG_DEAL_WORDS = ["coupon", "discount", "sale", "promo", "deal", "offer"]
+INFO_INDICATORS = [
+    "what is celiac", "gluten intolerance symptoms", "diagnosis",
+    "gluten free diet benefits", "celiac disease facts",
+    "gluten sensitivity explained", "wheat allergy vs"
+]
+EXPIRED_INDICATORS = [
+    "expired", "ended", "no longer valid", "promotion closed",
+    "offer has ended", "deal expired", "sale ended", "coupon expired"
+]
+SPAM_INDICATORS = [
+    "you won't believe", "amazing secret", "doctors hate",
+    "one weird trick", "shocking truth", "incredible discovery",
+    "miracle cure", "secret formula", "lose weight fast"
+]
+STRONG_DEAL_INDICATORS = ["coupon code", "promo code", "% off", "$ off", "free shipping", "bogo"]
+TEXT_STORE_NAMES = ['target','walmart','kroger','costco','amazon','whole foods']
+FOOD_TERMS = ['snack','food','meal','cookie','cracker','bread','pizza']
+FROZEN_TERMS = ['frozen','ice cream','entree']
+RESTRICTION_TERMS = ['restrictions apply','exclusions','not valid with other offers','one per customer']
+FRESH_TERMS = ['today','current','active','new','latest','this week']
+HQ_SIGNAL_TERMS = frozenset(["deal","sale","promotion","special","clearance","markdown"])
+VALIDATION_SIGNAL_TERMS = frozenset(["deal","sale","promotion","special","clearance","coupon","discount"])
+
+class KeywordIndex:
+    """Aho-Corasick automaton over {category: [terms]} with substring (not word) semantics."""
+
+    def __init__(self, vocabularies: Dict[str, List[str]]):
+        goto: List[Dict[str, int]] = [{}]
+        out: List[set] = [set()]
+        for category, terms in vocabularies.items():
+            for term in terms:
+                state = 0
+                for ch in term.lower():
+                    nxt = goto[state].get(ch)
+                    if nxt is None:
+                        nxt = len(goto); goto.append({}); out.append(set())
+                        goto[state][ch] = nxt
+                    state = nxt
+                out[state].add((category, term.lower()))
+
+        # BFS to fill failure links, then fold them into a full transition table
+        # so scanning is one dict lookup per character.
+        fail = [0] * len(goto)
+        delta: List[Dict[str, int]] = [dict(goto[0])] + [None] * (len(goto) - 1)
+        queue = list(goto[0].values())
+        for state in queue:
+            out[state] |= out[fail[state]]
+            delta[state] = {**delta[fail[state]], **goto[state]}
+            for ch, nxt in goto[state].items():
+                fail[nxt] = delta[fail[state]].get(ch, 0)
+                queue.append(nxt)
+        self._delta = delta
+        self._out = [frozenset(o) for o in out]
+        self.categories = tuple(vocabularies)
+        self.fingerprint = hashlib.sha1(json.dumps(vocabularies, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def scan(self, text: str) -> Dict[str, frozenset]:
+        delta, out, state = self._delta, self._out, 0
+        found = set()
+        for ch in text:
+            state = delta[state].get(ch, 0)
+            if out[state]: found.update(out[state])
+        grouped: Dict[str, set] = {}
+        for category, term in found:
+            grouped.setdefault(category, set()).add(term)
+        hits = dict.fromkeys(self.categories, frozenset())
+        hits.update((c, frozenset(t)) for c, t in grouped.items())
+        return hits
+
+KEYWORD_INDEX = KeywordIndex({
+    "gf": GF_KEYWORDS,
+    "deal": DEAL_INDICATORS,
+    "real_gf": REAL_DEAL_GF_KEYWORDS,
+    "real_deal": REAL_DEAL_KEYWORDS,
+    "non_shopping": NON_SHOPPING_PATTERNS,
+    "blog": BLOG_INDICATORS,
+    "blog_deal": BLOG_DEAL_WORDS,
+    "info": INFO_INDICATORS,
+    "expired": EXPIRED_INDICATORS,
+    "spam": SPAM_INDICATORS,
+    "strong_deal": STRONG_DEAL_INDICATORS,
+    "store": TEXT_STORE_NAMES,
+    "brand": enhanced_brands,
+    "food": FOOD_TERMS,
+    "frozen": FROZEN_TERMS,
+    "restriction": RESTRICTION_TERMS,
+    "fresh": FRESH_TERMS,
+    "signal": sorted(HQ_SIGNAL_TERMS | VALIDATION_SIGNAL_TERMS),
+})
+
+@lru_cache(maxsize=8192)
+def keyword_hits(text: str) -> Dict[str, frozenset]:
+    """Matched terms per category for a lowercased text (memoized; do not mutate)."""
+    return KEYWORD_INDEX.scan(text)
+
+# ---------------- Domain resolver ----------------
+class DomainResolver:
+    """
+    Maps a URL host to a store/brand name. Dotted keys ("kind.com") live in a
+    suffix trie over reversed labels, so subdomains resolve to their registrable
+    domain; bare keys ("happycampersgf") match a whole non-TLD label. Results are
+    LRU-cached per host. Earlier mappings win when keys collide.
+    """
+
+    def __init__(self, *mappings: Dict[str, str], cache_size: int = 4096):
+        self._trie: list = [{}, None]  # node = [children by label, name]
+        self._labels: Dict[str, str] = {}
+        for mapping in mappings:
+            for key, name in mapping.items():
+                key = key.lower()
+                if "." not in key:
+                    self._labels.setdefault(key, name)
+                    continue
+                node = self._trie
+                for label in reversed(key.split(".")):
+                    node = node[0].setdefault(label, [{}, None])
+                if node[1] is None: node[1] = name
+        self._lookup = lru_cache(maxsize=cache_size)(self._resolve_host)
+        self.stats = {"lookups": 0, "resolved": 0, "unresolved": 0, "ambiguous": 0}
+
+    def _resolve_host(self, host: str) -> Tuple[Optional[str], bool]:
+        labels = host.split(".")
+        if labels[0] == "www": labels = labels[1:]
+        node, suffix_match = self._trie, None
+        for label in reversed(labels):
+            node = node[0].get(label)
+            if node is None: break
+            if node[1] is not None: suffix_match = node[1]  # deepest match wins
+        label_matches = [self._labels[l] for l in labels[:-1] if l in self._labels]
+        candidates = {suffix_match, *label_matches} - {None}
+        name = suffix_match or (label_matches[0] if label_matches else None)
+        return name, len(candidates) > 1
+
+    def resolve(self, host: str) -> Optional[str]:
+        host = (host or "").lower().strip(".")
+        self.stats["lookups"] += 1
+        name, ambiguous = self._lookup(host)
+        self.stats["resolved" if name else "unresolved"] += 1
+        if ambiguous: self.stats["ambiguous"] += 1
+        return name
+
+    def resolve_url(self, url: str) -> Optional[str]:
+        return self.resolve(urlparse(url).hostname or "")
+
+    def stats_snapshot(self) -> Dict[str, int]:
+        info = self._lookup.cache_info()
+        return {**self.stats, "cache_hits": info.hits, "cache_misses": info.misses, "cache_size": info.currsize}
+
+DOMAIN_RESOLVER = DomainResolver(DOMAIN_TO_BRAND, DEAL_FOCUSED_STORES)
+
+# ---------------- Compiled deal matcher ----------------
+# All scoring/extraction regexes are compiled once here. deal_features() scans a
+# lowercased text once and returns a DealFeatures record that the quality check,
+# detail extraction and validation stages all read instead of re-running patterns.
+STRONG_DEAL_PATTERNS = [
+    (name, re.compile(p)) for name, p in [
+        ("pct_off", r'\d+%\s*off'), ("dollar_off", r'\$\d+\.?\d*\s*off'), ("save_dollar", r'save\s*\$\d+'),
+        ("buy_get", r'buy\s+\d+\s+get\s+\d+'), ("for_price", r'for\s+\$\d+'), ("printable", r'printable coupon'),
+        ("digital", r'digital coupon'), ("free_ship", r'free shipping'), ("rebate", r'rebate'), ("cashback", r'cashback'),
+    ]
+]
+CODE_PHRASE_RE = re.compile(r'(promo|coupon|discount)\s*code')
+
+class DealType(str, Enum):
+    COUPON = "Coupon/Promo Code"
+    REBATE = "Rebate/Cashback"
+    SALE = "Sale/Discount"
+    FREE_SHIPPING = "Free Shipping"
+    BOGO = "BOGO/Bundle"
+    PRINTABLE = "Printable/Digital Coupon"
+    LIMITED_TIME = "Limited Time Offer"
+    FLASH = "Flash/Daily Deal"
+    EXCLUSIVE = "Exclusive Deal"
+    UNKNOWN = "N/A"
+
+DEAL_TYPE_PATTERNS = [
+    (re.compile(p), dtype) for p, dtype in [
+        (r'coupon|promo code|discount code', DealType.COUPON),
+        (r'rebate|cashback|cash back', DealType.REBATE),
+        (r'sale|clearance|\d+%\s*off', DealType.SALE),
+        (r'free shipping', DealType.FREE_SHIPPING),
+        (r'bogo|buy one get|buy \d+ get', DealType.BOGO),
+        (r'printable|digital coupon', DealType.PRINTABLE),
+        (r'limited time|while supplies last', DealType.LIMITED_TIME),
+        (r'flash sale|daily deal', DealType.FLASH),
+        (r'member|exclusive|app only', DealType.EXCLUSIVE)
+    ]
+]
+
+# (pattern, display format, unit, value group or fixed value)
+DISCOUNT_PATTERNS = [
+    (re.compile(p), fmt, unit, value) for p, fmt, unit, value in [
+        (r'(\d+)%\s*off', r'\1% off', "percent", 1),
+        (r'\$(\d+(?:\.\d{2})?)\s*off', r'$\1 off', "usd", 1),
+        (r'save\s*\$(\d+(?:\.\d{2})?)', r'Save $\1', "usd", 1),
+        (r'save\s*(\d+)%', r'Save \1%', "percent", 1),
+        (r'up to\s*(\d+)%\s*off', r'Up to \1% off', "percent", 1),
+        (r'(\d+)\s*percent\s*off', r'\1% off', "percent", 1),
+        (r'buy\s*(\d+)\s*get\s*(\d+)', r'Buy \1 Get \2 Free', "free_items", 2),
+        (r'(\d+)\s*for\s*\$(\d+(?:\.\d{2})?)', r'\1 for $\2', "bundle_usd", 2),
+        (r'half\s*off', '50% off', "percent", 50.0),
+        (r'(\d+)\s*=\s*\$(\d+(?:\.\d{2})?)', r'\1 for $\2', "bundle_usd", 2)
+    ]
+]
+
+# Coupon patterns keep re.I: the text is lowercased, so [A-Z0-9] must match either case
+COUPON_PATTERNS = [re.compile(p, re.I) for p in [
+    r'(?:code|use|enter|promo|coupon)[:;\s]*([A-Z0-9]{4,20})\b',
+    r'\b(SAVE[A-Z0-9]+)\b', r'\b(GET[A-Z0-9]+)\b',
+    r'\b([A-Z]{3,}[0-9]{2,})\b', r'\b([A-Z0-9]{6,15})\b',
+    r'code\s*[:;]\s*([A-Z0-9]+)', r'"([A-Z0-9]{4,})"'
+]]
+COUPON_SHAPE_RE = re.compile(r'[A-Z0-9]{4,}')
+
+EXPIRATION_PATTERNS = [re.compile(p) for p in [
+    r'expires? (?:on|at|in|by)?\s*([^\.,\n]+)',
+    r'valid (?:through|until|by)?\s*([^\.,\n]+)',
+    r'good (?:through|until)?\s*([^\.,\n]+)',
+    r'offer ends?\s*([^\.,\n]+)',
+    r'\bends? (?:on )?(?:today|tonight|tomorrow|soon|in \d|this|\d|(?:mon|tues|wednes|thurs|fri|satur|sun)day|'
+    r'(?:jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\b)[^\.,\n]*',
+    r'while supplies last|limited time|quantities limited'
+]]
+# Expiration phrases come out of ordinary product text ("good for 1/2 off",
+# "good & gather decaf 12 oz", "valid in sunday circular"), so a date only counts
+# when it directly follows an expiry word, and month names must be whole words.
+MONTH_NUMBERS = {name: i + 1 for i, name in enumerate(["january", "february", "march", "april", "may", "june", "july",
+                                                      "august", "september", "october", "november", "december"])}
+MONTH_NUMBERS.update({name[:3]: n for name, n in list(MONTH_NUMBERS.items())}, sept=9)
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+_MONTH_RE = r"\b(" + "|".join(sorted(MONTH_NUMBERS, key=len, reverse=True)) + r")\b\.?"
+_EXPIRY_VERB_RE = r"\b(?:expires?|expiring|ends?|through|thru|until|till|by)\s+(?:on\s+|at\s+)?"
+# (pattern, kind): groups are (month, day, year) except "dmy_name" (day, month, year), "iso" (year, month, day)
+# and "month_year" (month, year → last day of that month)
+EXPIRY_DATE_PATTERNS = [
+    (re.compile(_EXPIRY_VERB_RE + r'(\d{4})-(\d{2})-(\d{2})\b'), "iso"),
+    (re.compile(_EXPIRY_VERB_RE + r'(\d{1,2})/(\d{1,2})(?:/(\d{4}|\d{2}))?(?![\d/])'), "mdy"),
+    (re.compile(_EXPIRY_VERB_RE + _MONTH_RE + r'\s*(\d{1,2})(?:st|nd|rd|th)?\b(?:,?\s*(\d{4}))?'), "name"),
+    (re.compile(_EXPIRY_VERB_RE + r'(\d{1,2})(?:st|nd|rd|th)?\s+(?:of\s+)?' + _MONTH_RE + r'(?:,?\s*(\d{4}))?'), "dmy_name"),
+    (re.compile(_EXPIRY_VERB_RE + _MONTH_RE + r',?\s+(\d{4})\b'), "month_year"),
+]
+# Relative phrases count from the day a result was first seen (Deal.expires_on)
+_RELATIVE_VERB_RE = r"\b(?:ends?|expires?|expiring|through|thru|until|till)\s+"
+RELATIVE_EXPIRY_PATTERNS = [(re.compile(_RELATIVE_VERB_RE + p), kind) for p, kind in [
+    (r'(?:in|within)\s+(\d{1,3})\s+(day|week|month)s?\b', "offset"),
+    (r'(?:today|tonight|(?:at\s+)?midnight)\b', "today"),
+    (r'tomorrow\b', "tomorrow"),
+    (r'(?:the\s+)?end of (?:the )?month\b', "month_end"),
+    (r'(?:(?:the\s+)?end of (?:the )?week|this weekend)\b', "week_end"),
+    (r'(?:on\s+|this\s+)?(' + "|".join(WEEKDAYS) + r')\b', "weekday"),
+]]
+RELATIVE_UNIT_DAYS = {"day": 1, "week": 7, "month": 30}
+
+class DealFeatures(NamedTuple):
+    # Shared by every caller of the memoized record, so everything here is immutable
+    gf: bool
+    strong: frozenset
+    code_phrase: bool
+    signals: frozenset
+    fresh: frozenset
+    deal_type: DealType
+    discount_amount: Optional[str]
+    discount_value: Optional[float]
+    discount_unit: Optional[str]
+    coupon_code: Optional[str]
+    expiration: Optional[str]
+    expires_on: Optional[date]  # absolute dates only; Deal.expires_on adds relative phrases
+    restrictions: bool
+
+def _extract_coupon_code(text: str) -> Optional[str]:
+    for pat in COUPON_PATTERNS:
+        for m in pat.findall(text):
+            raw = m.upper() if isinstance(m, str) else m[0].upper()
+            if raw in INVALID_COUPON_TERMS or len(raw) > 15: continue
+            if COUPON_SHAPE_RE.fullmatch(raw): return raw
+    return None
+
+def _extract_expiration(text: str) -> Optional[str]:
+    for pat in EXPIRATION_PATTERNS:
+        m = pat.search(text)
+        if m:
+            fm = m.group(0).strip()
+            return "While Supplies Last" if 'while supplies last' in fm.lower() else fm
+    return None
+
+def parse_expiry_date(phrase: Optional[str], today: date, relative: bool = True) -> Optional[date]:
+    """
+    Date right after an expiry word in an expiration phrase: absolute ("expires
+    10/31", "valid until nov 3, 2026", "ends 31 aug", "expires on 2026-10-31") or,
+    unless relative=False, relative to today ("ends in 3 days", "ends tomorrow",
+    "offer ends sunday", "through end of month"), if any.
+    """
+    if not phrase: return None
+    for pat, kind in EXPIRY_DATE_PATTERNS:
+        m = pat.search(phrase)
+        if not m: continue
+        if kind == "iso": year, month, day = m.group(1), int(m.group(2)), int(m.group(3))
+        elif kind == "mdy": year, month, day = m.group(3), int(m.group(1)), int(m.group(2))
+        elif kind == "name": year, month, day = m.group(3), MONTH_NUMBERS[m.group(1)], int(m.group(2))
+        elif kind == "dmy_name": year, month, day = m.group(3), MONTH_NUMBERS[m.group(2)], int(m.group(1))
+        else:
+            first = date(int(m.group(2)), MONTH_NUMBERS[m.group(1)], 1)
+            return (first + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+        try:
+            if year: return date(int(year) + (2000 if len(year) == 2 else 0), month, day)
+            found = date(today.year, month, day)
+        except ValueError:
+            continue
+        # No year given: only a date more than half a year back means next year's
+        # ("expires 1/5" in December); a few weeks back is a stale page, so it stays past
+        return found.replace(year=today.year + 1) if found < today - timedelta(days=183) else found
+    return relative_expiry_date(phrase, today) if relative else None
+
+def relative_expiry_date(phrase: Optional[str], today: date) -> Optional[date]:
+    if not phrase: return None
+    for pat, kind in RELATIVE_EXPIRY_PATTERNS:
+        m = pat.search(phrase)
+        if not m: continue
+        if kind == "offset": return today + timedelta(days=int(m.group(1)) * RELATIVE_UNIT_DAYS[m.group(2)])
+        if kind == "today": return today
+        if kind == "tomorrow": return today + timedelta(days=1)
+        if kind == "month_end": return (today.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+        if kind == "week_end": return today + timedelta(days=6 - today.weekday())
+        return today + timedelta(days=(WEEKDAYS.index(m.group(1)) - today.weekday()) % 7)
+    return None
+
+@lru_cache(maxsize=8192)
+def _deal_features(text: str, today: date) -> DealFeatures:
+    strong = frozenset(name for name, pat in STRONG_DEAL_PATTERNS if pat.search(text))
+    deal_type = next((dtype for pat, dtype in DEAL_TYPE_PATTERNS if pat.search(text)), DealType.UNKNOWN)
+    discount_amount = discount_value = discount_unit = None
+    for pat, fmt, unit, value in DISCOUNT_PATTERNS:
+        m = pat.search(text)
+        if m:
+            discount_amount, discount_unit = m.expand(fmt), unit
+            discount_value = float(m.group(value)) if isinstance(value, int) else value
+            break
+    expiration = _extract_expiration(text)
+    hits = keyword_hits(text)
+    month = today.strftime('%B').lower()
+    return DealFeatures(
+        gf=bool(hits["gf"]),
+        strong=strong,
+        code_phrase=bool(CODE_PHRASE_RE.search(text)),
+        signals=hits["signal"],
+        fresh=hits["fresh"] | {month} if month in text else hits["fresh"],
+        deal_type=deal_type,
+        discount_amount=discount_amount,
+        discount_value=discount_value,
+        discount_unit=discount_unit,
+        coupon_code=_extract_coupon_code(text),
+        expiration=expiration,
+        expires_on=parse_expiry_date(expiration, today, relative=False),
+        restrictions=bool(hits["restriction"]),
+    )
+
+def deal_features(text: str, today: Optional[date] = None) -> DealFeatures:
+    """Compiled single-pass feature record for a lowercased deal text as of today (memoized per day)."""
+    return _deal_features(text, today or date.today())
+
+def is_high_quality_deal(deal: "Deal") -> bool:
+    feats = deal.features
+    if not feats.gf:
         return False
+    quality_score = 3 * len(feats.strong)
+    if feats.code_phrase: quality_score += 2
+    quality_score += 2 * len(feats.signals & HQ_SIGNAL_TERMS)
+    if feats.fresh: quality_score += 2
+    if deal.focused_store: quality_score += 5
+    return quality_score >= 3
+
+# ---------------- Deal record ----------------
+@dataclass(slots=True, eq=False)
+class Deal:
+    """
+    One search hit on its way through the pipeline. Text fields are coerced and
+    lowercased at construction; the keyword scan and feature record are computed
+    on first use (a result the seen-deal index already knows may never need
+    them). The "N/A"-style sentinels of the stored schema only appear in to_dict().
+    """
+    title: str
+    snippet: str
+    link: str
+    source: str
+    fetched_at: datetime
+    store: Optional[str] = None
+    brand: Optional[str] = None
+    category: str = "General"
+    ai_quality_score: int = 0
+    source_boost: bool = False
+    llm_verified: bool = False
+    seen_on: Optional[date] = None  # first day this exact result was fetched, from the seen-deal index
+    text: str = field(init=False, repr=False)
+    focused_store: bool = field(init=False, repr=False)
+    _hits: Optional[Dict[str, frozenset]] = field(init=False, default=None, repr=False)
+    _features: Optional[DealFeatures] = field(init=False, default=None, repr=False)
+
+    def __post_init__(self):
+        self.title, self.snippet, self.link = str(self.title or ""), str(self.snippet or ""), str(self.link or "")
+        self.text = f"{self.title} {self.snippet}".lower()
+        link = self.link.lower()
+        self.focused_store = any(domain in link for domain in DEAL_FOCUSED_STORES.keys())
+
+    @property
+    def hits(self) -> Dict[str, frozenset]:
+        if self._hits is None: self._hits = keyword_hits(self.text)
+        return self._hits
+
+    @property
+    def features(self) -> DealFeatures:
+        if self._features is None: self._features = deal_features(self.text, self.fetched_at.date())
+        return self._features
+
+    @property
+    def expires_on(self) -> Optional[date]:
+        """Expiry date; relative phrases count from seen_on, or from the fetch day when that is unknown."""
+        f = self.features
+        return f.expires_on or relative_expiry_date(f.expiration, self.seen_on or self.fetched_at.date())
+
+    def to_state(self) -> Dict:
+        """Minimal JSON-safe state (no sentinels, no derived fields) for shipping between processes."""
+        return {"title": self.title, "snippet": self.snippet, "link": self.link, "source": self.source,
+                "fetched_at": self.fetched_at.isoformat(), "store": self.store, "brand": self.brand,
+                "category": self.category, "ai_quality_score": self.ai_quality_score, "source_boost": self.source_boost,
+                "seen_on": self.seen_on.isoformat() if self.seen_on else None}
 
-def extract_comprehensive_deal_details(item: Dict) -> Dict:
+    @classmethod
+    def from_state(cls, state: Dict) -> "Deal":
+        seen_on = state.get("seen_on")
+        return cls(**{**state, "fetched_at": datetime.fromisoformat(state["fetched_at"]),
+                      "seen_on": date.fromisoformat(seen_on) if seen_on else None})
+
+    def to_row(self, features: bool = False) -> Tuple:
+        """
+        Positional state for process-pool chunks (pickles much smaller than
+        to_state()), plus the feature record if it was computed or features=True.
+        """
+        return (self.title, self.snippet, self.link, self.source, self.fetched_at, self.store, self.brand,
+                self.category, self.ai_quality_score, self.source_boost, self.features if features else self._features, self.seen_on)
+
+    @classmethod
+    def from_row(cls, row: Tuple) -> "Deal":
+        deal = cls(*row[:10])
+        deal._features, deal.seen_on = row[10], row[11]
+        return deal
+
+    def to_dict(self) -> Dict:
+        """Stored/JSON shape of the deal."""
+        f = self.features
+        out = {
+            "title": self.title, "snippet": self.snippet, "link": self.link, "source": self.source,
+            "timestamp": self.fetched_at.isoformat(),
+            "deal_type": f.deal_type.value,
+            "discount_amount": f.discount_amount or "N/A",
+            "coupon_code": f.coupon_code or "N/A",
+            "expiration": f.expiration or "N/A",
+            "restrictions": "Restrictions apply" if f.restrictions else "N/A",
+            "ai_quality_score": self.ai_quality_score,
+            "store": self.store or "Unknown",
+            "brand": self.brand or "Multiple/Various",
+            "category": self.category,
+        }
+        if f.discount_value is not None:
+            out["discount_value"], out["discount_unit"] = f.discount_value, f.discount_unit
+        # A relative phrase is only stored against its first-seen day: counted from
+        # the fetch day it would move every run (new content hash, expiresAt never reached)
+        expires_on = f.expires_on or (relative_expiry_date(f.expiration, self.seen_on) if self.seen_on else None)
+        if expires_on: out["expires_on"] = expires_on.isoformat()
+        if self.source_boost: out["source_boost"] = True
+        if self.llm_verified: out["llm_verified"] = True
+        return out
+
+SERPAPI_URL = os.getenv("SERPAPI_URL", "https://serpapi.com/search")
+TAVILY_URL = os.getenv("TAVILY_URL", "https://api.tavily.com/search")
+SERPAPI_ENGINES = ["google","bing","duckduckgo"]
+
+def record_fixture(provider: str, engine: str, query: str, response: Dict) -> None:
+    """Save one raw provider response under SEARCH_RECORD_DIR for bench.py replay."""
+    if not SEARCH_RECORD_DIR: return
     try:
-        title = str(item.get('title','') or '')
-        snippet = str(item.get('snippet','') or '')
-        link = str(item.get('link','') or '')
-        text = f"{title} {snippet}".lower()
-        details = {"deal_type":"N/A","discount_amount":"N/A","coupon_code":"N/A","expiration":"N/A","restrictions":"N/A"}
-        for pattern, dtype in [
-            (r'coupon|promo code|discount code','Coupon/Promo Code'),
-            (r'rebate|cashback|cash back','Rebate/Cashback'),
-            (r'sale|clearance|\d+%\s*off','Sale/Discount'),
-            (r'free shipping','Free Shipping'),
-            (r'bogo|buy one get|buy \d+ get','BOGO/Bundle'),
-            (r'printable|digital coupon','Printable/Digital Coupon'),
-            (r'limited time|while supplies last','Limited Time Offer'),
-            (r'flash sale|daily deal','Flash/Daily Deal'),
-            (r'member|exclusive|app only','Exclusive Deal')
-        ]:
-            if re.search(pattern, text, re.I): details["deal_type"]=dtype; break
-        for pattern, fmt in [
-            (r'(\d+)%\s*off', r'\1% off'),
-            (r'\$(\d+(?:\.\d{2})?)\s*off', r'$\1 off'),
-            (r'save\s*\$(\d+(?:\.\d{2})?)', r'Save $\1'),
-            (r'save\s*(\d+)%', r'Save \1%'),
-            (r'up to\s*(\d+)%\s*off', r'Up to \1% off'),
-            (r'(\d+)\s*percent\s*off', r'\1% off'),
-            (r'buy\s*(\d+)\s*get\s*(\d+)', r'Buy \1 Get \2 Free'),
-            (r'(\d+)\s*for\s*\$(\d+(?:\.\d{2})?)', r'\1 for $\2'),
-            (r'half\s*off', '50% off'),
-            (r'(\d+)\s*=\s*\$(\d+(?:\.\d{2})?)', r'\1 for $\2')
-        ]:
-            m = re.search(pattern, text, re.I)
-            if m: details["discount_amount"]=re.sub(pattern, fmt, m.group(0), flags=re.I); break
-        for pattern in [
-            r'(?:code|use|enter|promo|coupon)[:;\s]*([A-Z0-9]{4,20})\b',
-            r'\b(SAVE[A-Z0-9]+)\b', r'\b(GET[A-Z0-9]+)\b',
-            r'\b([A-Z]{3,}[0-9]{2,})\b', r'\b([A-Z0-9]{6,15})\b',
-            r'code\s*[:;]\s*([A-Z0-9]+)', r'"([A-Z0-9]{4,})"'
-        ]:
-            matches = re.findall(pattern, text, re.I)
-            for m in matches:
-                raw = m.upper() if isinstance(m, str) else m[0].upper()
-                if raw in INVALID_COUPON_TERMS or len(raw) > 15: continue
-                if re.fullmatch(r'[A-Z0-9]{4,}', raw): details["coupon_code"]=raw; break
-            if details["coupon_code"]!="N/A": break
-        for pattern in [
-            r'expires? (?:on|at|in|by)?\s*([^\.,\n]+)',
-            r'valid (?:through|until|by)?\s*([^\.,\n]+)',
-            r'good (?:through|until)?\s*([^\.,\n]+)',
-            r'offer ends?\s*([^\.,\n]+)',
-            r'while supplies last|limited time|quantities limited'
-        ]:
-            m = re.search(pattern, text, re.I)
-            if m:
-                fm = m.group(0).strip()
-                details["expiration"] = "While Supplies Last" if 'while supplies last' in fm.lower() else fm
-                break
-        if any(k in text for k in ['restrictions apply','exclusions','not valid with other offers','one per customer']):
-            details["restrictions"] = "Restrictions apply"
-        return details
-    except Exception as e:
-        print(f"❌ Error extracting deal details: {e}")
-        return {"deal_type":"N/A","discount_amount":"N/A","coupon_code":"N/A","expiration":"N/A","restrictions":"N/A"}
+        os.makedirs(SEARCH_RECORD_DIR, exist_ok=True)
+        norm = " ".join(query.lower().split())
+        name = f"{provider}-{engine}-{hashlib.sha1(norm.encode('utf-8')).hexdigest()[:16]}.json"
+        with open(os.path.join(SEARCH_RECORD_DIR, name), "w") as f:
+            json.dump({"provider": provider, "engine": engine, "query": query, "recordedAt": datetime.utcnow().isoformat(), "response": response}, f)
+    except OSError as e:
+        print(f"⚠️ Could not record fixture for {provider}/{engine}: {e}")
 
-def search_serpapi_enhanced(query: str) -> List[Dict]:
-    if not SERPAPI_KEY:
-        print("⚠️  SerpAPI key not configured.")
-        return []
-    url = "https://serpapi.com/search"
-    all_items, seen_links = [], set()
-    engines = ["google","bing","duckduckgo"]
-    for engine in engines:
-        params = {"engine":engine,"q":query,"api_key":SERPAPI_KEY,"num":20,"gl":"us","hl":"en","safe":"off","tbs":"qdr:m"}
-        print(f"-> SerpAPI [{engine}]: {query}")
+# ---------------- Search response cache ----------------
+class SearchCache:
+    """No-op cache; backends store raw provider JSON keyed by search_cache_key()."""
+
+    def __init__(self, ttl: float = SEARCH_CACHE_TTL):
+        self.ttl = ttl
+        self.stats = {"hits": 0, "misses": 0, "stores": 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, stat: str) -> None:
+        with self._stats_lock: self.stats[stat] += 1
+
+    def get(self, key: str) -> Optional[Dict]:
         try:
-            r = requests.get(url, params=params, timeout=REQUEST_TIMEOUT)
+            value = self._get(key)
+        except Exception as e:
+            print(f"⚠️ Search cache read failed: {e}"); value = None
+        self._count("hits" if value is not None else "misses")
+        return value
+
+    def set(self, key: str, value: Dict) -> None:
+        try:
+            self._set(key, value); self._count("stores")
+        except Exception as e:
+            print(f"⚠️ Search cache write failed: {e}")
+
+    def _get(self, key: str) -> Optional[Dict]:
+        return None
+
+    def _set(self, key: str, value: Dict) -> None:
+        pass
+
+class SqliteSearchCache(SearchCache):
+    """Local on-disk cache with TTL expiry and LRU eviction past max_entries."""
+
+    def __init__(self, path: str = SEARCH_CACHE_PATH, ttl: float = SEARCH_CACHE_TTL, max_entries: int = SEARCH_CACHE_MAX_ENTRIES, table: str = "search_cache"):
+        super().__init__(ttl)
+        self.max_entries = max_entries
+        self.table = table
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value BLOB, created REAL, accessed REAL)")
+        self._db.execute(f"CREATE INDEX IF NOT EXISTS {table}_accessed ON {table} (accessed)")
+
+    def _get(self, key: str) -> Optional[Dict]:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(f"SELECT value, created FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if not row: return None
+            if now - row[1] > self.ttl:
+                self._db.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                return None
+            self._db.execute(f"UPDATE {self.table} SET accessed = ? WHERE key = ?", (now, key))
+        return json.loads(zlib.decompress(row[0]))
+
+    def _set(self, key: str, value: Dict) -> None:
+        now = time.time()
+        blob = zlib.compress(json.dumps(value).encode("utf-8"))
+        with self._lock:
+            self._db.execute(f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?)", (key, blob, now, now))
+            self._db.execute(f"DELETE FROM {self.table} WHERE created < ?", (now - self.ttl,))
+            self._db.execute(
+                f"DELETE FROM {self.table} WHERE key IN (SELECT key FROM {self.table} ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,))
+
+class FirestoreSearchCache(SearchCache):
+    """
+    Cache in a Firestore collection so it survives cold starts. Entries carry
+    expiresAt for a Firestore TTL policy; reads also check it. Size is bounded
+    by the TTL rather than by explicit eviction.
+    """
+
+    def __init__(self, ttl: float = SEARCH_CACHE_TTL, collection: str = "search_cache"):
+        super().__init__(ttl)
+        self._coll = get_firestore_client().collection(collection)
+
+    def _get(self, key: str) -> Optional[Dict]:
+        snap = self._coll.document(key).get()
+        if not snap.exists: return None
+        doc = snap.to_dict() or {}
+        expires = doc.get("expiresAt")
+        if expires is None or expires.timestamp() < time.time(): return None
+        return json.loads(zlib.decompress(doc["value"]))
+
+    def _set(self, key: str, value: Dict) -> None:
+        now = datetime.utcnow()
+        self._coll.document(key).set({
+            "value": zlib.compress(json.dumps(value).encode("utf-8")),
+            "createdAt": now,
+            "expiresAt": now + timedelta(seconds=self.ttl),
+        })
+
+_caches: Dict[str, SearchCache] = {}
+
+def open_cache(name: str, ttl: float, max_entries: int = SEARCH_CACHE_MAX_ENTRIES, backend: str = SEARCH_CACHE_BACKEND) -> SearchCache:
+    """Named cache on `backend` (default SEARCH_CACHE_BACKEND): sqlite table / Firestore collection."""
+    if name not in _caches:
+        try:
+            if backend == "sqlite": _caches[name] = SqliteSearchCache(ttl=ttl, max_entries=max_entries, table=name)
+            elif backend == "firestore": _caches[name] = FirestoreSearchCache(ttl=ttl, collection=name)
+            else: _caches[name] = SearchCache(ttl)
+        except Exception as e:
+            print(f"⚠️ Cache '{name}' on '{backend}' unavailable, caching disabled: {e}")
+            _caches[name] = SearchCache(ttl)
+    return _caches[name]
+
+def open_query_plan_cache() -> SearchCache:
+    return open_cache("query_plans", QUERY_PLAN_TTL, max_entries=24, backend=QUERY_PLAN_CACHE_BACKEND)
+
+def get_search_cache() -> SearchCache:
+    return open_cache("search_cache", SEARCH_CACHE_TTL)
+
+def search_cache_key(provider: str, engine: str, params: Dict) -> str:
+    """Provider + engine + request params (minus api_key), with the query normalized."""
+    norm = {k: v for k, v in params.items() if k != "api_key"}
+    for qk in ("q", "query"):
+        if qk in norm: norm[qk] = " ".join(str(norm[qk]).lower().split())
+    raw = json.dumps({"provider": provider, "engine": engine, "params": norm}, sort_keys=True)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+# ---------------- Rate limiting ----------------
+class TokenBucket:
+    """
+    Thread-safe token bucket with AIMD adaptation: a throttle response halves the
+    rate and blocks the bucket until Retry-After; each success creeps back up.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.max_rate = self.rate = max(rate, 0.01)
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Block until a token is available; returns the seconds spent waiting."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if now >= self._blocked_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = max(self._blocked_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(delay); waited += delay
+
+    def penalize(self, delay: float) -> None:
+        with self._lock:
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+            self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+            self._tokens = 0.0
+
+    def reward(self) -> None:
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+class RateLimiter:
+    """Lazily-built token buckets keyed by provider ("serpapi") or provider:engine."""
+
+    def __init__(self, defaults: Dict[str, Tuple[float, int]]):
+        self._defaults = defaults
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "throttled": 0, "retries": 0, "errors": 0, "wait_seconds": 0.0}
+
+    def record(self, **deltas) -> None:
+        with self._lock:
+            for k, v in deltas.items(): self.stats[k] += v
+
+    def bucket(self, key: str) -> TokenBucket:
+        with self._lock:
+            if key not in self._buckets:
+                provider = key.split(":")[0]
+                rate, burst = self._defaults.get(key) or self._defaults.get(f"{provider}:engine" if ":" in key else provider, (1.0, 1))
+                prefix = key.upper().replace(":", "_").replace("-", "_")
+                self._buckets[key] = TokenBucket(float(os.getenv(f"{prefix}_RATE_PER_SEC", rate)), int(os.getenv(f"{prefix}_BURST", burst)))
+            return self._buckets[key]
+
+    def snapshot(self) -> Dict[str, object]:
+        with self._lock:
+            rates = {k: round(b.rate, 3) for k, b in self._buckets.items()}
+            stats = dict(self.stats)
+        return {**stats, "wait_seconds": round(stats["wait_seconds"], 1), "rates": rates}
+
+RATE_LIMITER = RateLimiter(DEFAULT_RATE_LIMITS)
+
+def retry_after_seconds(resp) -> Optional[float]:
+    value = (getattr(resp, "headers", None) or {}).get("Retry-After")
+    if not value: return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_to_datetime
+        when = parsedate_to_datetime(value)  # HTTP-date form
+        return max(0.0, (when - datetime.now(when.tzinfo)).total_seconds())
+    except Exception:
+        return None
+
+# Monotonic time the current search fan-out must finish by; SearchLimiter.run
+# copies it into the provider-call threads. Unset outside a fan-out.
+SEARCH_DEADLINE_AT: "contextvars.ContextVar[float]" = contextvars.ContextVar("search_deadline_at", default=float("inf"))
+
+def search_time_left() -> float:
+    return SEARCH_DEADLINE_AT.get() - time.monotonic()
+
+def backoff_delay(attempt: int, base: float = SEARCH_BACKOFF_BASE, cap: float = SEARCH_BACKOFF_MAX) -> float:
+    """Full-jitter exponential backoff (search settings unless base/cap are given)."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+def rate_limited_request(method: str, url: str, bucket_keys: Tuple[str, ...], **kwargs):
+    """
+    Send a request through the shared session after taking a token from every
+    bucket in bucket_keys. 429/5xx responses and connection errors are retried
+    with Retry-After (capped at SEARCH_BACKOFF_MAX) or jittered exponential
+    backoff; the last response (or exception) is returned/raised once
+    SEARCH_MAX_RETRIES is spent, or once the next retry would start past the
+    search deadline.
+    """
+    import requests
+    buckets = [RATE_LIMITER.bucket(k) for k in bucket_keys]
+    record = RATE_LIMITER.record
+    for attempt in range(SEARCH_MAX_RETRIES + 1):
+        record(wait_seconds=sum(b.acquire() for b in buckets), requests=1)
+        try:
+            resp = get_http_session().request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            record(errors=1)
+            delay = backoff_delay(attempt)
+            if attempt == SEARCH_MAX_RETRIES or delay >= search_time_left(): raise
+        else:
+            if resp.status_code != 429 and resp.status_code < 500:
+                for b in buckets: b.reward()
+                return resp
+            if resp.status_code == 429:
+                record(throttled=1)
+                asked = retry_after_seconds(resp)
+                delay = backoff_delay(attempt) if asked is None else min(asked, SEARCH_BACKOFF_MAX)
+                for b in buckets: b.penalize(delay)
+                if asked is not None and asked > search_time_left():
+                    print(f"⏳ {' / '.join(bucket_keys)}: Retry-After {asked:.0f}s runs past the search deadline — giving up")
+                    return resp
+            else:
+                record(errors=1)
+                delay = backoff_delay(attempt)
+            if attempt == SEARCH_MAX_RETRIES or delay >= search_time_left(): return resp
+        record(retries=1)
+        print(f"⏳ {' / '.join(bucket_keys)}: retry {attempt + 1}/{SEARCH_MAX_RETRIES} in {delay:.1f}s")
+        time.sleep(delay)
+
+def fetch_serpapi_engine(query: str, engine: str) -> List[Deal]:
+    """One SerpAPI engine call; returns its high-quality hits (not yet deduped)."""
+    params = {"engine":engine,"q":query,"api_key":SERPAPI_KEY,"num":20,"gl":"us","hl":"en","safe":"off","tbs":"qdr:m"}
+    cache, cache_key = get_search_cache(), search_cache_key("serpapi", engine, params)
+    data = cache.get(cache_key)
+    print(f"-> SerpAPI [{engine}]{' (cached)' if data is not None else ''}: {query}")
+    if data is None:
+        outcome = "error"
+        try:
+            with METRICS.span("provider_call", provider="serpapi", engine=engine):
+                r = rate_limited_request("GET", SERPAPI_URL, ("serpapi", f"serpapi:{engine}"), params=params, timeout=REQUEST_TIMEOUT)
             if r.status_code == 429:
-                print(f"⚠️  Rate limited on {engine}, waiting..."); time.sleep(10); continue
+                outcome = "throttled"
+                print(f"⚠️  Still rate limited on {engine} after {SEARCH_MAX_RETRIES} retries"); return []
             r.raise_for_status(); data = r.json()
-            if "error" in data: print(f"❌ SerpAPI error on {engine}: {data['error']}"); continue
+            if "error" in data: print(f"❌ SerpAPI error on {engine}: {data['error']}"); return []
+            outcome = "ok"
         except Exception as e:
-            print(f"❌ Error searching SerpAPI [{engine}]: {e}"); continue
+            print(f"❌ Error searching SerpAPI [{engine}]: {e}"); return []
+        finally:
+            METRICS.inc("provider_calls_total", provider="serpapi", engine=engine, outcome=outcome)
+        cache.set(cache_key, data)
+    else:
+        METRICS.inc("provider_calls_total", provider="serpapi", engine=engine, outcome="cached")
+    record_fixture("serpapi", engine, query, data)
+    items, fetched_at = [], datetime.now()
+    for item in data.get("organic_results", []):
+        link = item.get("link","")
+        if not link: continue
+        result = Deal(item.get("title",""), item.get("snippet",""), link, f"SerpAPI ({engine})", fetched_at)
+        if is_high_quality_deal(result): items.append(result)
+    return items
+
+def merge_engine_results(per_engine: List[Tuple[str, List[Deal]]]) -> List[Deal]:
+    """Dedup one query's hits by link, earlier engines first."""
+    all_items, seen_links = [], set()
+    for engine, items in per_engine:
         engine_items = 0
-        for item in data.get("organic_results", []):
-            link = item.get("link","")
-            if not link or link in seen_links: continue
-            result = {"title":item.get("title",""),"snippet":item.get("snippet",""),"link":link,"source":f"SerpAPI ({engine})","timestamp":datetime.now().isoformat()}
-            if is_high_quality_deal(result):
-                result.update(extract_comprehensive_deal_details(result))
-                seen_links.add(link); all_items.append(result); engine_items += 1
+        for result in items:
+            if result.link in seen_links: continue
+            seen_links.add(result.link); all_items.append(result); engine_items += 1
         print(f"  ✅ {engine_items} high-quality deals from {engine}")
-        time.sleep(random.uniform(2,4))
     print(f"  📊 Total SerpAPI deals: {len(all_items)}")
     return all_items
 
-def search_tavily_enhanced(query: str) -> List[Dict]:
+def search_serpapi_enhanced(query: str) -> List[Deal]:
+    """Sequential, blocking variant of search_serpapi_async for one-off calls."""
+    if not SERPAPI_KEY:
+        print("⚠️  SerpAPI key not configured.")
+        return []
+    return merge_engine_results([(engine, fetch_serpapi_engine(query, engine)) for engine in SERPAPI_ENGINES])
+
+def search_tavily_enhanced(query: str) -> List[Deal]:
     if not TAVILY_API_KEY:
         print("⚠️  Tavily key not configured.")
         return []
-    print(f"-> Tavily: {query}")
-    url = "https://api.tavily.com/search"
     payload = {"api_key":TAVILY_API_KEY,"query":query,"search_depth":"advanced","include_answer":True,"max_results":25,"include_domains":list(DEAL_FOCUSED_STORES.keys()),"days":30}
-    try:
-        r = requests.post(url, json=payload, timeout=REQUEST_TIMEOUT); r.raise_for_status(); data = r.json()
-    except Exception as e:
-        print(f"❌ Error searching Tavily: {e}"); return []
-    items = []
+    cache, cache_key = get_search_cache(), search_cache_key("tavily", "tavily", payload)
+    data = cache.get(cache_key)
+    print(f"-> Tavily{' (cached)' if data is not None else ''}: {query}")
+    if data is None:
+        try:
+            with METRICS.span("provider_call", provider="tavily", engine="tavily"):
+                r = rate_limited_request("POST", TAVILY_URL, ("tavily",), json=payload, timeout=REQUEST_TIMEOUT)
+            r.raise_for_status(); data = r.json()
+        except Exception as e:
+            METRICS.inc("provider_calls_total", provider="tavily", engine="tavily", outcome="error")
+            print(f"❌ Error searching Tavily: {e}"); return []
+        METRICS.inc("provider_calls_total", provider="tavily", engine="tavily", outcome="ok")
+        cache.set(cache_key, data)
+    else:
+        METRICS.inc("provider_calls_total", provider="tavily", engine="tavily", outcome="cached")
+    record_fixture("tavily", "tavily", query, data)
+    items, fetched_at = [], datetime.now()
     answer = (data.get("answer","") or "").strip()
     if answer and len(answer) > 50:
-        ans_item = {"title": f"AI Summary: {query[:50]}...","snippet": answer[:500],"link":"N/A","source":"Tavily AI Summary","timestamp":datetime.now().isoformat()}
-        if is_high_quality_deal(ans_item):
-            ans_item.update(extract_comprehensive_deal_details(ans_item)); items.append(ans_item)
+        ans_item = Deal(f"AI Summary: {query[:50]}...", answer[:500], "N/A", "Tavily AI Summary", fetched_at)
+        if is_high_quality_deal(ans_item): items.append(ans_item)
     valid = 0
     for ritem in data.get("results", []):
-        item = {"title":ritem.get("title",""),"snippet":(ritem.get("content","") or "")[:600],"link":ritem.get("url",""),"source":"Tavily","timestamp":datetime.now().isoformat()}
-        if is_high_quality_deal(item):
-            item.update(extract_comprehensive_deal_details(item)); items.append(item); valid += 1
+        item = Deal(ritem.get("title",""), (ritem.get("content","") or "")[:600], ritem.get("url",""), "Tavily", fetched_at)
+        if is_high_quality_deal(item): items.append(item); valid += 1
     print(f"  ✅ {valid} high-quality Tavily deals")
     return items
 
-def ai_powered_deal_validation(deals: List[Dict]) -> List[Dict]:
+# ---------------- Async search fan-out ----------------
+class SearchLimiter:
+    """Per-provider and per-engine concurrency caps for blocking provider calls, run on executor."""
+
+    def __init__(self, executor):
+        self._executor = executor
+        self._sems: Dict[str, "asyncio.Semaphore"] = {}
+
+    def _sem(self, key: str, limit: int) -> "asyncio.Semaphore":
+        import asyncio
+        if key not in self._sems: self._sems[key] = asyncio.Semaphore(max(1, limit))
+        return self._sems[key]
+
+    async def run(self, provider: str, engine: str, fn: Callable, *args):
+        import asyncio
+        # Engine slot first: a call queued on a busy engine must not hold a provider slot other engines could use
+        async with self._sem(f"{provider}:{engine}", ENGINE_CONCURRENCY), self._sem(provider, SEARCH_CONCURRENCY[provider]):
+            ctx = contextvars.copy_context()  # as asyncio.to_thread does, so the call sees SEARCH_DEADLINE_AT
+            return await asyncio.get_running_loop().run_in_executor(self._executor, ctx.run, fn, *args)
+
+async def search_serpapi_async(query: str, limiter: SearchLimiter, engines: Optional[List[str]] = None) -> List[Deal]:
+    """All SerpAPI engines for one query at once; same dedup as search_serpapi_enhanced."""
+    import asyncio
+    if not SERPAPI_KEY: return []
+    engines = engines or SERPAPI_ENGINES
+    per_engine = await asyncio.gather(*(limiter.run("serpapi", engine, fetch_serpapi_engine, query, engine) for engine in engines))
+    return merge_engine_results(list(zip(engines, per_engine)))
+
+async def search_tavily_async(query: str, limiter: SearchLimiter) -> List[Deal]:
+    if not TAVILY_API_KEY: return []
+    return await limiter.run("tavily", "tavily", search_tavily_enhanced, query)
+
+async def search_all_async(queries: Dict[str, List[str]], emit: Callable[[List[Deal]], None], deadline: float = SEARCH_DEADLINE,
+                           on_query_done: Optional[Callable[[str, str, List[Deal], Optional[List[str]]], None]] = None) -> None:
+    """
+    Fan out every query to both providers concurrently and emit each query's hits
+    as soon as it finishes. Queries still pending at the deadline are cancelled,
+    and provider calls already running are abandoned rather than waited for.
+    """
+    import asyncio, concurrent.futures
+    SEARCH_DEADLINE_AT.set(time.monotonic() + deadline)
+    # Our own executor, not the loop's default one: asyncio.run joins the default
+    # executor on exit, which would block on every in-flight call and retry sleep
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=sum(SEARCH_CONCURRENCY.values()), thread_name_prefix="search")
+    limiter = SearchLimiter(executor)
+
+    async def tagged(provider: str, query: str, engines: Optional[List[str]], coro):
+        return provider, query, engines, await coro
+
+    engines = queries.get('serpapi_engines', {})
+    tasks = [asyncio.ensure_future(tagged("serpapi", q, engines.get(q), search_serpapi_async(q, limiter, engines.get(q)))) for q in queries.get('serpapi', [])]
+    tasks += [asyncio.ensure_future(tagged("tavily", q, None, search_tavily_async(q, limiter))) for q in queries.get('tavily', [])]
+    try:
+        for fut in asyncio.as_completed(tasks, timeout=deadline):
+            provider, query, query_engines, items = await fut
+            if on_query_done: on_query_done(provider, query, items, query_engines)
+            emit(items)
+    except asyncio.TimeoutError:
+        pending = sum(not t.done() for t in tasks)
+        print(f"⏰ Search deadline of {deadline:g}s reached, cancelling {pending} pending queries")
+    finally:
+        for t in tasks: t.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def validate_deal(deal: Deal, dbg: Optional[Dict[str, int]] = None) -> Optional[Deal]:
+    """Score one deal; returns it with ai_quality_score set, or None if it fails."""
+    dbg = dbg if dbg is not None else {"passed":0,"failed_gf":0,"failed_score":0}
+    feats = deal.features
+    if not feats.gf: dbg["failed_gf"] += 1; return None
+    quality = 3 * len(feats.strong - {"for_price"})  # "for $X" only scores in the quality check
+    quality += 2 * len(feats.signals & VALIDATION_SIGNAL_TERMS)
+    if feats.fresh - {"this week"}: quality += 2  # validation never counted "this week"
+    if deal.focused_store: quality += 3
+    deal.ai_quality_score = quality
+    if quality >= 2: dbg["passed"] += 1; return deal
+    dbg["failed_score"] += 1
+    return None
+
+def ai_powered_deal_validation(deals: List[Deal]) -> List[Deal]:
     print(f"🤖 AI-powered validation of {len(deals)} deals...")
     validated, dbg = [], {"passed":0,"failed_gf":0,"failed_score":0}
     for i, deal in enumerate(deals):
         try:
-            if not isinstance(deal, dict): continue
-            title = str(deal.get('title','') or ''); snippet = str(deal.get('snippet','') or ''); link = str(deal.get('link','') or '')
-            text = f"{title} {snippet}".lower()
-            if not any(kw.lower() in text for kw in GF_KEYWORDS): dbg["failed_gf"] += 1; continue
-            quality = 0
-            for pat in [r'\d+%\s*off', r'\$\d+\.?\d*\s*off', r'save\s*\$\d+', r'buy\s+\d+\s+get\s+\d+', r'printable coupon', r'digital coupon', r'free shipping', r'rebate', r'cashback']:
-                if re.search(pat, text, re.I): quality += 3
-            for sig in ["deal","sale","promotion","special","clearance","coupon","discount"]:
-                if sig in text: quality += 2
-            if any(k in text for k in ['today','current','active','new','latest', datetime.now().strftime('%B').lower()]): quality += 2
-            if any(d in link.lower() for d in DEAL_FOCUSED_STORES.keys()): quality += 3
-            deal["ai_quality_score"] = quality
-            if quality >= 2: validated.append(deal); dbg["passed"] += 1
-            else: dbg["failed_score"] += 1
+            if validate_deal(deal, dbg) is not None: validated.append(deal)
         except Exception as e:
             print(f"❌ Error validating deal #{i+1}: {e}")
-    validated.sort(key=lambda x: x.get("ai_quality_score",0), reverse=True)
+    validated.sort(key=lambda x: x.ai_quality_score, reverse=True)
     print(f" ✅ Validation complete: {dbg}")
     return validated
 
-def enhance_deal_metadata(deals: List[Dict]) -> List[Dict]:
-    enhanced = []
-    for deal in deals:
+def enhance_deal(deal: Deal) -> Optional[Deal]:
+    """Attach store, brand and category to one deal (in place)."""
+    try:
+        link, hits = deal.link, deal.hits
+        store = None
         try:
-            if not isinstance(deal, dict): continue
-            link = deal.get("link","") or ""; title = str(deal.get("title","") or ""); snippet = str(deal.get("snippet","") or ""); text = f"{title} {snippet}".lower()
-            store = "Unknown"
-            try:
-                if link.startswith(('http://','https://')):
-                    parsed = urlparse(link); domain = parsed.netloc.lower().replace("www.","")
-                    if domain in DOMAIN_TO_BRAND:
-                        store = DOMAIN_TO_BRAND[domain]
-                    else:
-                        parts = domain.split('.')
-                        if parts and parts[0] in DOMAIN_TO_BRAND:
-                            store = DOMAIN_TO_BRAND[parts[0]]
-                        else:
-                            for dk, bn in DOMAIN_TO_BRAND.items():
-                                if dk in domain or dk in link.lower(): store = bn; break
-                            if store == "Unknown":
-                                for sn in ['target','walmart','kroger','costco','amazon','whole foods']:
-                                    if sn in text: store = sn.title(); break
-            except Exception as e:
-                print(f"⚠️ Error parsing URL {link}: {e}")
-            deal["store"] = store
-
-            brand = deal.get("brand","Multiple/Various")
-            if brand == "Multiple/Various":
-                brand = store if store != "Unknown" else "Multiple/Various"
-                for bn in enhanced_brands:
-                    if bn.lower() in text: brand = bn; break
-            deal["brand"] = brand
-
-            food_terms = ['snack','food','meal','cookie','cracker','bread','pizza']
-            frozen_terms = ['frozen','ice cream','entree']
-            deal["category"] = "Food" if any(t in text for t in food_terms) else ("Frozen" if any(t in text for t in frozen_terms) else "General")
-            enhanced.append(deal)
+            if link.startswith(('http://','https://')):
+                store = DOMAIN_RESOLVER.resolve_url(link)
+                if not store:
+                    for sn in TEXT_STORE_NAMES:
+                        if sn in hits["store"]: store = sn.title(); break
         except Exception as e:
-            print(f"❌ Error enhancing deal: {e}")
-            deal.setdefault("store","Unknown"); deal.setdefault("brand","Multiple/Various"); deal.setdefault("category","General")
-            enhanced.append(deal)
+            print(f"⚠️ Error parsing URL {link}: {e}")
+        deal.store = store
+
+        if deal.brand is None:
+            brand = store
+            for bn in enhanced_brands:
+                if bn.lower() in hits["brand"]: brand = bn; break
+            deal.brand = brand
+
+        deal.category = "Food" if hits["food"] else ("Frozen" if hits["frozen"] else "General")
+        return deal
+    except Exception as e:
+        print(f"❌ Error enhancing deal: {e}")
+        return deal
+
+def enhance_deal_metadata(deals: List[Deal]) -> List[Deal]:
+    enhanced = []
+    for deal in deals:
+        deal = enhance_deal(deal)
+        if deal is not None: enhanced.append(deal)
     return enhanced
 
-def is_real_deal(item: Dict) -> bool:
+def is_real_deal(item: Deal) -> bool:
     """Enhanced real deal detection with better filtering"""
-    link = item.get("link","") or ""
-    title = str(item.get("title","")).lower()
-    snippet = str(item.get("snippet","")).lower()
-    text = f"{title} {snippet}"
-    
     # Must have valid HTTP link
-    if not link.startswith(("http://","https://")): return False
+    if not item.link.startswith(("http://","https://")): return False
     
+    hits = item.hits
     # Must contain GF keywords (more flexible)
-    gf_keywords = [
-        "gluten free", "gluten-free", "gf", "celiac", "wheat free", 
-        "gluten conscious", "gluten sensitive"
-    ]
-    if not any(kw in text for kw in gf_keywords): return False
+    if not hits["real_gf"]: return False
     
     # Must contain deal indicators (more flexible)
-    deal_keywords = [
-        "coupon", "promo", "discount", "save", "off", "deal", "sale", 
-        "special", "offer", "rebate", "cashback", "bogo", "free shipping",
-        "clearance", "promotion", "code"
-    ]
-    if not any(kw in text for kw in deal_keywords): return False
+    if not hits["real_deal"]: return False
     
     # Filter out obvious non-shopping content
-    exclude_patterns = [
-        "recipe", "how to make", "what is gluten", "gluten intolerance symptoms",
-        "celiac disease diagnosis", "gluten free diet tips", "restaurant review",
-        "blog about", "article about", "guide to", "understanding celiac"
-    ]
-    if any(pattern in text for pattern in exclude_patterns): return False
+    if hits["non_shopping"]: return False
     
     return True
 
-def final_relevance_filter(deals: List[Dict]) -> List[Dict]:
-    """Smart final filter to remove irrelevant content while keeping good deals"""
-    print(f"🎯 Final relevance filter: Processing {len(deals)} deals...")
-    
-    filtered_deals = []
-    filter_stats = {"kept": 0, "removed_blogs": 0, "removed_info": 0, "removed_expired": 0, "removed_spam": 0}
-    
-    for deal in deals:
-        try:
-            title = str(deal.get("title", "")).lower()
-            snippet = str(deal.get("snippet", "")).lower()  
-            link = str(deal.get("link", "")).lower()
-            text = f"{title} {snippet}"
-            
-            should_remove = False
-            removal_reason = ""
-            
-            # Remove blogs and informational content (not deals)
-            blog_indicators = [
-                "blog", "article", "post", "guide to", "how to", "what is", 
-                "understanding", "living with", "tips for", "managing celiac",
-                "gluten free lifestyle", "celiac awareness", "gluten sensitivity guide"
-            ]
-            if any(indicator in text for indicator in blog_indicators) and not any(deal_word in text for deal_word in ["coupon", "discount", "sale", "promo", "deal", "offer"]):
-                should_remove = True
-                removal_reason = "blog_content"
-            
-            # Remove informational/educational content  
-            info_indicators = [
-                "what is celiac", "gluten intolerance symptoms", "diagnosis", 
-                "gluten free diet benefits", "celiac disease facts",
-                "gluten sensitivity explained", "wheat allergy vs"
-            ]
-            if any(indicator in text for indicator in info_indicators):
-                should_remove = True  
-                removal_reason = "educational_content"
-            
-            # Remove clearly expired or invalid deals
-            expired_indicators = [
-                "expired", "ended", "no longer valid", "promotion closed",
-                "offer has ended", "deal expired", "sale ended", "coupon expired"
-            ]
-            if any(indicator in text for indicator in expired_indicators):
-                should_remove = True
-                removal_reason = "expired_deal"
-            
-            # Remove spam/clickbait content
-            spam_indicators = [
-                "you won't believe", "amazing secret", "doctors hate", 
-                "one weird trick", "shocking truth", "incredible discovery",
-                "miracle cure", "secret formula", "lose weight fast"
-            ]
-            if any(indicator in text for indicator in spam_indicators):
-                should_remove = True
-                removal_reason = "spam_content"
-            
-            # Remove non-shopping domains (keep if they have strong deal indicators)
-            non_shopping_domains = ["wikipedia", "webmd", "healthline", "mayoclinic", "celiac.org"]
-            strong_deal_indicators = ["coupon code", "promo code", "% off", "$ off", "free shipping", "bogo"]
-            
-            is_non_shopping = any(domain in link for domain in non_shopping_domains)
-            has_strong_deal = any(indicator in text for indicator in strong_deal_indicators)
+def new_relevance_stats() -> Dict[str, int]:
+    return {"kept": 0, "removed_blogs": 0, "removed_info": 0, "removed_expired": 0, "removed_spam": 0}
+
+def is_relevant_deal(deal: Deal, filter_stats: Optional[Dict[str, int]] = None) -> bool:
+    """Final relevance check for one deal; tags source_boost on kept deals from good domains."""
+    filter_stats = filter_stats if filter_stats is not None else new_relevance_stats()
+    try:
+        link = deal.link.lower()
+        hits = deal.hits
+        
+        should_remove = False
+        removal_reason = ""
+        
+        # Remove blogs and informational content (not deals)
+        if hits["blog"] and not hits["blog_deal"]:
+            should_remove = True
+            removal_reason = "blog_content"
+        
+        # Remove informational/educational content  
+        if hits["info"]:
+            should_remove = True  
+            removal_reason = "educational_content"
+        
+        # Remove clearly expired or invalid deals
+        expires_on = deal.expires_on
+        if hits["expired"] or (expires_on and expires_on < date.today()):
+            should_remove = True
+            removal_reason = "expired_deal"
+        
+        # Remove spam/clickbait content
+        if hits["spam"]:
+            should_remove = True
+            removal_reason = "spam_content"
+        
+        # Remove non-shopping domains (keep if they have strong deal indicators)
+        non_shopping_domains = ["wikipedia", "webmd", "healthline", "mayoclinic", "celiac.org"]
+        
+        is_non_shopping = any(domain in link for domain in non_shopping_domains)
+        
+        if is_non_shopping and not hits["strong_deal"]:
+            should_remove = True
+            removal_reason = "non_shopping_domain"
+        
+        # Keep the deal if it passes all filters
+        if not should_remove:
+            # Boost deals from known good sources
+            good_domains = ["target.com", "walmart.com", "kroger.com", "costco.com", "amazon.com", 
+                           "bobsredmill.com", "schar.com", "enjoylifefoods.com", "slickdeals.net", 
+                           "retailmenot.com", "coupons.com"]
             
-            if is_non_shopping and not has_strong_deal:
-                should_remove = True
-                removal_reason = "non_shopping_domain"
+            if any(domain in link for domain in good_domains):
+                deal.source_boost = True
             
-            # Keep the deal if it passes all filters
-            if not should_remove:
-                # Boost deals from known good sources
-                good_domains = ["target.com", "walmart.com", "kroger.com", "costco.com", "amazon.com", 
-                               "bobsredmill.com", "schar.com", "enjoylifefoods.com", "slickdeals.net", 
-                               "retailmenot.com", "coupons.com"]
-                
-                if any(domain in link for domain in good_domains):
-                    deal["source_boost"] = True
+            filter_stats["kept"] += 1
+            return True
+        else:
+            # Track removal reasons
+            if removal_reason == "blog_content":
+                filter_stats["removed_blogs"] += 1
+            elif removal_reason in ["educational_content", "non_shopping_domain"]:
+                filter_stats["removed_info"] += 1
+            elif removal_reason == "expired_deal":
+                filter_stats["removed_expired"] += 1 
+            elif removal_reason == "spam_content":
+                filter_stats["removed_spam"] += 1
                 
-                filtered_deals.append(deal)
-                filter_stats["kept"] += 1
-            else:
-                # Track removal reasons
-                if removal_reason == "blog_content":
-                    filter_stats["removed_blogs"] += 1
-                elif removal_reason in ["educational_content", "non_shopping_domain"]:
-                    filter_stats["removed_info"] += 1
-                elif removal_reason == "expired_deal":
-                    filter_stats["removed_expired"] += 1 
-                elif removal_reason == "spam_content":
-                    filter_stats["removed_spam"] += 1
-                    
-        except Exception as e:
-            print(f"⚠️ Error in final filter: {e}")
-            filtered_deals.append(deal)  # Keep if error processing
+    except Exception as e:
+        print(f"⚠️ Error in final filter: {e}")
+        return True  # Keep if error processing
+    return False
+
+def final_relevance_filter(deals: List[Deal]) -> List[Deal]:
+    """Smart final filter to remove irrelevant content while keeping good deals"""
+    print(f"🎯 Final relevance filter: Processing {len(deals)} deals...")
+    
+    filter_stats = new_relevance_stats()
+    filtered_deals = [deal for deal in deals if is_relevant_deal(deal, filter_stats)]
     
     print(f"📊 Final filter results: {filter_stats}")
     print(f"✅ Kept {len(filtered_deals)} relevant deals ({len(filtered_deals)/len(deals)*100:.1f}%)")
     
     return filtered_deals
 
+# ---------------- Near-duplicate clustering ----------------
+TRACKING_PARAMS = frozenset([
+    "gclid", "fbclid", "msclkid", "dclid", "yclid", "srsltid", "mc_cid", "mc_eid", "ref", "ref_", "referrer",
+    "affiliate", "aff_id", "affid", "clickid", "irclickid", "cjevent", "sscid", "ranmid", "raneaid", "ransiteid",
+])
+
+def canonicalize_url(link: str) -> str:
+    """Lowercase host without www/default port/fragment, tracking params dropped, no trailing slash."""
+    if not link or not link.startswith(("http://", "https://")): return link or ""
+    try:
+        p = urlparse(link)
+        port = p.port
+    except ValueError:
+        return link
+    host = (p.hostname or "").lower()
+    if host.startswith("www."): host = host[4:]
+    if port and port not in (80, 443): host = f"{host}:{port}"
+    params = sorted((k, v) for k, v in parse_qsl(p.query, keep_blank_values=True)
+                    if not k.lower().startswith("utm_") and k.lower() not in TRACKING_PARAMS)
+    path = p.path.rstrip("/") if p.path not in ("", "/") else ""
+    return urlunparse(("https", host, path, "", urlencode(params), ""))
+
+MINHASH_BANDS, MINHASH_ROWS = 8, 4  # 32 hashes; a 0.8-Jaccard pair shares a band ~98% of the time
+_MINHASH_MASKS = [int(hashlib.sha1(f"minhash-{i}".encode()).hexdigest()[:16], 16) for i in range(MINHASH_BANDS * MINHASH_ROWS)]
+LSH_BUCKET_COMPARE_CAP = 20
+
+def text_shingles(text: str, k: int = 3) -> frozenset:
+    words = re.findall(r"[a-z0-9$%]+", text)
+    if len(words) < k: return frozenset([" ".join(words)]) if words else frozenset()
+    return frozenset(" ".join(words[i:i + k]) for i in range(len(words) - k + 1))
+
+def minhash_signature(shingles: frozenset) -> Tuple[int, ...]:
+    hashes = [int.from_bytes(hashlib.blake2b(sh.encode("utf-8"), digest_size=8).digest(), "big") for sh in shingles]
+    return tuple(min(map(mask.__xor__, hashes)) for mask in _MINHASH_MASKS)
+
+def _deal_rank(deal: Deal) -> Tuple:
+    # link last so ties don't depend on which search finished first
+    return (deal.ai_quality_score, deal.source_boost, deal.features.coupon_code is not None, len(deal.snippet), deal.link)
+
+def dedupe_deals(deals: Iterable[Deal], stats: Optional[Dict[str, int]] = None) -> List[Deal]:
+    """
+    Cluster deals across queries/engines/providers: same canonical URL, or
+    near-identical title+snippet via MinHash LSH (candidates confirmed with exact
+    shingle Jaccard). Within a cluster keep the best-ranked deal per
+    (store, coupon_code, discount_amount). Each LSH bucket is checked against at
+    most LSH_BUCKET_COMPARE_CAP members, so cost stays roughly linear.
+    """
+    stats = stats if stats is not None else {}
+    items: List[Deal] = []
+    parent: List[int] = []
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]; i = parent[i]
+        return i
+
+    def union(a: int, b: int) -> None:
+        ra, rb = find(a), find(b)
+        if ra != rb: parent[max(ra, rb)] = min(ra, rb)
+
+    by_url: Dict[str, int] = {}
+    buckets: Dict[Tuple[int, Tuple[int, ...]], List[int]] = {}
+    shingles: List[frozenset] = []
+    sigs: Dict[str, Tuple[frozenset, Optional[Tuple[int, ...]]]] = {}  # exact repeats across engines hash once
+    for deal in deals:
+        i = len(items); items.append(deal); parent.append(i)
+        url = canonicalize_url(deal.link)
+        if url.startswith("https://"):
+            if url in by_url: union(i, by_url[url])
+            else: by_url[url] = i
+        text = deal.text
+        if text not in sigs: sigs[text] = (text_shingles(text), None)
+        sh, sig = sigs[text]; shingles.append(sh)
+        if not sh: continue
+        if sig is None: sig = minhash_signature(sh); sigs[text] = (sh, sig)
+        for band in range(MINHASH_BANDS):
+            members = buckets.setdefault((band, sig[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS]), [])
+            for j in members[:LSH_BUCKET_COMPARE_CAP]:
+                if find(i) == find(j): break
+                if len(sh & shingles[j]) / len(sh | shingles[j]) >= DEDUP_JACCARD_THRESHOLD:
+                    union(i, j); break
+            members.append(i)
+
+    best: Dict[Tuple, int] = {}
+    for i, deal in enumerate(items):
+        key = (find(i), deal.store, deal.features.coupon_code, deal.features.discount_amount)
+        if key not in best or _deal_rank(deal) > _deal_rank(items[best[key]]): best[key] = i
+    keep = sorted(best.values())
+    stats.update({"in": len(items), "clusters": len({find(i) for i in range(len(items))}), "kept": len(keep), "dropped": len(items) - len(keep)})
+    return [items[i] for i in keep]
+
+# ---------------- LLM review ----------------
+# Optional second opinion (LLM_REVIEW=1) on deals whose heuristic score sits in the
+# uncertain band. Deals go out dozens per prompt with JSON output; verdicts are
+# cached by content so a deal already judged is never sent again.
+LLM_REVIEW = os.getenv("LLM_REVIEW", "0") == "1"
+LLM_REVIEW_MODEL = os.getenv("LLM_REVIEW_MODEL", "gpt-3.5-turbo")
+LLM_REVIEW_BAND = (int(os.getenv("LLM_REVIEW_MIN_SCORE", "2")), int(os.getenv("LLM_REVIEW_MAX_SCORE", "5")))
+LLM_REVIEW_BATCH_SIZE = int(os.getenv("LLM_REVIEW_BATCH_SIZE", "40"))
+LLM_REVIEW_MAX_BATCHES = int(os.getenv("LLM_REVIEW_MAX_BATCHES", "10"))  # per run; 0 = unlimited
+LLM_REVIEW_CONCURRENCY = int(os.getenv("LLM_REVIEW_CONCURRENCY", "4"))
+LLM_REVIEW_MIN_CONFIDENCE = float(os.getenv("LLM_REVIEW_MIN_CONFIDENCE", "0.6"))  # weaker rejections keep the heuristic verdict
+LLM_REVIEW_TTL = float(os.getenv("LLM_REVIEW_TTL_SECONDS", str(30 * 86400)))
+LLM_REVIEW_PROMPT_VERSION = 1  # bump when the prompt changes so cached verdicts are not reused
+
+LLM_REVIEW_SYSTEM_PROMPT = (
+    "You review web search results for a gluten-free deals app. For each item decide whether it is a real, "
+    "currently usable shopping deal (coupon, promo code, sale, rebate, BOGO, free shipping) on gluten-free "
+    "products, as opposed to a recipe, article, product page without an offer, expired offer or spam. "
+    'Reply with JSON only: {"verdicts": [{"id": <item id>, "keep": true|false, "confidence": <0-1>, '
+    '"store": <retailer or null>, "brand": <product brand or null>}]}, one verdict per item.'
+)
+
+_REVIEW_STORES = {n.lower(): n for n in [*DEAL_FOCUSED_STORES.values(), *DOMAIN_TO_BRAND.values()]}
+_REVIEW_BRANDS = {n.lower(): n for n in [*enhanced_brands, *DOMAIN_TO_BRAND.values()]}
+
+def verdict_key(deal: Deal) -> str:
+    raw = f"v{LLM_REVIEW_PROMPT_VERSION}|{LLM_REVIEW_MODEL}|{canonicalize_url(deal.link)}|{deal.title}|{deal.snippet}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def review_fixture_query(prompt: str) -> str:
+    """Fixture key for one review batch (bench.py answers the same key)."""
+    return "deal-review-" + hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:16]
+
+def in_review_band(deal: Deal) -> bool:
+    return LLM_REVIEW_BAND[0] <= deal.ai_quality_score <= LLM_REVIEW_BAND[1]
+
+def _parse_verdict(raw) -> Optional[Dict]:
+    if not isinstance(raw, dict) or not isinstance(raw.get("keep"), bool): return None
+    try:
+        confidence = min(1.0, max(0.0, float(raw.get("confidence", 0))))
+    except (TypeError, ValueError):
+        confidence = 0.0
+    store, brand = (raw.get(k) if isinstance(raw.get(k), str) else None for k in ("store", "brand"))
+    return {"keep": raw["keep"], "confidence": confidence, "store": store, "brand": brand}
+
+def review_batch(deals: List[Deal]) -> Dict[int, Dict]:
+    """One chat-completions call for a batch; verdicts by position, malformed entries left out."""
+    items = [{"id": i, "title": d.title[:200], "snippet": d.snippet[:400], "link": d.link} for i, d in enumerate(deals)]
+    prompt = json.dumps({"items": items}, ensure_ascii=False)
+    with METRICS.span("llm_review", model=LLM_REVIEW_MODEL):
+        resp = get_openai_client().chat.completions.create(
+            model=LLM_REVIEW_MODEL,
+            messages=[
+                {"role":"system","content":LLM_REVIEW_SYSTEM_PROMPT},
+                {"role":"user","content":prompt}
+            ],
+            response_format={"type": "json_object"}, temperature=0, max_tokens=40 * len(deals) + 100
+        )
+    content = resp.choices[0].message.content or ""
+    record_fixture("openai", LLM_REVIEW_MODEL, review_fixture_query(prompt), {"content": content})
+    verdicts: Dict[int, Dict] = {}
+    for raw in json.loads(content).get("verdicts") or []:
+        vid = raw.get("id") if isinstance(raw, dict) else None
+        verdict = _parse_verdict(raw)
+        if isinstance(vid, int) and 0 <= vid < len(deals) and verdict: verdicts[vid] = verdict
+    return verdicts
+
+def apply_verdict(deal: Deal, verdict: Dict) -> bool:
+    """True to keep. Accepted deals are marked and get store/brand filled from known names only."""
+    if not verdict["keep"]: return verdict["confidence"] < LLM_REVIEW_MIN_CONFIDENCE
+    deal.llm_verified = True
+    if not deal.store: deal.store = _REVIEW_STORES.get((verdict.get("store") or "").lower())
+    if not deal.brand: deal.brand = _REVIEW_BRANDS.get((verdict.get("brand") or "").lower()) or deal.store
+    return True
+
+def llm_review_deals(deals: List[Deal], stats: Optional[Dict[str, int]] = None) -> List[Deal]:
+    """
+    Send deals scored inside LLM_REVIEW_BAND to the LLM in batches of
+    LLM_REVIEW_BATCH_SIZE (at most LLM_REVIEW_MAX_BATCHES calls per run), reusing
+    cached verdicts first. Deals without a verdict (call failed, over budget,
+    missing from the reply) keep the heuristic decision.
+    """
+    import concurrent.futures
+    stats = stats if stats is not None else {}
+    stats.update(dict.fromkeys(("candidates", "cached", "sent", "batches", "errors", "kept", "dropped", "unreviewed"), 0))
+    cache = open_cache("llm_verdicts", LLM_REVIEW_TTL, max_entries=20000)
+    verdicts: Dict[str, Dict] = {}
+    pending: Dict[str, Deal] = {}
+    keys: Dict[int, str] = {}
+    for i, deal in enumerate(deals):
+        if not in_review_band(deal): continue
+        stats["candidates"] += 1
+        key = keys[i] = verdict_key(deal)
+        if key in verdicts or key in pending: continue
+        hit = cache.get(key)
+        if hit is not None: verdicts[key] = hit; stats["cached"] += 1
+        else: pending[key] = deal
+
+    todo = list(pending.items())
+    batches = [todo[j:j + LLM_REVIEW_BATCH_SIZE] for j in range(0, len(todo), max(1, LLM_REVIEW_BATCH_SIZE))]
+    if LLM_REVIEW_MAX_BATCHES: batches = batches[:LLM_REVIEW_MAX_BATCHES]
+
+    def run(batch):
+        try:
+            return batch, review_batch([deal for _, deal in batch])
+        except Exception as e:
+            print(f"⚠️ LLM review batch of {len(batch)} failed: {e}")
+            return batch, None
+
+    if batches:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, LLM_REVIEW_CONCURRENCY)) as pool:
+            for batch, result in pool.map(run, batches):
+                stats["batches"] += 1
+                if result is None: stats["errors"] += 1; continue
+                stats["sent"] += len(batch)
+                for j, (key, _) in enumerate(batch):
+                    if j in result: verdicts[key] = result[j]; cache.set(key, result[j])
+
+    out = []
+    for i, deal in enumerate(deals):
+        verdict = verdicts.get(keys[i]) if i in keys else None
+        if verdict is None:
+            if i in keys: stats["unreviewed"] += 1
+            out.append(deal)
+        elif apply_verdict(deal, verdict):
+            stats["kept"] += 1; out.append(deal)
+        else:
+            stats["dropped"] += 1
+    for outcome in ("kept", "dropped", "unreviewed"):
+        METRICS.inc("llm_review_total", stats[outcome], outcome=outcome)
+    return out
+
+# ---------------- Seen-deal index ----------------
+# Results come back run after run. For each one already pushed through the
+# per-deal stages (keyed by canonical link + title/snippet hash) the index keeps
+# the outcome: the stage that dropped it, or the fields the stages set. A known
+# result skips the keyword scan and the stages; a kept one only re-checks its
+# expiry date. Each entry also keeps the day the result was first seen, which
+# relative expiry phrases count from and which outlives a version change.
+# The index is a single compressed blob (a local file, or part
+# docs in Firestore) loaded on first lookup and saved once per run. Its version
+# folds in the keyword and domain lists, so editing them starts it afresh, and
+# the current month, since scores count the month name as a freshness term;
+# bump SEEN_INDEX_VERSION for logic changes.
+SEEN_INDEX_VERSION = 2
+SEEN_INDEX_COLLECTION = "gf_seen_index"
+SEEN_INDEX_PART_BYTES = 900_000  # Firestore docs max out at 1 MiB
+
+class SeenDealIndex:
+    def __init__(self, backend: str = SEEN_INDEX):
+        self.backend = backend
+        self.version = hashlib.sha1(json.dumps([SEEN_INDEX_VERSION, date.today().strftime('%Y-%m'), KEYWORD_INDEX.fingerprint, DOMAIN_TO_BRAND,
+                                                DEAL_FOCUSED_STORES, enhanced_brands, TEXT_STORE_NAMES], sort_keys=True).encode("utf-8")).hexdigest()[:16]
+        self.entries: Optional[Dict[str, Dict]] = None
+        self.touched: Dict[str, Dict] = {}  # entries recorded or seen this run
+        self.stats = {"loaded": 0, "reused": 0, "dropped": 0, "misses": 0}
+        self.today = int(time.time())
+
+    @staticmethod
+    def key(deal: Deal) -> str:
+        text_hash = hashlib.sha1(f"{deal.title}\n{deal.snippet}".encode("utf-8")).hexdigest()
+        return hashlib.sha1(f"{canonicalize_url(deal.link)}|{text_hash}".encode("utf-8")).hexdigest()[:20]
+
+    def _load(self) -> Dict[str, Dict]:
+        if self.entries is None:
+            try:
+                blob = self._read()
+                data = json.loads(zlib.decompress(blob)) if blob else {}
+            except Exception as e:
+                print(f"⚠️ Seen-deal index unreadable, starting empty: {e}"); data = {}
+            self.entries = data.get("entries", {})
+            if data.get("version") != self.version:  # outcomes are stale; first-seen days are not
+                self.entries = {k: {"t": e["t"], "first": e["first"]} for k, e in self.entries.items() if "first" in e}
+            self.stats["loaded"] = len(self.entries)
+        return self.entries
+
+    def lookup(self, key: str, deal: Deal) -> Optional[Deal]:
+        """None on a miss; else the deal with its stored outcome applied, or False if it was dropped."""
+        entry = self.touched.get(key) or self._load().get(key)
+        if entry and entry.get("first"): deal.seen_on = date.fromisoformat(entry["first"])
+        if entry is None or "drop" not in entry and "score" not in entry:
+            self.stats["misses"] += 1; return None
+        if "drop" not in entry:
+            deal.store, deal.brand, deal.category = entry["store"], entry["brand"], entry["category"]
+            deal.ai_quality_score, deal.source_boost = entry["score"], entry["boost"]
+            expires_on = deal.expires_on
+            if expires_on and expires_on < date.today(): entry = {"first": entry.get("first"), "drop": "relevance"}
+        self.touched[key] = {**entry, "t": self.today}
+        self.stats["dropped" if "drop" in entry else "reused"] += 1
+        return False if "drop" in entry else deal
+
+    def record(self, key: str, deal: Optional[Deal], dropped_at: Optional[str] = None) -> None:
+        first = (self.touched.get(key) or self._load().get(key) or {}).get("first")
+        first = first or ((deal.seen_on or deal.fetched_at.date()) if deal else date.today()).isoformat()
+        if deal is None:
+            self.touched[key] = {"t": self.today, "first": first, "drop": dropped_at}
+            return
+        deal.seen_on = date.fromisoformat(first)
+        self.touched[key] = {"t": self.today, "first": first, "store": deal.store, "brand": deal.brand,
+                             "category": deal.category, "score": deal.ai_quality_score, "boost": deal.source_boost}
+
+    def merge(self, entries: Dict[str, Dict], stats: Dict[str, int]) -> None:
+        """Fold in what a shard worker recorded."""
+        self.touched.update(entries)
+        for k in ("reused", "dropped", "misses"): self.stats[k] += stats.get(k, 0)
+
+    def save(self) -> None:
+        if not self.touched: return
+        cutoff = time.time() - SEEN_INDEX_TTL
+        entries = {k: e for k, e in {**self._load(), **self.touched}.items() if e.get("t", 0) >= cutoff}
+        if len(entries) > SEEN_INDEX_MAX_ENTRIES:
+            entries = dict(sorted(entries.items(), key=lambda kv: kv[1]["t"], reverse=True)[:SEEN_INDEX_MAX_ENTRIES])
+        self._write(zlib.compress(json.dumps({"version": self.version, "entries": entries}, separators=(",", ":")).encode("utf-8")))
+        print(f"👁️  Seen-deal index saved: {len(entries)} entries ({len(self.touched)} touched this run)")
+
+    def _read(self) -> Optional[bytes]:
+        if self.backend == "local":
+            if not os.path.exists(SEEN_INDEX_PATH): return None
+            with open(SEEN_INDEX_PATH, "rb") as f: return f.read()
+        coll = get_firestore_client().collection(SEEN_INDEX_COLLECTION)
+        manifest = coll.document("manifest").get()
+        if not manifest.exists: return None
+        parts = [coll.document(f"part-{i}").get() for i in range((manifest.to_dict() or {}).get("parts", 0))]
+        return b"".join((p.to_dict() or {})["data"] for p in parts)
+
+    def _write(self, blob: bytes) -> None:
+        if self.backend == "local":
+            tmp = f"{SEEN_INDEX_PATH}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f: f.write(blob)
+            os.replace(tmp, SEEN_INDEX_PATH)
+            return
+        db = get_firestore_client()
+        coll = db.collection(SEEN_INDEX_COLLECTION)
+        parts = [blob[i:i + SEEN_INDEX_PART_BYTES] for i in range(0, len(blob), SEEN_INDEX_PART_BYTES)]
+        for i, part in enumerate(parts): coll.document(f"part-{i}").set({"data": part})
+        coll.document("manifest").set({"parts": len(parts), "version": self.version, "savedAt": datetime.utcnow()})
+
+def open_seen_index() -> Optional[SeenDealIndex]:
+    return SeenDealIndex() if SEEN_INDEX in ("local", "firestore") else None
+
 # ---------------- Main pipeline ----------------
-def main() -> List[Dict]:
+# Each stage takes one deal and returns it (possibly enriched) or None to drop it.
+DealStage = Tuple[str, Callable[[Deal], Optional[Deal]]]
+
+def filter_stage(name: str, predicate: Callable[[Deal], bool]) -> DealStage:
+    return name, (lambda deal: deal if predicate(deal) else None)
+
+def run_deal_pipeline(items: Iterable[Deal], stages: List[DealStage], stats: Dict[str, Dict[str, int]],
+                      seen: Optional[SeenDealIndex] = None) -> Iterator[Deal]:
+    """
+    Stream items through the stages one at a time, yielding survivors as soon as
+    they clear the last stage. Per-stage in/dropped counters and summed seconds
+    go into stats and, once the input is exhausted, into METRICS as "stage.<name>".
+    With a seen-deal index, known results are settled by a "seen" step instead
+    and new outcomes are recorded into it.
+    """
+    names = (["seen"] if seen else []) + [name for name, _ in stages]
+    for name in names:
+        stats.setdefault(name, {"in": 0, "dropped": 0, "seconds": 0.0})
+    for item in items:
+        key, known = _seen_lookup(seen, item, stats)
+        if known is not None:
+            if known: yield known
+            continue
+        item, dropped_at, failed = _run_stages(item, stages, stats)
+        if key and not failed: seen.record(key, item, dropped_at)
+        if dropped_at is None: yield item
+    _record_stage_metrics(names, stats)
+
+def _seen_lookup(seen: Optional[SeenDealIndex], item: Deal, stats: Dict[str, Dict[str, int]]) -> Tuple[Optional[str], Optional[Deal]]:
+    """(key, known) for the "seen" step; known is None when the stages still have to run."""
+    if not seen: return None, None
+    st = stats["seen"]
+    st["in"] += 1
+    start = time.perf_counter()
+    key = seen.key(item)
+    known = seen.lookup(key, item)
+    st["seconds"] += time.perf_counter() - start
+    if known is False: st["dropped"] += 1
+    return key, known
+
+def _run_stages(item: Deal, stages: List[DealStage], stats: Dict[str, Dict[str, int]]) -> Tuple[Optional[Deal], Optional[str], bool]:
+    """(deal or None, stage that dropped it, whether a stage raised) for one item."""
+    clock = time.perf_counter
+    for name, fn in stages:
+        st = stats[name]
+        st["in"] += 1
+        start = clock()
+        try:
+            item = fn(item)
+        except Exception as e:
+            print(f"❌ Error in {name} stage: {e}")
+            st["seconds"] += clock() - start; st["dropped"] += 1
+            return None, name, True
+        st["seconds"] += clock() - start
+        if item is None:
+            st["dropped"] += 1
+            return None, name, False
+    return item, None, False
+
+def _record_stage_metrics(names: List[str], stats: Dict[str, Dict[str, int]]) -> None:
+    for name in names:
+        st = stats[name]
+        st["seconds"] = round(st["seconds"], 4)
+        METRICS.record_span(f"stage.{name}", st["seconds"], count=st["in"])
+        METRICS.inc("stage_items_total", st["in"] - st["dropped"], stage=name, outcome="kept")
+        METRICS.inc("stage_items_total", st["dropped"], stage=name, outcome="dropped")
+
+def default_deal_stages(validation_stats: Dict[str, int], relevance_stats: Dict[str, int], quality: bool = False) -> List[DealStage]:
+    """quality=True adds the fetch-time high-quality gate up front, for raw hits that skipped it (reprocessing)."""
+    stages = [
+        filter_stage("real_deal", is_real_deal),
+        ("validate", lambda d: validate_deal(d, validation_stats)),
+        ("enhance", enhance_deal),
+        filter_stage("relevance", lambda d: is_relevant_deal(d, relevance_stats)),
+    ]
+    return [filter_stage("quality", is_high_quality_deal)] + stages if quality else stages
+
+# ---------------- Process-pool stages ----------------
+# STAGE_EXECUTOR=process moves the CPU-bound per-deal stages (keyword scan,
+# scoring, extraction) off the main thread onto a spawned process pool, so
+# large batches use every core. Fetches stay on the search loop's I/O threads,
+# and the seen-deal index stays in the parent. Deals travel as Deal.to_row()
+# tuples, STAGE_CHUNK_SIZE per task, with their feature record attached both
+# ways so neither side repeats a scan the other already did.
+def run_stage_chunk(rows: List[Tuple], quality: bool = False) -> Tuple[List, Dict, Dict, Dict]:
+    """Pool task: the default stages over one chunk. Per row: a kept row, the dropping stage's name, or None if a stage raised."""
+    stats: Dict[str, Dict[str, int]] = {}
+    validation_stats = {"passed":0,"failed_gf":0,"failed_score":0}
+    relevance_stats = new_relevance_stats()
+    stages = default_deal_stages(validation_stats, relevance_stats, quality)
+    for name, _ in stages: stats[name] = {"in": 0, "dropped": 0, "seconds": 0.0}
+    out: List = []
+    for row in rows:
+        deal, dropped_at, failed = _run_stages(Deal.from_row(row), stages, stats)
+        out.append(None if failed else dropped_at or deal.to_row(features=True))
+    return out, stats, validation_stats, relevance_stats
+
+def run_deal_pipeline_pool(items: Iterable[Deal], stats: Dict[str, Dict[str, int]], validation_stats: Dict[str, int],
+                           relevance_stats: Dict[str, int], seen: Optional[SeenDealIndex] = None, quality: bool = False,
+                           workers: int = STAGE_WORKERS, chunk_size: int = STAGE_CHUNK_SIZE) -> Iterator[Deal]:
+    """
+    run_deal_pipeline with the default stages on a process pool. At most two
+    chunks per worker are in flight, so memory stays flat on long streams, and
+    chunk results come back in input order. Stage seconds are summed across
+    workers (CPU time, not wall time).
+    """
+    import collections, multiprocessing, concurrent.futures
+    workers = workers or os.cpu_count() or 1
+    names = (["seen"] if seen else []) + [name for name, _ in default_deal_stages({}, {}, quality)]
+    for name in names:
+        stats.setdefault(name, {"in": 0, "dropped": 0, "seconds": 0.0})
+    pending: "collections.deque" = collections.deque()
+
+    def drain() -> Iterator[Deal]:
+        fut, keys = pending.popleft()
+        rows, chunk_stats, chunk_validation, chunk_relevance = fut.result()
+        for name, st in chunk_stats.items():
+            for k in st: stats[name][k] += st[k]
+        for k in validation_stats: validation_stats[k] += chunk_validation.get(k, 0)
+        for k in relevance_stats: relevance_stats[k] += chunk_relevance.get(k, 0)
+        for key, row in zip(keys, rows):
+            if row is None: continue
+            deal = Deal.from_row(row) if isinstance(row, tuple) else None
+            if key: seen.record(key, deal, None if deal else row)
+            if deal: yield deal
+
+    ctx = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        rows, keys = [], []
+        for item in items:
+            key, known = _seen_lookup(seen, item, stats)
+            if known is not None:
+                if known: yield known
+                continue
+            rows.append(item.to_row()); keys.append(key)
+            if len(rows) >= chunk_size:
+                pending.append((pool.submit(run_stage_chunk, rows, quality), keys))
+                rows, keys = [], []
+            while pending and (len(pending) >= 2 * workers or pending[0][0].done()):
+                yield from drain()
+        if rows: pending.append((pool.submit(run_stage_chunk, rows, quality), keys))
+        while pending:
+            yield from drain()
+    _record_stage_metrics(names, stats)
+
+def iter_search_results(queries: Dict[str, List[str]], tracker: Optional[QueryYieldTracker] = None,
+                        require_results: bool = True) -> Iterator[Deal]:
+    """
+    Run the async fan-out on a background loop and yield each query's hits as they
+    land. tracker only needs record_search (shard workers pass a ShardSearchLog).
+    """
+    print(f"\n🔍 Running {len(queries['serpapi'])} SerpAPI + {len(queries['tavily'])} Tavily queries…")
+    results: "queue.Queue" = queue.Queue()
+    done = object()
+
+    def runner():
+        import asyncio
+        try:
+            asyncio.run(search_all_async(queries, results.put, on_query_done=tracker.record_search if tracker else None))
+        except BaseException as e:
+            results.put(e)
+        finally:
+            results.put(done)
+
+    threading.Thread(target=runner, name="search-fanout", daemon=True).start()
+    raw, waited, batches = 0, 0.0, 0
+    while True:
+        start = time.perf_counter()
+        batch = results.get()
+        waited += time.perf_counter() - start; batches += 1
+        if batch is done: break
+        if isinstance(batch, BaseException): raise batch
+        for item in batch:
+            raw += 1
+            yield item
+
+    METRICS.record_span("search_wait", waited, count=batches)  # time the stages sat idle waiting on providers
+    METRICS.inc("raw_results_total", raw)
+    print(f"\n📊 Collected {raw} raw results")
+    if not raw and require_results: raise RuntimeError("No results found. Check your API keys or service availability.")
+
+# ---------------- Sharded search ----------------
+# With SHARD_COUNT > 1 the coordinator (main) splits the query plan into shards
+# of roughly equal provider-call cost. Each worker runs search + per-deal stages
+# on its shard and ships back JSON-safe deal state, yield bookkeeping and stats;
+# merge, dedup and the Firestore write stay in the coordinator. Workers are a
+# local process pool (SHARD_MODE=local) or Pub/Sub fan-out (SHARD_MODE=pubsub).
+SHARD_COLLECTION = "gf_shard_runs"
+
+class ShardSearchLog:
+    """Stands in for the yield tracker inside a worker: keeps (source, link) per finished query."""
+
+    def __init__(self):
+        self.searches: List[Dict] = []
+        self.raw = 0
+
+    def record_search(self, provider: str, query: str, items: List[Deal], engines: Optional[List[str]] = None) -> None:
+        self.searches.append({"provider": provider, "query": query, "engines": engines, "hits": [[d.source, d.link] for d in items]})
+        self.raw += len(items)
+
+def shard_plan(plan: Dict[str, List[str]], shards: int) -> List[Dict[str, List[str]]]:
+    """Longest-first greedy split by call cost (SerpAPI engines per query, 1 per Tavily query)."""
+    engines = plan.get("serpapi_engines", {})
+    units = [("serpapi", q, len(engines.get(q) or SERPAPI_ENGINES)) for q in plan.get("serpapi", [])]
+    units += [("tavily", q, 1) for q in plan.get("tavily", [])]
+    out = [{"serpapi": [], "tavily": [], "serpapi_engines": {}} for _ in range(max(1, shards))]
+    load = [0] * len(out)
+    for provider, q, cost in sorted(units, key=lambda u: -u[2]):
+        i = min(range(len(out)), key=load.__getitem__)
+        out[i][provider].append(q); load[i] += cost
+        if provider == "serpapi" and q in engines: out[i]["serpapi_engines"][q] = engines[q]
+    return [s for s in out if s["serpapi"] or s["tavily"]]
+
+def run_shard(plan: Dict[str, List[str]], shard: int = 0, rate_scale: float = 1.0) -> Dict:
+    """Worker half of a sharded run. rate_scale < 1 gives this worker its slice of the provider rate limits."""
+    global RATE_LIMITER
+    if rate_scale < 1:
+        RATE_LIMITER = RateLimiter({k: (r * rate_scale, max(1, int(b * rate_scale))) for k, (r, b) in DEFAULT_RATE_LIMITS.items()})
+    METRICS.reset()
+    log = ShardSearchLog()
+    stage_stats: Dict[str, Dict[str, int]] = {}
+    validation_stats = {"passed":0,"failed_gf":0,"failed_score":0}
+    relevance_stats = new_relevance_stats()
+    seen = open_seen_index()  # read-only here; the coordinator merges and saves what workers touched
+    start = time.perf_counter()
+    survivors = list(run_deal_pipeline(iter_search_results(plan, log, require_results=False),
+                                       default_deal_stages(validation_stats, relevance_stats), stage_stats, seen))
+    return {"shard": shard, "deals": [d.to_state() for d in survivors], "searches": log.searches, "raw": log.raw,
+            "stages": stage_stats, "validation": validation_stats, "relevance": relevance_stats,
+            "seen": seen.touched if seen else {}, "seen_stats": seen.stats if seen else {},
+            "seconds": round(time.perf_counter() - start, 3), "timings": METRICS.breakdown()}
+
+def run_shards_local(plans: List[Dict], rate_scale: float) -> List[Dict]:
+    """Fan shards out to a spawned process pool (fresh interpreter per worker, no forked threads)."""
+    import multiprocessing, concurrent.futures
+    outputs = []
+    ctx = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(plans), mp_context=ctx) as pool:
+        futures = {pool.submit(run_shard, plan, i, rate_scale): i for i, plan in enumerate(plans)}
+        for fut in concurrent.futures.as_completed(futures):
+            try:
+                outputs.append(fut.result())
+            except Exception as e:
+                print(f"❌ Shard {futures[fut]} failed: {e}")
+    return outputs
+
+def run_shards_pubsub(plans: List[Dict], rate_scale: float) -> List[Dict]:
+    """Publish one message per shard to SHARD_TOPIC and wait for the workers' output docs."""
+    run_id = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}-{os.urandom(3).hex()}"
+    shards_ref = get_firestore_client().collection(SHARD_COLLECTION).document(run_id).collection("shards")
+    publisher = get_pubsub_publisher()
+    topic = publisher.topic_path(gcp_project(), SHARD_TOPIC)
+    for f in [publisher.publish(topic, json.dumps({"runId": run_id, "shard": i, "plan": plan, "rateScale": rate_scale}).encode("utf-8"))
+              for i, plan in enumerate(plans)]:
+        f.result(timeout=30)
+    print(f"📤 Published {len(plans)} shards for run {run_id}")
+
+    deadline = time.monotonic() + SEARCH_DEADLINE + 120
+    outputs: Dict[str, Dict] = {}
+    while len(outputs) < len(plans) and time.monotonic() < deadline:
+        for snap in shards_ref.stream():
+            if snap.id not in outputs:
+                outputs[snap.id] = json.loads(zlib.decompress((snap.to_dict() or {})["output"]))
+        if len(outputs) < len(plans): time.sleep(2)
+    if len(outputs) < len(plans):
+        print(f"⏰ Only {len(outputs)}/{len(plans)} shards reported before the deadline; merging what arrived")
+    for snap in shards_ref.stream(): snap.reference.delete()
+    return list(outputs.values())
+
+def run_sharded_search(queries: Dict[str, List[str]], tracker: QueryYieldTracker, stage_stats: Dict[str, Dict[str, int]],
+                       validation_stats: Dict[str, int], relevance_stats: Dict[str, int], shards: int = SHARD_COUNT,
+                       seen: Optional[SeenDealIndex] = None) -> List[Deal]:
+    """Coordinator half: fan out, then fold every shard's deals, stats and yield bookkeeping back in."""
+    plans = shard_plan(queries, shards)
+    rate_scale = 1.0 / len(plans) if SHARD_SPLIT_RATE_LIMITS else 1.0
+    print(f"\n🧩 Sharding {len(queries.get('serpapi', []))} SerpAPI + {len(queries.get('tavily', []))} Tavily queries into {len(plans)} {SHARD_MODE} shards")
+    outputs = run_shards_pubsub(plans, rate_scale) if SHARD_MODE == "pubsub" else run_shards_local(plans, rate_scale)
+    if not outputs: raise RuntimeError("Every search shard failed.")
+
+    survivors: List[Deal] = []
+    raw = 0
+    for out in sorted(outputs, key=lambda o: o["shard"]):
+        for rec in out["searches"]:
+            tracker.record_hits(rec["provider"], rec["query"], [tuple(h) for h in rec["hits"]], rec["engines"])
+        survivors.extend(Deal.from_state(st) for st in out["deals"])
+        for name, st in out["stages"].items():
+            agg = stage_stats.setdefault(name, {"in": 0, "dropped": 0, "seconds": 0.0})
+            for k in agg: agg[k] += st.get(k, 0)
+        for k in validation_stats: validation_stats[k] += out["validation"].get(k, 0)
+        for k in relevance_stats: relevance_stats[k] += out["relevance"].get(k, 0)
+        if seen: seen.merge(out.get("seen", {}), out.get("seen_stats", {}))
+        raw += out["raw"]
+        METRICS.record_span("shard", out["seconds"])
+        for name, t in out["timings"].items():
+            METRICS.record_span(name, t["total_ms"] / 1000, count=t["count"], max_seconds=t["max_ms"] / 1000)
+    print(f"\n📊 Collected {raw} raw results from {len(outputs)}/{len(plans)} shards")
+    if not raw: raise RuntimeError("No results found. Check your API keys or service availability.")
+    return survivors
+
+@functions_framework.cloud_event
+def run_deals_shard(cloud_event):
+    """Pub/Sub-triggered shard worker (SHARD_TOPIC); output lands in gf_shard_runs/{runId}/shards/{shard}."""
+    from google.cloud import firestore
+    payload = json.loads(base64.b64decode(cloud_event.data["message"]["data"]))
+    doc = get_firestore_client().collection(SHARD_COLLECTION).document(payload["runId"]).collection("shards").document(str(payload["shard"]))
+    if doc.get().exists:
+        print(f"⏭️  Shard {payload['shard']} of {payload['runId']} already done — skipping duplicate delivery")
+        return
+    out = run_shard(payload["plan"], payload["shard"], payload.get("rateScale", 1.0))
+    doc.set({"output": zlib.compress(json.dumps(out).encode("utf-8")), "finishedAt": firestore.SERVER_TIMESTAMP})
+
+def main(progress: Optional[Callable[[str, Dict], None]] = None) -> List[Dict]:
     print("🚀 AI-ENHANCED Gluten-Free Deals & Coupons Scraper v2.0")
     print(f"📅 Searching for current deals as of {datetime.now().strftime('%B %d, %Y')}")
     print("🤖 Powered by OpenAI LLM + Advanced AI Filtering")
@@ -589,62 +2836,362 @@ def main() -> List[Dict]:
     if not TAVILY_API_KEY: missing.append("Tavily")
     if missing: raise RuntimeError(f"Missing API keys for: {', '.join(missing)}")
 
-    try:
-        queries = generate_comprehensive_queries()
-    except Exception as e:
-        print(f"❌ Query generation failed: {e} — using fallback")
-        queries = generate_comprehensive_fallback_queries()
-
-    all_results: List[Dict] = []
-    if SERPAPI_KEY:
-        print(f"\n🔍 Running {len(queries['serpapi'])} SerpAPI queries…")
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as execp:
-            futures = [execp.submit(search_serpapi_enhanced, q) for q in queries['serpapi']]
-            for fut in concurrent.futures.as_completed(futures):
-                all_results.extend(fut.result()); time.sleep(random.uniform(1,2))
-    if TAVILY_API_KEY:
-        print(f"\n🔍 Running {len(queries['tavily'])} Tavily queries…")
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as execp:
-            futures = [execp.submit(search_tavily_enhanced, q) for q in queries['tavily']]
-            for fut in concurrent.futures.as_completed(futures):
-                all_results.extend(fut.result()); time.sleep(random.uniform(1,2))
-
-    print(f"\n📊 Collected {len(all_results)} raw results")
-    if not all_results: raise RuntimeError("No results found. Check your API keys or service availability.")
-
-    all_results = [item for item in all_results if is_real_deal(item)]
-    print(f"📊 {len(all_results)} after basic real-deal filtering")
-
-    validated = ai_powered_deal_validation(all_results)
-    enhanced  = enhance_deal_metadata(validated)
-    
-    # ADD THE FINAL RELEVANCE FILTER HERE - This is the key addition!
-    filtered_deals = final_relevance_filter(enhanced)
+    METRICS.reset()
+    run_start = time.perf_counter()
+    stage_stats: Dict[str, Dict[str, int]] = {}
+    last_report = 0.0
 
-    # 🔁 Firestore replace-all - Use filtered_deals instead of enhanced
+    def report(phase: str, force: bool = True) -> None:
+        """Push phase + live stage counts to the job doc (throttled while searching)."""
+        nonlocal last_report
+        if progress is None or (not force and time.monotonic() - last_report < JOB_PROGRESS_INTERVAL): return
+        last_report = time.monotonic()
+        try:
+            progress(phase, {"stages": json.loads(json.dumps(stage_stats)), "timings": METRICS.breakdown()})
+        except Exception as e:
+            print(f"⚠️ Progress update failed: {e}")
+
+    report("query_plan")
+    with METRICS.span("query_plan"):
+        tracker = load_query_yield()
+        try:
+            queries = generate_comprehensive_queries(tracker)
+        except Exception as e:
+            print(f"❌ Query generation failed: {e} — using fallback")
+            queries = generate_comprehensive_fallback_queries(tracker)
+        queries = allocate_search_budget(queries, tracker)
+
+    # Search hits stream through real-deal → validation → metadata → relevance
+    # while other queries are still running (per shard when SHARD_COUNT > 1);
+    # dedup then hands survivors to the writer.
+    validation_stats = {"passed":0,"failed_gf":0,"failed_score":0}
+    relevance_stats = new_relevance_stats()
+    filtered_deals: List[Dict] = []
+
+    def collect(deals: Iterable[Deal]) -> Iterator[Dict]:
+        for deal in deals:
+            tracker.record_deal(deal)
+            record = deal.to_dict(); filtered_deals.append(record)
+            yield record
+
+    seen = open_seen_index()
+    report("searching")
+    with METRICS.span("search_pipeline"):
+        if SHARD_COUNT > 1:
+            survivors = run_sharded_search(queries, tracker, stage_stats, validation_stats, relevance_stats, seen=seen)
+        else:
+            survivors = []
+            results = iter_search_results(queries, tracker)
+            if STAGE_EXECUTOR == "process":
+                pipeline = run_deal_pipeline_pool(results, stage_stats, validation_stats, relevance_stats, seen)
+            else:
+                pipeline = run_deal_pipeline(results, default_deal_stages(validation_stats, relevance_stats), stage_stats, seen)
+            for deal in pipeline:
+                survivors.append(deal); report("searching", force=False)
+    if seen: run_in_background("seen_index_save", seen.save)
+
+    # Cross-source dedup needs every result, so it is the one step that buffers
+    dedup_stats: Dict[str, int] = {}
+    report("dedup")
+    with METRICS.span("dedup"):
+        deduped = dedupe_deals(survivors, dedup_stats)
+    stage_stats["dedup"] = {"in": dedup_stats["in"], "dropped": dedup_stats["dropped"]}
+
+    # Optional LLM second opinion on the uncertain score band, after dedup so each deal is judged once
+    review_stats: Dict[str, int] = {}
+    if LLM_REVIEW:
+        report("review")
+        with METRICS.span("review"):
+            reviewed = llm_review_deals(deduped, review_stats)
+        stage_stats["llm_review"] = {"in": len(deduped), "dropped": review_stats["dropped"]}
+        deduped = reviewed
+
+    # 🔁 Firestore write (diff sync by default; FIRESTORE_WRITE_MODE=replace rewrites all, =snapshot publishes a versioned run)
     run_ts = datetime.utcnow()
-    _ = replace_deals_firestore(filtered_deals, run_ts)
+    report("writing")
+    with METRICS.span("firestore_write", mode=FIRESTORE_WRITE_MODE):
+        write_stats = write_deals_firestore(collect(deduped), run_ts)
+
+    print(f"📊 Pipeline stages: {stage_stats}")
+    print(f"🧬 Dedup clusters: {dedup_stats}")
+    if LLM_REVIEW: print(f"🧑‍⚖️ LLM review: {review_stats}")
+    print(f" ✅ Validation: {validation_stats}")
+    print(f"📊 Final filter results: {relevance_stats}")
+    print(f"🏷️  Domain resolver: {DOMAIN_RESOLVER.stats_snapshot()}")
+    print(f"🚦 Rate limiter: {RATE_LIMITER.snapshot()}")
+    print(f"🗄️  Search cache ({SEARCH_CACHE_BACKEND}): {get_search_cache().stats}")
+    if seen: print(f"👁️  Seen-deal index ({SEEN_INDEX}): {seen.stats}")
+    with METRICS.span("yield_commit"):
+        yield_stats = tracker.commit()
+    print(f"📈 Query yield: {yield_stats}")
+    filtered_deals.sort(key=lambda x: x.get("ai_quality_score",0), reverse=True)
+
+    METRICS.record_span("total", time.perf_counter() - run_start)
+    METRICS.inc("deals_written_total", len(filtered_deals))
+    timings = METRICS.breakdown()
+    print("⏱️  Timings (ms): " + ", ".join(f"{name}={t['total_ms']:.0f}" for name, t in timings.items()))
+    log_event("run_summary", deals=len(filtered_deals), stages=stage_stats, dedup=dedup_stats, review=review_stats, validation=validation_stats,
+              relevance=relevance_stats, resolver=DOMAIN_RESOLVER.stats_snapshot(), rate_limiter=RATE_LIMITER.snapshot(),
+              search_cache=get_search_cache().stats, seen_index=seen.stats if seen else {}, query_yield=yield_stats,
+              firestore=write_stats, timings=timings)
+    if METRICS_PROM_PATH: METRICS.dump_prometheus(METRICS_PROM_PATH)
+    join_background()
 
     print(f"\n🎉 SUCCESS: {len(filtered_deals)} premium deals saved to Firestore")
     return filtered_deals
 
+# ---------------- Job mode ----------------
+# JOB_MODE=pubsub: the HTTP call creates (or joins) a job doc and publishes its ID
+# to JOB_TOPIC; run_deals_job runs the scrape; get_job_status reads the doc.
+# JOB_MODE=local does the same with an in-memory store and an in-process queue.
+# One lock doc points at the active job, so concurrent triggers coalesce.
+JOB_MODE = os.getenv("JOB_MODE", "sync")  # "sync" (scrape inside the request), "pubsub" or "local"
+JOB_TOPIC = os.getenv("JOB_TOPIC", "gf-deals-jobs")
+JOB_COLLECTION = "gf_jobs"
+JOB_LOCK_PATH = "gf_job_locks/scrape"
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "1800"))  # no heartbeat for this long → job no longer blocks
+JOB_PROGRESS_INTERVAL = 5.0
+ACTIVE_JOB_STATES = ("queued", "running")
+
+class _MemoryTxn:
+    def __init__(self, docs: Dict[str, Dict]):
+        self.docs = docs
+
+    def get(self, path: str) -> Optional[Dict]:
+        doc = self.docs.get(path)
+        return dict(doc) if doc is not None else None
+
+    def set(self, path: str, data: Dict, merge: bool = False) -> None:
+        self.docs[path] = {**self.docs.get(path, {}), **data} if merge else dict(data)
+
+    def delete(self, path: str) -> None:
+        self.docs.pop(path, None)
+
+class _FirestoreTxn:
+    def __init__(self, db, tx):
+        self.db, self.tx = db, tx
+
+    def get(self, path: str) -> Optional[Dict]:
+        snap = self.db.document(path).get(transaction=self.tx)
+        return snap.to_dict() if snap.exists else None
+
+    def set(self, path: str, data: Dict, merge: bool = False) -> None:
+        self.tx.set(self.db.document(path), data, merge=merge)
+
+    def delete(self, path: str) -> None:
+        self.tx.delete(self.db.document(path))
+
+def firestore_transact(fn: Callable):
+    """Run fn(txn) in one Firestore transaction; txn.get/set/delete take doc paths."""
+    from google.cloud import firestore
+    db = get_firestore_client()
+    @firestore.transactional
+    def run(tx): return fn(_FirestoreTxn(db, tx))
+    return run(db.transaction())
+
+class JobStore:
+    """Job docs plus the active-job lock, on Firestore or in memory; every change is one transaction."""
+
+    def __init__(self, backend: str = "firestore"):
+        self.backend = backend
+        if backend != "firestore": self._docs: Dict[str, Dict] = {}; self._lock = threading.RLock()
+
+    def transact(self, fn: Callable):
+        if self.backend != "firestore":
+            with self._lock: return fn(_MemoryTxn(self._docs))
+        return firestore_transact(fn)
+
+    @staticmethod
+    def _live(doc: Optional[Dict]) -> bool:
+        return bool(doc) and doc.get("status") in ACTIVE_JOB_STATES and time.time() - doc.get("heartbeat", 0) < JOB_STALE_SECONDS
+
+    def enqueue_or_join(self, trigger: str) -> Tuple[str, bool]:
+        """(job_id, coalesced): a new queued job, or the one that is already queued/running."""
+        def txn(t):
+            lock = t.get(JOB_LOCK_PATH)
+            active = t.get(f"{JOB_COLLECTION}/{lock['jobId']}") if lock else None
+            if self._live(active):
+                t.set(f"{JOB_COLLECTION}/{lock['jobId']}", {"triggers": active.get("triggers", 1) + 1}, merge=True)
+                return lock["jobId"], True
+            if active and active.get("status") in ACTIVE_JOB_STATES:
+                t.set(f"{JOB_COLLECTION}/{lock['jobId']}", {"status": "stale", "phase": "stale"}, merge=True)
+            job_id = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}-{os.urandom(3).hex()}"
+            now = time.time()
+            t.set(f"{JOB_COLLECTION}/{job_id}", {"jobId": job_id, "status": "queued", "trigger": trigger, "phase": "queued",
+                                                "createdAt": datetime.utcnow().isoformat() + "Z", "heartbeat": now, "triggers": 1})
+            t.set(JOB_LOCK_PATH, {"jobId": job_id})
+            return job_id, False
+        return self.transact(txn)
+
+    def start(self, job_id: str) -> bool:
+        """queued → running. False for duplicate deliveries of a job that is running or finished."""
+        def txn(t):
+            job = t.get(f"{JOB_COLLECTION}/{job_id}")
+            if not job: return False
+            if job["status"] == "running" and self._live(job): return False
+            if job["status"] not in ACTIVE_JOB_STATES: return False
+            t.set(f"{JOB_COLLECTION}/{job_id}", {"status": "running", "phase": "starting", "heartbeat": time.time(),
+                                                "startedAt": datetime.utcnow().isoformat() + "Z"}, merge=True)
+            return True
+        return self.transact(txn)
+
+    def progress(self, job_id: str, phase: str, info: Dict) -> None:
+        self.transact(lambda t: t.set(f"{JOB_COLLECTION}/{job_id}", {"phase": phase, "heartbeat": time.time(), **info}, merge=True))
+
+    def finish(self, job_id: str, status: str, info: Dict) -> None:
+        def txn(t):
+            lock = t.get(JOB_LOCK_PATH)
+            t.set(f"{JOB_COLLECTION}/{job_id}", {"status": status, "phase": status, "heartbeat": time.time(),
+                                                "finishedAt": datetime.utcnow().isoformat() + "Z", **info}, merge=True)
+            if lock and lock.get("jobId") == job_id: t.delete(JOB_LOCK_PATH)
+        self.transact(txn)
+
+    def get(self, job_id: Optional[str] = None) -> Optional[Dict]:
+        """One job doc; without an ID, the active job (if any)."""
+        def txn(t):
+            jid = job_id or (t.get(JOB_LOCK_PATH) or {}).get("jobId")
+            return t.get(f"{JOB_COLLECTION}/{jid}") if jid else None
+        return self.transact(txn)
+
+class PubSubJobQueue:
+    def __init__(self, topic: str = JOB_TOPIC):
+        self.publisher = get_pubsub_publisher()
+        self.topic_path = self.publisher.topic_path(gcp_project(), topic)
+
+    def publish(self, job_id: str) -> None:
+        self.publisher.publish(self.topic_path, json.dumps({"jobId": job_id}).encode("utf-8")).result(timeout=30)
+
+class LocalJobQueue:
+    """In-process stand-in for the Pub/Sub topic: one daemon thread runs published jobs in order."""
+
+    def __init__(self, handler: Callable[[str], None]):
+        self._handler = handler
+        self._queue: "queue.Queue[str]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def publish(self, job_id: str) -> None:
+        self._queue.put(job_id)
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._drain, name="job-worker", daemon=True)
+                self._thread.start()
+
+    def _drain(self) -> None:
+        while True:
+            job_id = self._queue.get()
+            try:
+                self._handler(job_id)
+            finally:
+                self._queue.task_done()
+
+    def join(self) -> None:
+        self._queue.join()
+
+_job_store: Optional[JobStore] = None
+_job_queue = None
+
+def get_job_store() -> JobStore:
+    global _job_store
+    if _job_store is None: _job_store = JobStore("memory" if JOB_MODE == "local" else "firestore")
+    return _job_store
+
+def get_job_queue():
+    global _job_queue
+    if _job_queue is None: _job_queue = LocalJobQueue(run_job) if JOB_MODE == "local" else PubSubJobQueue()
+    return _job_queue
+
+def submit_job(trigger: str) -> Tuple[str, bool]:
+    """Enqueue a scrape, or join the one already in flight."""
+    store = get_job_store()
+    job_id, coalesced = store.enqueue_or_join(trigger)
+    if not coalesced:
+        try:
+            get_job_queue().publish(job_id)
+        except Exception as e:
+            store.finish(job_id, "failed", {"error": f"publish failed: {e}"})
+            raise
+    log_event("job_submitted", jobId=job_id, trigger=trigger, coalesced=coalesced)
+    return job_id, coalesced
+
+def run_job(job_id: str) -> None:
+    """Worker body shared by the Pub/Sub entry point and the local queue."""
+    store = get_job_store()
+    if not store.start(job_id):
+        print(f"⏭️  Job {job_id} is already running or finished — skipping duplicate delivery")
+        return
+    try:
+        deals = main(progress=lambda phase, info: store.progress(job_id, phase, info))
+        store.finish(job_id, "succeeded", {"count": len(deals), "timings": METRICS.breakdown()})
+    except Exception as e:
+        print(f"❌ Job {job_id} failed: {e}")
+        store.finish(job_id, "failed", {"error": str(e), "timings": METRICS.breakdown()})
+
+@functions_framework.cloud_event
+def run_deals_job(cloud_event):
+    """Pub/Sub-triggered worker. A message without a jobId (e.g. straight from Cloud Scheduler) is submitted first."""
+    raw = (cloud_event.data or {}).get("message", {}).get("data")
+    payload = json.loads(base64.b64decode(raw)) if raw else {}
+    job_id = payload.get("jobId")
+    if not job_id:
+        job_id, coalesced = get_job_store().enqueue_or_join("pubsub")
+        if coalesced: print(f"🔗 Trigger joined active job {job_id}"); return
+    run_job(job_id)
+
 # ---------------- HTTP entry point ----------------
 from flask import jsonify, Request
 
 def get_gluten_free_deals(request: Request):
     """
-    Synchronous HTTP entry point.
-    Runs the scrape and replaces Firestore collection.
-    NOTE: This may take several minutes. Deploy with long timeout in Gen2.
+    HTTP entry point.
+    With JOB_MODE=pubsub/local it enqueues a scrape (or joins the one already
+    running) and answers 202 with the job ID at once; poll get_job_status.
+    With JOB_MODE=sync it runs the scrape and syncs the Firestore collection
+    inside the request. NOTE: that may take several minutes; deploy with a long timeout.
     """
+    if JOB_MODE != "sync":
+        try:
+            job_id, coalesced = submit_job("http")
+            return jsonify({"jobId": job_id, "coalesced": coalesced, "status": get_job_store().get(job_id)["status"]}), 202
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
     try:
         deals = main()
         return jsonify({
             "generatedAt": datetime.utcnow().isoformat() + "Z",
             "count": len(deals),
+            "timings": METRICS.breakdown(),
         }), 200
+    except Exception as e:
+        log_event("run_failed", severity="ERROR", error=str(e), timings=METRICS.breakdown())
+        return jsonify({"error": str(e), "timings": METRICS.breakdown()}), 500
+
+def get_job_status(request: Request):
+    """HTTP status endpoint: ?jobId=... or, without it, the active job."""
+    try:
+        job = get_job_store().get(request.args.get("jobId"))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+    if not job:
+        return jsonify({"error": "job not found" if request.args.get("jobId") else "no active job"}), 404
+    return jsonify(job), 200
+
+def rollback_gluten_free_deals(request: Request):
+    """HTTP rollback for FIRESTORE_WRITE_MODE=snapshot: ?runId=... or, without it, the previous run."""
+    try:
+        return jsonify(rollback_deals_snapshot(request.args.get("runId"))), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 409
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def sweep_gluten_free_deals(request: Request):
+    """HTTP expiry sweep (e.g. hourly from Cloud Scheduler); cheap enough to run between scrapes."""
+    try:
+        return jsonify(sweep_expired_deals()), 200
+    except Exception as e:
+        log_event("sweep_failed", severity="ERROR", error=str(e))
+        return jsonify({"error": str(e)}), 500
 
 # ---------------- Local run ----------------
 if __name__ == "__main__":
@@ -653,6 +3200,6 @@ if __name__ == "__main__":
         deals = main()
     except Exception as err:
         print(f"❌ Execution error: {err}")
-    else:
+    finally:
         elapsed = (datetime.now() - start).total_seconds()
-        print(f"⏱️  Total runtime: {elapsed:.1f} seconds")
\ No newline at end of file
+        print(f"⏱️  Total runtime: {elapsed:.1f} seconds")
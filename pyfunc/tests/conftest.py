@@ -0,0 +1,6 @@
+import os
+import sys
+
+# main.py is a flat Cloud Functions module, not a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("K_SERVICE", "tests")  # config from env vars only, no .env lookup
@@ -0,0 +1,59 @@
+from datetime import datetime
+
+import pytest
+
+import main
+
+FETCHED = datetime(2026, 10, 18, 12)
+
+
+def deal(title, snippet="", link="", source="Tavily", **kw):
+    return main.Deal(title, snippet, link, source, FETCHED, **kw)
+
+
+@pytest.mark.parametrize("link, expected", [
+    ("https://www.Target.com/p/bread/-/A-1?utm_source=x&b=2&a=1#reviews", "https://target.com/p/bread/-/A-1?a=1&b=2"),
+    ("http://kroger.com:80/deals/", "https://kroger.com/deals"),
+    ("https://shop.example.com:8443/x?gclid=abc&fbclid=def", "https://shop.example.com:8443/x"),
+    ("https://example.com/", "https://example.com"),
+    ("https://example.com/?q=", "https://example.com?q="),
+    ("not a url", "not a url"),
+    ("", ""),
+    ("https://bad:port/x", "https://bad:port/x"),
+])
+def test_canonicalize_url(link, expected):
+    assert main.canonicalize_url(link) == expected
+
+
+def test_same_canonical_url_collapses():
+    stats = {}
+    kept = main.dedupe_deals([
+        deal("gluten free bread sale", "20% off", "https://www.target.com/bread?utm_campaign=a"),
+        deal("gf bread deal", "20% off", "https://target.com/bread/", ai_quality_score=5),
+    ], stats)
+    assert [d.ai_quality_score for d in kept] == [5]
+    assert stats == {"in": 2, "clusters": 1, "kept": 1, "dropped": 1}
+
+
+def test_near_identical_text_collapses_across_urls():
+    text = "schar gluten free crackers are 25% off this week at kroger for card members and online orders"
+    kept = main.dedupe_deals([
+        deal("schar crackers deal", text, "https://kroger.com/a", source="SerpAPI (google)"),
+        deal("schar crackers deal", text + " now", "https://hip2save.com/b", source_boost=True),
+    ])
+    assert [d.link for d in kept] == ["https://hip2save.com/b"]
+
+
+@pytest.mark.parametrize("a, b", [
+    ("save 25% on schar gluten free crackers this week at kroger", "buy one get one free canyon bakehouse bread at target"),
+    ("save 25% on schar crackers with code SCHAR25", "save 25% on schar crackers with code CRACK10"),
+])
+def test_distinct_deals_are_kept(a, b):
+    kept = main.dedupe_deals([deal("deal one", a, "https://kroger.com/a"), deal("deal two", b, "https://kroger.com/b")])
+    assert len(kept) == 2
+
+
+def test_keeps_input_order():
+    deals = [deal(f"deal {i}", f"unique snippet number {i} about {w}", f"https://example.com/{i}")
+             for i, w in enumerate(["bread", "pasta", "crackers", "cookies"])]
+    assert main.dedupe_deals(deals) == deals
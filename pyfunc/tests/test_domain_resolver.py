@@ -0,0 +1,54 @@
+import pytest
+
+import main
+
+
+@pytest.fixture
+def resolver():
+    return main.DomainResolver(
+        {"kind.com": "KIND", "shop.kind.com": "KIND Shop", "happycampersgf": "Happy Campers GF", "target.com": "Target"},
+        {"target.com": "Target Deals", "schar": "Schar"},
+    )
+
+
+@pytest.mark.parametrize("host, expected", [
+    ("kind.com", "KIND"),
+    ("www.kind.com", "KIND"),
+    ("us.kind.com", "KIND"),          # subdomain falls back to the registrable domain
+    ("shop.kind.com", "KIND Shop"),   # deepest suffix wins
+    ("KIND.COM.", "KIND"),
+    ("mykind.com", None),             # no substring matches on dotted keys
+    ("kind.com.evil.net", None),
+    ("happycampersgf.myshopify.com", "Happy Campers GF"),  # bare key matches a whole label
+    ("www.happycampersgf.com", "Happy Campers GF"),
+    ("happycampers.com", None),
+    ("target.com", "Target"),         # earlier mapping wins
+    ("", None),
+])
+def test_resolve(resolver, host, expected):
+    assert resolver.resolve(host) == expected
+
+
+def test_bare_key_ignores_tld_label():
+    assert main.DomainResolver({"com": "Nope"}).resolve("example.com") is None
+
+
+def test_resolve_url(resolver):
+    assert resolver.resolve_url("https://us.kind.com/products/bars?x=1") == "KIND"
+    assert resolver.resolve_url("not a url") is None
+
+
+def test_stats_count_ambiguous_and_cached_lookups(resolver):
+    resolver.resolve("schar.kind.com"); resolver.resolve("schar.kind.com"); resolver.resolve("nowhere.org")
+    stats = resolver.stats_snapshot()
+    assert (stats["lookups"], stats["resolved"], stats["unresolved"], stats["ambiguous"]) == (3, 2, 1, 2)
+    assert (stats["cache_hits"], stats["cache_misses"]) == (1, 2)
+
+
+@pytest.mark.parametrize("url, store", [
+    ("https://www.costco.com/gluten-free.html", "Costco"),
+    ("https://shop.bobsredmill.com/x", "Bob's Red Mill"),
+    ("https://gfjules.myshopify.com/", "GfJules"),
+])
+def test_default_resolver(url, store):
+    assert main.DOMAIN_RESOLVER.resolve_url(url) == store
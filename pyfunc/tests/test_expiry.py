@@ -0,0 +1,59 @@
+from datetime import date
+
+import pytest
+
+import main
+
+TODAY = date(2026, 10, 18)  # a Sunday
+
+
+def expiry(text, today=TODAY):
+    return main.parse_expiry_date(main._deal_features(text, today).expiration, today)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("expires 10/31", date(2026, 10, 31)),
+    ("valid thru 12/25/26", date(2026, 12, 25)),
+    ("expires on 2026-12-01", date(2026, 12, 1)),
+    ("valid until nov 3, 2026", date(2026, 11, 3)),
+    ("expires 5th of january", date(2027, 1, 5)),
+    ("ends march 3rd", date(2027, 3, 3)),
+    ("expires aug 2026", date(2026, 8, 31)),
+    ("offer ends in 3 days", date(2026, 10, 21)),
+    ("expires in 2 weeks", date(2026, 11, 1)),
+    ("ends tomorrow", date(2026, 10, 19)),
+    ("ends tonight", date(2026, 10, 18)),
+    ("offer ends tuesday", date(2026, 10, 20)),
+    ("valid through end of month", date(2026, 10, 31)),
+    ("good through this weekend", date(2026, 10, 18)),
+])
+def test_expiry_dates(text, expected):
+    assert expiry(text) == expected
+
+
+@pytest.mark.parametrize("text", [
+    "good for 1/2 off all bread",
+    "good & gather decaf 12 oz",
+    "valid on orders at market 5 locations",
+    "valid with junk 3 snacks",
+    "valid in sunday circular",
+    "expires soon",
+    "while supplies last",
+])
+def test_product_text_is_not_a_date(text):
+    assert expiry(text) is None
+
+
+def test_relative_phrases_are_left_out_of_the_feature_record():
+    feats = main._deal_features("gf pasta coupon, offer ends in 5 days", TODAY)
+    assert feats.expiration == "offer ends in 5 days"
+    assert feats.expires_on is None
+    assert main.relative_expiry_date(feats.expiration, date(2026, 10, 1)) == date(2026, 10, 6)
+
+
+def test_missing_year_rolls_over_only_when_well_past():
+    assert main.parse_expiry_date("expires 10/1", TODAY) == date(2026, 10, 1)
+    assert main.parse_expiry_date("ends on august 21", TODAY) == date(2026, 8, 21)  # stale page, not next year
+    assert main.parse_expiry_date("expires 1/5", TODAY) == date(2027, 1, 5)
+    assert main.parse_expiry_date("expires 1/5", date(2026, 12, 20)) == date(2027, 1, 5)
+    assert main.parse_expiry_date("expires 2/30", TODAY) is None
@@ -0,0 +1,51 @@
+import pytest
+
+import main
+
+
+@pytest.fixture
+def index():
+    return main.KeywordIndex({"gf": ["gluten free", "gf", "celiac"], "deal": ["sale", "% off", "bogo"], "spam": ["free"]})
+
+
+def test_scan_groups_hits_by_category(index):
+    hits = index.scan("gluten free bread on sale, 20% off")
+    assert hits == {"gf": {"gluten free"}, "deal": {"sale", "% off"}, "spam": {"free"}}
+
+
+def test_every_category_present_when_nothing_matches(index):
+    assert index.scan("whole wheat bagels") == {"gf": frozenset(), "deal": frozenset(), "spam": frozenset()}
+
+
+@pytest.mark.parametrize("text, term", [  # substring, not word, semantics
+    ("gfjules.com", "gf"),
+    ("bogofest", "bogo"),
+    ("xceliacx", "celiac"),
+])
+def test_substring_matches(index, text, term):
+    assert term in set().union(*index.scan(text).values())
+
+
+def test_overlapping_and_suffix_terms():
+    index = main.KeywordIndex({"a": ["he", "she", "his", "hers"]})
+    assert index.scan("ushers")["a"] == {"he", "she", "hers"}
+
+
+def test_terms_are_lowercased_but_text_is_not():
+    index = main.KeywordIndex({"store": ["Target"]})
+    assert index.scan("target run")["store"] == {"target"}
+    assert index.scan("TARGET RUN")["store"] == frozenset()
+
+
+def test_fingerprint_tracks_vocabulary():
+    assert main.KeywordIndex({"a": ["x"]}).fingerprint == main.KeywordIndex({"a": ["x"]}).fingerprint
+    assert main.KeywordIndex({"a": ["x"]}).fingerprint != main.KeywordIndex({"a": ["y"]}).fingerprint
+
+
+def test_matches_naive_substring_scan():
+    vocab = {"gf": main.GF_KEYWORDS, "deal": main.DEAL_INDICATORS, "spam": main.SPAM_INDICATORS, "store": main.TEXT_STORE_NAMES}
+    index = main.KeywordIndex(vocab)
+    for text in ["celiac safe gluten-free pizza bogo at whole foods", "20% off glutino crackers at target this week",
+                 "click here to win a free iphone", ""]:
+        expected = {c: {t.lower() for t in terms if t.lower() in text} for c, terms in vocab.items()}
+        assert index.scan(text) == expected
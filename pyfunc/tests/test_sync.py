@@ -0,0 +1,81 @@
+from datetime import datetime
+
+import pytest
+
+import main
+
+RUN_TS = datetime(2026, 10, 18, 12)
+
+
+class FakeWriter:
+    """DealDocWriter stand-in that records ops; `fail` lists doc IDs whose writes never land."""
+
+    def __init__(self, db, collection, fail=()):
+        self.coll, self.ops, self.fail = None, [], set(fail)
+        self.stats = {"written": 0, "deleted": 0, "retried": 0, "failed": 0}
+        self.failures = {}
+
+    def set(self, doc_id, data):
+        self.ops.append(("set", doc_id))
+        if doc_id in self.fail: self.failures[doc_id] = "code 14: unavailable"; self.stats["failed"] += 1
+        else: self.stats["written"] += 1
+
+    def delete(self, doc_id):
+        self.ops.append(("delete", doc_id)); self.stats["deleted"] += 1
+
+    def flush(self):
+        pass
+
+    def close(self):
+        return self.stats
+
+
+def deal(link, discount="20% off", **kw):
+    return {"title": "gf bread sale", "link": link, "discount_amount": discount, "timestamp": "now", **kw}
+
+
+@pytest.fixture
+def sync(monkeypatch):
+    def run(deals, existing, fail=()):
+        writers = []
+        def make(db, collection):
+            writers.append(FakeWriter(db, collection, fail)); return writers[-1]
+        monkeypatch.setattr(main, "get_firestore_client", lambda: None)
+        monkeypatch.setattr(main, "DealDocWriter", make)
+        monkeypatch.setattr(main, "existing_deal_hashes", lambda coll: dict(existing))
+        return main.sync_deals_firestore(deals, RUN_TS), writers[0].ops
+    return run
+
+
+def test_doc_id_follows_canonical_url_and_discount():
+    assert main.deal_doc_id(deal("https://www.target.com/b?utm_source=x")) == main.deal_doc_id(deal("https://target.com/b/"))
+    assert main.deal_doc_id(deal("https://target.com/b")) != main.deal_doc_id(deal("https://target.com/b", "30% off"))
+
+
+def test_content_hash_ignores_volatile_fields():
+    a = deal("https://target.com/b")
+    assert main.deal_content_hash(a) == main.deal_content_hash({**a, "timestamp": "later", "runAt": RUN_TS, "contentHash": "x"})
+    assert main.deal_content_hash(a) != main.deal_content_hash({**a, "title": "gf bread bogo"})
+
+
+def test_sync_writes_only_changes(sync):
+    same, changed, new = deal("https://a.com/1"), deal("https://a.com/2"), deal("https://a.com/3")
+    existing = {main.deal_doc_id(same): main.deal_content_hash(same), main.deal_doc_id(changed): "old", "stale": "h"}
+    stats, ops = sync([same, changed, new], existing)
+    assert stats == {"inserted": 1, "updated": 1, "unchanged": 1, "deleted": 1, "retried": 0, "failed": 0}
+    assert ops == [("set", main.deal_doc_id(changed)), ("set", main.deal_doc_id(new)), ("delete", "stale")]
+
+
+def test_sync_repeated_deal_last_one_wins(sync):
+    first, second = deal("https://a.com/1"), deal("https://a.com/1/", title="gf bread bogo")
+    stats, ops = sync([first, second, first], {})
+    doc_id = main.deal_doc_id(first)
+    assert ops == [("set", doc_id), ("set", doc_id), ("set", doc_id)]
+    assert (stats["inserted"], stats["updated"], stats["unchanged"]) == (1, 2, 0)
+
+
+def test_sync_keeps_stale_docs_when_writes_fail(sync):
+    new = deal("https://a.com/3")
+    stats, ops = sync([new], {"stale": "h"}, fail=[main.deal_doc_id(new)])
+    assert ("delete", "stale") not in ops
+    assert stats["failed"] == 1 and stats["failed_docs"] == {main.deal_doc_id(new): "code 14: unavailable"}